@@ -5,12 +5,16 @@ import json
 import math
 import mimetypes
 import os
+import queue
 import shutil
+import threading
+import time
 import traceback
-from threading import Event
+from typing import Callable, Optional
 from uuid import uuid4
 
 import eventlet
+from eventlet import tpool
 from PIL import Image
 from PIL.Image import Image as ImageType
 from flask import Flask, redirect, send_from_directory, request, make_response
@@ -20,6 +24,15 @@ from werkzeug.utils import secure_filename
 from backend.modules.get_canvas_generation_mode import (
     get_canvas_generation_mode,
 )
+from backend.modules.gallery_index import GalleryIndex, gallery_db_path
+from backend.modules.job_queue import (
+    Job,
+    JobQueue,
+    PRIORITY_HIGH,
+    PRIORITY_NORMAL,
+    client_priority,
+    Worker,
+)
 from backend.modules.parameters import parameters_to_command
 from ldm.generate import Generate
 from ldm.invoke.args import Args, APP_ID, APP_VERSION, calculate_init_img_hash
@@ -43,17 +56,48 @@ if not os.path.isabs(args.outdir):
 if not os.path.isabs(opt.conf):
     opt.conf = os.path.normpath(os.path.join(Globals.root,opt.conf))
 
+# progress previews are sent at most this often (seconds), as JPEGs of this quality
+PROGRESS_PREVIEW_INTERVAL = 0.5
+PROGRESS_PREVIEW_QUALITY = 80
+
 class InvokeAIWebServer:
-    def __init__(self, generate: Generate, gfpgan, codeformer, esrgan) -> None:
+    def __init__(
+        self,
+        generate: Generate,
+        gfpgan,
+        codeformer,
+        esrgan,
+        generate_factory: Optional[Callable[[], Generate]] = None,
+    ) -> None:
+        """
+        :param generate: the Generate instance of the first generation worker
+        :param generate_factory: makes the Generate instances of any further
+            workers (see --web_workers); without it there is a single worker
+        """
         self.host = args.host
         self.port = args.port
 
         self.generate = generate
+        self.generate_factory = generate_factory
         self.gfpgan = gfpgan
         self.codeformer = codeformer
         self.esrgan = esrgan
 
-        self.canceled = Event()
+        # the model generation jobs use; the workers switch to it as needed
+        self.model_name = generate.model_name
+        self.model_name_lock = threading.Lock()
+        # held while models are loaded and while the (shared) models config is read or changed
+        self.model_manager_lock = threading.RLock()
+        self.job_queue = JobQueue()
+        worker_count = max(1, args.web_workers) if generate_factory else 1
+        self.workers = [
+            Worker(
+                self.job_queue,
+                index,
+                (lambda: self.generate) if index == 0 else self.make_worker_generate,
+            )
+            for index in range(worker_count)
+        ]
         self.ALLOWED_EXTENSIONS = {"png", "jpg", "jpeg"}
 
     def allowed_file(self, filename: str) -> bool:
@@ -190,6 +234,7 @@ class InvokeAIWebServer:
                 thumbnail_path = save_thumbnail(
                     pil_image, os.path.basename(file_path), self.thumbnail_image_path
                 )
+                self.gallery_index.add(file_path, image=pil_image)
 
                 response = {
                     "url": self.get_url_from_image_path(file_path),
@@ -211,6 +256,11 @@ class InvokeAIWebServer:
 
         self.load_socketio_listeners(self.socketio)
 
+        for worker in self.workers:
+            worker.start()
+        self.socketio.start_background_task(self.relay_job_events)
+        print(f">> Started {len(self.workers)} generation worker(s)")
+
         if args.gui:
             print(">> Launching Invoke AI GUI")
             try:
@@ -297,13 +347,25 @@ class InvokeAIWebServer:
                 self.thumbnail_image_path,
             ]
         ]
+        # index of the images shown in the gallery
+        self.gallery_index = GalleryIndex(
+            gallery_db_path(self.result_path),
+            {"result": self.result_path, "user": self.init_image_path},
+            lambda image, filename: save_thumbnail(
+                image, filename, self.thumbnail_image_path
+            ),
+        )
+        print(">> Updating the gallery index")
+        self.gallery_index.reconcile(force=True)
 
     def load_socketio_listeners(self, socketio):
         @socketio.on("requestSystemConfig")
         def handle_request_capabilities():
             print(f">> System config requested")
             config = self.get_system_config()
-            config["model_list"] = self.generate.model_manager.list_models()
+            config["model_list"] = self.call_with_model_manager(
+                self.generate.model_manager.list_models
+            )
             config["infill_methods"] = infill_methods()
             socketio.emit("systemConfig", config)
 
@@ -316,7 +378,9 @@ class InvokeAIWebServer:
                     {'search_folder': None, 'found_models': None},
                 )
                 else:
-                    search_folder, found_models = self.generate.model_manager.search_models(search_folder)
+                    search_folder, found_models = self.call_with_model_manager(
+                        self.generate.model_manager.search_models, search_folder
+                    )
                     socketio.emit(
                         "foundModels",
                         {'search_folder': search_folder, 'found_models': found_models},
@@ -336,18 +400,17 @@ class InvokeAIWebServer:
                 model_attributes = new_model_config
                 if len(model_attributes['vae']) == 0:
                     del model_attributes['vae']
-                update = False
-                current_model_list = self.generate.model_manager.list_models()
-                if model_name in current_model_list:
-                    update = True
-
                 print(f">> Adding New Model: {model_name}")
 
-                self.generate.model_manager.add_model(
-                    model_name=model_name, model_attributes=model_attributes, clobber=True)
-                self.generate.model_manager.commit(opt.conf)
+                def add_model():
+                    model_manager = self.generate.model_manager
+                    update = model_name in model_manager.list_models()
+                    model_manager.add_model(
+                        model_name=model_name, model_attributes=model_attributes, clobber=True)
+                    model_manager.commit(opt.conf)
+                    return update, model_manager.list_models()
 
-                new_model_list = self.generate.model_manager.list_models()
+                update, new_model_list = self.call_with_model_manager(add_model)
                 socketio.emit(
                     "newModelAdded",
                     {"new_model_name": model_name,
@@ -365,9 +428,14 @@ class InvokeAIWebServer:
         def handle_delete_model(model_name: str):
             try:
                 print(f">> Deleting Model: {model_name}")
-                self.generate.model_manager.del_model(model_name)
-                self.generate.model_manager.commit(opt.conf)
-                updated_model_list = self.generate.model_manager.list_models()
+
+                def delete_model():
+                    model_manager = self.generate.model_manager
+                    model_manager.del_model(model_name)
+                    model_manager.commit(opt.conf)
+                    return model_manager.list_models()
+
+                updated_model_list = self.call_with_model_manager(delete_model)
                 socketio.emit(
                     "modelDeleted",
                     {"deleted_model_name": model_name,
@@ -383,26 +451,18 @@ class InvokeAIWebServer:
 
         @socketio.on("requestModelChange")
         def handle_set_model(model_name: str):
-            try:
-                print(f">> Model change requested: {model_name}")
-                model = self.generate.set_model(model_name)
-                model_list = self.generate.model_manager.list_models()
-                if model is None:
-                    socketio.emit(
-                        "modelChangeFailed",
-                        {"model_name": model_name, "model_list": model_list},
-                    )
-                else:
-                    socketio.emit(
-                        "modelChanged",
-                        {"model_name": model_name, "model_list": model_list},
-                    )
-            except Exception as e:
-                self.socketio.emit("error", {"message": (str(e))})
-                print("\n")
-
-                traceback.print_exc()
-                print("\n")
+            print(f">> Model change requested: {model_name}")
+            # generations requested from now on use the new model
+            with self.model_name_lock:
+                previous_model_name = self.model_name
+                self.model_name = model_name
+            self.submit_job(
+                "model change",
+                lambda job, worker: self.change_model(
+                    job, worker, model_name, previous_model_name
+                ),
+                priority=PRIORITY_HIGH,
+            )
 
         @socketio.on("requestEmptyTempFolder")
         def empty_temp_folder():
@@ -447,6 +507,7 @@ class InvokeAIWebServer:
                 thumbnail_path = save_thumbnail(
                     pil_image, os.path.basename(new_path), self.thumbnail_image_path
                 )
+                self.gallery_index.add(new_path, image=pil_image)
 
                 image_array = [
                     {
@@ -475,59 +536,14 @@ class InvokeAIWebServer:
         @socketio.on("requestLatestImages")
         def handle_request_latest_images(category, latest_mtime):
             try:
-                base_path = (
-                    self.result_path if category == "result" else self.init_image_path
-                )
-
-                paths = []
+                self.gallery_index.reconcile(category)
 
-                for ext in ("*.png", "*.jpg", "*.jpeg"):
-                    paths.extend(glob.glob(os.path.join(base_path, ext)))
-
-                image_paths = sorted(
-                    paths, key=lambda x: os.path.getmtime(x), reverse=True
-                )
-
-                image_paths = list(
-                    filter(
-                        lambda x: os.path.getmtime(x) > latest_mtime,
-                        image_paths,
+                image_array = [
+                    self.get_gallery_image(entry, category)
+                    for entry in self.gallery_index.images(
+                        category, after_mtime=latest_mtime
                     )
-                )
-
-                image_array = []
-
-                for path in image_paths:
-                    try:
-                        if os.path.splitext(path)[1] == ".png":
-                            metadata = retrieve_metadata(path)
-                        else:
-                            metadata = {}
-
-                        pil_image = Image.open(path)
-                        (width, height) = pil_image.size
-
-                        thumbnail_path = save_thumbnail(
-                            pil_image, os.path.basename(path), self.thumbnail_image_path
-                        )
-
-                        image_array.append(
-                            {
-                                "url": self.get_url_from_image_path(path),
-                                "thumbnail": self.get_url_from_image_path(
-                                    thumbnail_path
-                                ),
-                                "mtime": os.path.getmtime(path),
-                                "metadata": metadata.get("sd-metadata"),
-                                "dreamPrompt": metadata.get("Dream"),
-                                "width": width,
-                                "height": height,
-                                "category": category,
-                            }
-                        )
-                    except Exception as e:
-                        socketio.emit("error", {"message": f"Unable to load {path}: {str(e)}"})
-                        pass
+                ]
 
                 socketio.emit(
                     "galleryImages",
@@ -545,62 +561,18 @@ class InvokeAIWebServer:
             try:
                 page_size = 50
 
-                base_path = (
-                    self.result_path if category == "result" else self.init_image_path
-                )
+                self.gallery_index.reconcile(category)
 
-                paths = []
-                for ext in ("*.png", "*.jpg", "*.jpeg"):
-                    paths.extend(glob.glob(os.path.join(base_path, ext)))
-
-                image_paths = sorted(
-                    paths, key=lambda x: os.path.getmtime(x), reverse=True
+                # ask for one more than a page, to know whether there are more to come
+                entries = self.gallery_index.images(
+                    category, before_mtime=earliest_mtime, limit=page_size + 1
                 )
 
-                if earliest_mtime:
-                    image_paths = list(
-                        filter(
-                            lambda x: os.path.getmtime(x) < earliest_mtime,
-                            image_paths,
-                        )
-                    )
-
-                areMoreImagesAvailable = len(image_paths) >= page_size
-                image_paths = image_paths[slice(0, page_size)]
-
-                image_array = []
-                for path in image_paths:
-                    try:
-                        if os.path.splitext(path)[1] == ".png":
-                            metadata = retrieve_metadata(path)
-                        else:
-                            metadata = {}
-
-                        pil_image = Image.open(path)
-                        (width, height) = pil_image.size
-
-                        thumbnail_path = save_thumbnail(
-                            pil_image, os.path.basename(path), self.thumbnail_image_path
-                        )
-
-                        image_array.append(
-                            {
-                                "url": self.get_url_from_image_path(path),
-                                "thumbnail": self.get_url_from_image_path(
-                                    thumbnail_path
-                                ),
-                                "mtime": os.path.getmtime(path),
-                                "metadata": metadata.get("sd-metadata"),
-                                "dreamPrompt": metadata.get("Dream"),
-                                "width": width,
-                                "height": height,
-                                "category": category,
-                            }
-                        )
-                    except Exception as e:
-                        print(f">> Unable to load {path}")
-                        socketio.emit("error", {"message": f"Unable to load {path}: {str(e)}"})
-                        pass
+                areMoreImagesAvailable = len(entries) > page_size
+                image_array = [
+                    self.get_gallery_image(entry, category)
+                    for entry in entries[slice(0, page_size)]
+                ]
 
                 socketio.emit(
                     "galleryImages",
@@ -640,10 +612,19 @@ class InvokeAIWebServer:
                 print(
                     f">> Image generation requested: {printable_parameters}\nESRGAN parameters: {esrgan_parameters}\nFacetool parameters: {facetool_parameters}"
                 )
-                self.generate_images(
-                    generation_parameters,
-                    esrgan_parameters,
-                    facetool_parameters,
+                priority = client_priority(
+                    generation_parameters.pop("priority", PRIORITY_NORMAL)
+                )
+                self.submit_job(
+                    "generation",
+                    lambda job, worker: self.generate_images(
+                        job,
+                        self.generate_with_model(worker),
+                        generation_parameters,
+                        esrgan_parameters,
+                        facetool_parameters,
+                    ),
+                    priority=priority,
                 )
             except Exception as e:
                 self.socketio.emit("error", {"message": (str(e))})
@@ -654,123 +635,28 @@ class InvokeAIWebServer:
 
         @socketio.on("runPostprocessing")
         def handle_run_postprocessing(original_image, postprocessing_parameters):
-            try:
-                print(
-                    f'>> Postprocessing requested for "{original_image["url"]}": {postprocessing_parameters}'
-                )
-
-                progress = Progress()
-
-                socketio.emit("progressUpdate", progress.to_formatted_dict())
-                eventlet.sleep(0)
-
-                original_image_path = self.get_image_path_from_url(
-                    original_image["url"]
-                )
-
-                image = Image.open(original_image_path)
-
-                try:
-                    seed = original_image["metadata"]["image"]["seed"]
-                except (KeyError) as e:
-                    seed = "unknown_seed"
-                    pass
-
-                if postprocessing_parameters["type"] == "esrgan":
-                    progress.set_current_status("common:statusUpscalingESRGAN")
-                elif postprocessing_parameters["type"] == "gfpgan":
-                    progress.set_current_status("common:statusRestoringFacesGFPGAN")
-                elif postprocessing_parameters["type"] == "codeformer":
-                    progress.set_current_status("common:statusRestoringFacesCodeFormer")
-
-                socketio.emit("progressUpdate", progress.to_formatted_dict())
-                eventlet.sleep(0)
-
-                if postprocessing_parameters["type"] == "esrgan":
-                    image = self.esrgan.process(
-                        image=image,
-                        upsampler_scale=postprocessing_parameters["upscale"][0],
-                        strength=postprocessing_parameters["upscale"][1],
-                        seed=seed,
-                    )
-                elif postprocessing_parameters["type"] == "gfpgan":
-                    image = self.gfpgan.process(
-                        image=image,
-                        strength=postprocessing_parameters["facetool_strength"],
-                        seed=seed,
-                    )
-                elif postprocessing_parameters["type"] == "codeformer":
-                    image = self.codeformer.process(
-                        image=image,
-                        strength=postprocessing_parameters["facetool_strength"],
-                        fidelity=postprocessing_parameters["codeformer_fidelity"],
-                        seed=seed,
-                        device="cpu"
-                        if str(self.generate.device) == "mps"
-                        else self.generate.device,
-                    )
-                else:
-                    raise TypeError(
-                        f'{postprocessing_parameters["type"]} is not a valid postprocessing type'
-                    )
-
-                progress.set_current_status("common:statusSavingImage")
-                socketio.emit("progressUpdate", progress.to_formatted_dict())
-                eventlet.sleep(0)
-
-                postprocessing_parameters["seed"] = seed
-                metadata = self.parameters_to_post_processed_image_metadata(
-                    parameters=postprocessing_parameters,
-                    original_image_path=original_image_path,
-                )
-
-                command = parameters_to_command(postprocessing_parameters)
-
-                (width, height) = image.size
-
-                path = self.save_result_image(
-                    image,
-                    command,
-                    metadata,
-                    self.result_path,
-                    postprocessing=postprocessing_parameters["type"],
-                )
-
-                thumbnail_path = save_thumbnail(
-                    image, os.path.basename(path), self.thumbnail_image_path
-                )
-
-                self.write_log_message(
-                    f'[Postprocessed] "{original_image_path}" > "{path}": {postprocessing_parameters}'
-                )
-
-                progress.mark_complete()
-                socketio.emit("progressUpdate", progress.to_formatted_dict())
-                eventlet.sleep(0)
-
-                socketio.emit(
-                    "postprocessingResult",
-                    {
-                        "url": self.get_url_from_image_path(path),
-                        "thumbnail": self.get_url_from_image_path(thumbnail_path),
-                        "mtime": os.path.getmtime(path),
-                        "metadata": metadata,
-                        "dreamPrompt": command,
-                        "width": width,
-                        "height": height,
-                    },
-                )
-            except Exception as e:
-                self.socketio.emit("error", {"message": (str(e))})
-                print("\n")
-
-                traceback.print_exc()
-                print("\n")
+            print(
+                f'>> Postprocessing requested for "{original_image["url"]}": {postprocessing_parameters}'
+            )
+            self.submit_job(
+                "postprocessing",
+                lambda job, worker: self.run_postprocessing(
+                    job, worker.generate, original_image, postprocessing_parameters
+                ),
+                priority=PRIORITY_HIGH,
+            )
 
         @socketio.on("cancel")
-        def handle_cancel():
+        def handle_cancel(job_id=None):
             print(f">> Cancel processing requested")
-            self.canceled.set()
+            for job in self.job_queue.cancel(job_id=job_id, session_id=request.sid):
+                if job.id not in self.job_queue.running:
+                    # running jobs report this themselves when they stop
+                    job.emit("processingCanceled")
+
+        @socketio.on("disconnect")
+        def handle_disconnect():
+            self.job_queue.forget_session(request.sid)
 
         # TODO: I think this needs a safety mechanism.
         @socketio.on("deleteImage")
@@ -784,6 +670,7 @@ class InvokeAIWebServer:
 
                 send2trash(path)
                 send2trash(thumbnail_path)
+                self.gallery_index.remove(path)
 
                 socketio.emit(
                     "imageDeleted",
@@ -796,30 +683,247 @@ class InvokeAIWebServer:
                 traceback.print_exc()
                 print("\n")
 
-    # App Functions
-    def get_system_config(self):
-        model_list: dict = self.generate.model_manager.list_models()
-        active_model_name = None
+    # Job Functions
+    def submit_job(self, kind, run, priority=PRIORITY_NORMAL):
+        """
+        Queues a job for the generation workers on behalf of the client
+        whose socket.io event is being handled.
+        """
+        job = Job(request.sid, kind, run, priority=priority)
+        ahead = self.job_queue.submit(job)
+        print(f">> Queued {kind} job {job.id} behind {ahead} other jobs")
+        job.emit("jobQueued", {"jobId": job.id, "kind": kind, "position": ahead})
+        return job
+
+    def relay_job_events(self):
+        """
+        Sends the events emitted by jobs on worker threads to their clients.
+        Runs on the socket.io event loop.
+        """
+        while True:
+            try:
+                event, data, session_id = self.job_queue.events.get_nowait()
+            except queue.Empty:
+                eventlet.sleep(0.02)
+                continue
+            if data is None:
+                self.socketio.emit(event, to=session_id)
+            else:
+                self.socketio.emit(event, data, to=session_id)
+
+    def change_model(self, job, worker, model_name, previous_model_name):
+        """
+        Runs a model change job: loads the model into the worker that takes
+        the job. The other workers switch when they get their next generation
+        job. If the model can't be loaded, generation jobs go back to
+        previous_model_name, unless another model change was requested since.
+        """
+        failed = True
+        try:
+            generate = worker.generate
+            # load the new model into RAM in the background, so that a model
+            # which is still on the device can be used until it is ready
+            model_manager = generate.model_manager
+            if model_manager.prefetch(model_name):
+                while model_manager.is_prefetching(model_name):
+                    time.sleep(0.1)
+            with self.model_manager_lock:
+                # set_model() falls back to the previous model if the new one fails to load
+                model = generate.set_model(model_name)
+                model_list = generate.model_manager.list_models()
+            failed = model is None or generate.model_name != model_name
+            if failed:
+                job.broadcast(
+                    "modelChangeFailed",
+                    {"model_name": model_name, "model_list": model_list},
+                )
+            else:
+                job.broadcast(
+                    "modelChanged",
+                    {"model_name": model_name, "model_list": model_list},
+                )
+        except Exception as e:
+            job.emit("error", {"message": (str(e))})
+            print("\n")
 
-        for model_name, model_dict in model_list.items():
-            if model_dict["status"] == "active":
-                active_model_name = model_name
+            traceback.print_exc()
+            print("\n")
+        finally:
+            if failed:
+                with self.model_name_lock:
+                    if self.model_name == model_name:
+                        self.model_name = previous_model_name
+
+    def generate_with_model(self, worker):
+        """
+        Returns the worker's Generate instance, switched to the model
+        generations currently use.
+        """
+        with self.model_name_lock:
+            model_name = self.model_name
+        generate = worker.generate
+        if generate.model_name != model_name or generate.model is None:
+            with self.model_manager_lock:
+                generate.set_model(model_name)
+        return generate
+
+    def call_with_model_manager(self, function, *args, **kwargs):
+        """
+        Calls function holding the model manager lock. It runs on a thread of
+        eventlet's pool, so the event loop keeps serving other clients while
+        a worker holds the lock, e.g. while it loads a model.
+        """
+        def locked():
+            with self.model_manager_lock:
+                return function(*args, **kwargs)
+
+        return tpool.execute(locked)
+
+    def make_worker_generate(self):
+        """
+        Creates the Generate instance of a worker other than the first. It
+        shares its model list with the first worker's, so that models added
+        or deleted in the UI are seen by every worker.
+        """
+        generate = self.generate_factory()
+        with self.model_manager_lock:
+            generate.model_manager.config = self.generate.model_manager.config
+        return generate
 
+    # App Functions
+    def get_system_config(self, generate=None):
+        """
+        Describes the model of generate (by default, the first worker's).
+        Only reads attributes that set_model() assigns, so it does not need
+        the model manager lock.
+        """
+        generate = generate or self.generate
         return {
             "model": "stable diffusion",
-            "model_weights": active_model_name,
-            "model_hash": self.generate.model_hash,
+            "model_weights": generate.model_name,
+            "model_hash": generate.model_hash,
             "app_id": APP_ID,
             "app_version": APP_VERSION,
         }
 
-    def generate_images(
-        self, generation_parameters, esrgan_parameters, facetool_parameters
+    def run_postprocessing(
+        self, job, generate, original_image, postprocessing_parameters
     ):
+        """
+        Runs a postprocessing job on a worker thread.
+        """
         try:
-            self.canceled.clear()
+            progress = Progress()
+
+            job.emit("progressUpdate", progress.to_formatted_dict())
+
+            original_image_path = self.get_image_path_from_url(
+                original_image["url"]
+            )
+
+            image = Image.open(original_image_path)
+
+            try:
+                seed = original_image["metadata"]["image"]["seed"]
+            except (KeyError) as e:
+                seed = "unknown_seed"
+                pass
+
+            if postprocessing_parameters["type"] == "esrgan":
+                progress.set_current_status("common:statusUpscalingESRGAN")
+            elif postprocessing_parameters["type"] == "gfpgan":
+                progress.set_current_status("common:statusRestoringFacesGFPGAN")
+            elif postprocessing_parameters["type"] == "codeformer":
+                progress.set_current_status("common:statusRestoringFacesCodeFormer")
+
+            job.emit("progressUpdate", progress.to_formatted_dict())
+
+            if postprocessing_parameters["type"] == "esrgan":
+                image = self.esrgan.process(
+                    image=image,
+                    upsampler_scale=postprocessing_parameters["upscale"][0],
+                    strength=postprocessing_parameters["upscale"][1],
+                    seed=seed,
+                )
+            elif postprocessing_parameters["type"] == "gfpgan":
+                image = self.gfpgan.process(
+                    image=image,
+                    strength=postprocessing_parameters["facetool_strength"],
+                    seed=seed,
+                )
+            elif postprocessing_parameters["type"] == "codeformer":
+                image = self.codeformer.process(
+                    image=image,
+                    strength=postprocessing_parameters["facetool_strength"],
+                    fidelity=postprocessing_parameters["codeformer_fidelity"],
+                    seed=seed,
+                    device="cpu"
+                    if str(generate.device) == "mps"
+                    else generate.device,
+                )
+            else:
+                raise TypeError(
+                    f'{postprocessing_parameters["type"]} is not a valid postprocessing type'
+                )
+
+            progress.set_current_status("common:statusSavingImage")
+            job.emit("progressUpdate", progress.to_formatted_dict())
+
+            postprocessing_parameters["seed"] = seed
+            metadata = self.parameters_to_post_processed_image_metadata(
+                parameters=postprocessing_parameters,
+                original_image_path=original_image_path,
+            )
+
+            command = parameters_to_command(postprocessing_parameters)
+
+            (width, height) = image.size
+
+            path = self.save_result_image(
+                image,
+                command,
+                metadata,
+                self.result_path,
+                postprocessing=postprocessing_parameters["type"],
+            )
 
-            step_index = 1
+            thumbnail_path = save_thumbnail(
+                image, os.path.basename(path), self.thumbnail_image_path
+            )
+
+            self.write_log_message(
+                f'[Postprocessed] "{original_image_path}" > "{path}": {postprocessing_parameters}'
+            )
+
+            progress.mark_complete()
+            job.emit("progressUpdate", progress.to_formatted_dict())
+
+            job.emit(
+                "postprocessingResult",
+                {
+                    "url": self.get_url_from_image_path(path),
+                    "thumbnail": self.get_url_from_image_path(thumbnail_path),
+                    "mtime": os.path.getmtime(path),
+                    "metadata": metadata,
+                    "dreamPrompt": command,
+                    "width": width,
+                    "height": height,
+                },
+            )
+        except Exception as e:
+            job.emit("error", {"message": (str(e))})
+            print("\n")
+
+            traceback.print_exc()
+            print("\n")
+
+    def generate_images(
+        self, job, generate, generation_parameters, esrgan_parameters, facetool_parameters
+    ):
+        """
+        Runs a generation job on a worker thread, with the worker's Generate instance.
+        """
+        try:
             prior_variations = (
                 generation_parameters["with_variations"]
                 if "with_variations" in generation_parameters
@@ -831,8 +935,7 @@ class InvokeAIWebServer:
 
             progress = Progress(generation_parameters=generation_parameters)
 
-            self.socketio.emit("progressUpdate", progress.to_formatted_dict())
-            eventlet.sleep(0)
+            job.emit("progressUpdate", progress.to_formatted_dict())
 
             """
             TODO:
@@ -935,11 +1038,29 @@ class InvokeAIWebServer:
                 init_img_path = self.get_image_path_from_url(init_img_url)
                 generation_parameters["init_img"] = Image.open(init_img_path).convert('RGB')
 
+            last_preview_time = 0.0
+
+            def emit_preview(image, scale=1, **extra):
+                # sent over the socket as a data URL; never written to disk
+                (width, height) = image.size
+                job.emit(
+                    "intermediateResult",
+                    {
+                        "url": image_to_dataURL(image, **extra),
+                        "isBase64": True,
+                        "mtime": 0,
+                        "width": width * scale,
+                        "height": height * scale,
+                        "generationMode": generation_parameters["generation_mode"],
+                        "boundingBox": original_bounding_box,
+                    },
+                )
+
             def image_progress(sample, step):
-                if self.canceled.is_set():
+                if job.canceled.is_set():
                     raise CanceledException
 
-                nonlocal step_index
+                nonlocal last_preview_time
                 nonlocal generation_parameters
                 nonlocal progress
 
@@ -956,68 +1077,31 @@ class InvokeAIWebServer:
                 )
                 progress.set_current_status_has_steps(True)
 
-                if (
-                    generation_parameters["progress_images"]
-                    and step % generation_parameters["save_intermediates"] == 0
-                    and step < generation_parameters["steps"] - 1
-                ):
-                    image = self.generate.sample_to_image(sample)
-                    metadata = self.parameters_to_generated_image_metadata(
-                        generation_parameters
-                    )
-                    command = parameters_to_command(generation_parameters)
-
-                    (width, height) = image.size
-
-                    path = self.save_result_image(
-                        image,
-                        command,
-                        metadata,
-                        self.intermediate_path,
-                        step_index=step_index,
-                        postprocessing=False,
-                    )
-
-                    step_index += 1
-                    self.socketio.emit(
-                        "intermediateResult",
-                        {
-                            "url": self.get_url_from_image_path(path),
-                            "mtime": os.path.getmtime(path),
-                            "metadata": metadata,
-                            "width": width,
-                            "height": height,
-                            "generationMode": generation_parameters["generation_mode"],
-                            "boundingBox": original_bounding_box,
-                        },
-                    )
-
-
-                if generation_parameters["progress_latents"]:
-                    image = self.generate.sample_to_lowres_estimated_image(sample)
-                    (width, height) = image.size
-                    width *= 8
-                    height *= 8
-                    img_base64 = image_to_dataURL(image)
-                    self.socketio.emit(
-                        "intermediateResult",
-                        {
-                            "url": img_base64,
-                            "isBase64": True,
-                            "mtime": 0,
-                            "metadata": {},
-                            "width": width,
-                            "height": height,
-                            "generationMode": generation_parameters["generation_mode"],
-                            "boundingBox": original_bounding_box,
-                        },
-                    )
+                # previews are skipped, before any decoding, when the last one was sent too recently
+                now = time.monotonic()
+                if now - last_preview_time >= PROGRESS_PREVIEW_INTERVAL:
+                    if (
+                        generation_parameters["progress_images"]
+                        and step % generation_parameters["save_intermediates"] == 0
+                        and step < generation_parameters["steps"] - 1
+                    ):
+                        last_preview_time = now
+                        emit_preview(
+                            generate.sample_to_image(sample).convert("RGB"),
+                            format="JPEG",
+                            quality=PROGRESS_PREVIEW_QUALITY,
+                        )
+                    elif generation_parameters["progress_latents"]:
+                        last_preview_time = now
+                        emit_preview(
+                            generate.sample_to_lowres_estimated_image(sample),
+                            scale=8,
+                        )
 
-                self.socketio.emit("progressUpdate", progress.to_formatted_dict())
-                eventlet.sleep(0)
+                job.emit("progressUpdate", progress.to_formatted_dict())
 
             def image_done(image, seed, first_seed, attention_maps_image=None):
-                if self.canceled.is_set():
+                if job.canceled.is_set():
                     raise CanceledException
 
                 nonlocal generation_parameters
@@ -1025,7 +1109,6 @@ class InvokeAIWebServer:
                 nonlocal facetool_parameters
                 nonlocal progress
 
-                step_index = 1
                 nonlocal prior_variations
 
                 """
@@ -1041,8 +1124,7 @@ class InvokeAIWebServer:
 
                 progress.set_current_status("common:statusGenerationComplete")
 
-                self.socketio.emit("progressUpdate", progress.to_formatted_dict())
-                eventlet.sleep(0)
+                job.emit("progressUpdate", progress.to_formatted_dict())
 
                 all_parameters = generation_parameters
                 postprocessing = False
@@ -1062,14 +1144,13 @@ class InvokeAIWebServer:
                 else:
                     all_parameters["seed"] = seed
 
-                if self.canceled.is_set():
+                if job.canceled.is_set():
                     raise CanceledException
 
                 if esrgan_parameters:
                     progress.set_current_status("common:statusUpscaling")
                     progress.set_current_status_has_steps(False)
-                    self.socketio.emit("progressUpdate", progress.to_formatted_dict())
-                    eventlet.sleep(0)
+                    job.emit("progressUpdate", progress.to_formatted_dict())
 
                     image = self.esrgan.process(
                         image=image,
@@ -1084,7 +1165,7 @@ class InvokeAIWebServer:
                         esrgan_parameters["strength"],
                     ]
 
-                if self.canceled.is_set():
+                if job.canceled.is_set():
                     raise CanceledException
 
                 if facetool_parameters:
@@ -1094,8 +1175,7 @@ class InvokeAIWebServer:
                         progress.set_current_status("common:statusRestoringFacesCodeFormer")
 
                     progress.set_current_status_has_steps(False)
-                    self.socketio.emit("progressUpdate", progress.to_formatted_dict())
-                    eventlet.sleep(0)
+                    job.emit("progressUpdate", progress.to_formatted_dict())
 
                     if facetool_parameters["type"] == "gfpgan":
                         image = self.gfpgan.process(
@@ -1110,8 +1190,8 @@ class InvokeAIWebServer:
                             fidelity=facetool_parameters["codeformer_fidelity"],
                             seed=seed,
                             device="cpu"
-                            if str(self.generate.device) == "mps"
-                            else self.generate.device,
+                            if str(generate.device) == "mps"
+                            else generate.device,
                         )
                         all_parameters["codeformer_fidelity"] = facetool_parameters[
                             "codeformer_fidelity"
@@ -1124,8 +1204,7 @@ class InvokeAIWebServer:
                     all_parameters["facetool_type"] = facetool_parameters["type"]
 
                 progress.set_current_status("common:statusSavingImage")
-                self.socketio.emit("progressUpdate", progress.to_formatted_dict())
-                eventlet.sleep(0)
+                job.emit("progressUpdate", progress.to_formatted_dict())
 
                 # restore the stashed URLS and discard the paths, we are about to send the result to client
                 all_parameters["init_img"] = (
@@ -1140,7 +1219,7 @@ class InvokeAIWebServer:
                 if generation_parameters["generation_mode"] == "unifiedCanvas":
                     all_parameters["bounding_box"] = original_bounding_box
 
-                metadata = self.parameters_to_generated_image_metadata(all_parameters)
+                metadata = self.parameters_to_generated_image_metadata(all_parameters, generate)
 
                 command = parameters_to_command(all_parameters)
 
@@ -1175,16 +1254,15 @@ class InvokeAIWebServer:
                 else:
                     progress.mark_complete()
 
-                self.socketio.emit("progressUpdate", progress.to_formatted_dict())
-                eventlet.sleep(0)
+                job.emit("progressUpdate", progress.to_formatted_dict())
 
                 parsed_prompt, _ = get_prompt_structure(generation_parameters["prompt"])
                 tokens = None if type(parsed_prompt) is Blend else \
-                    get_tokens_for_prompt(self.generate.model, parsed_prompt)
+                    get_tokens_for_prompt(generate.model, parsed_prompt)
                 attention_maps_image_base64_url = None if attention_maps_image is None \
                     else image_to_dataURL(attention_maps_image)
 
-                self.socketio.emit(
+                job.emit(
                     "generationResult",
                     {
                         "url": self.get_url_from_image_path(path),
@@ -1200,7 +1278,6 @@ class InvokeAIWebServer:
                         "tokens": tokens,
                     },
                 )
-                eventlet.sleep(0)
 
                 progress.set_current_iteration(progress.current_iteration + 1)
 
@@ -1213,30 +1290,30 @@ class InvokeAIWebServer:
                 else:
                     return image_progress(*cb_args, **kwargs)
 
-            self.generate.prompt2image(
+            generate.prompt2image(
                 **generation_parameters,
                 step_callback=diffusers_step_callback_adapter,
                 image_callback=image_done
             )
 
         except KeyboardInterrupt:
-            self.socketio.emit("processingCanceled")
+            job.emit("processingCanceled")
             raise
         except CanceledException:
-            self.socketio.emit("processingCanceled")
+            job.emit("processingCanceled")
             pass
         except Exception as e:
             print(e)
-            self.socketio.emit("error", {"message": (str(e))})
+            job.emit("error", {"message": (str(e))})
             print("\n")
 
             traceback.print_exc()
             print("\n")
 
-    def parameters_to_generated_image_metadata(self, parameters):
+    def parameters_to_generated_image_metadata(self, parameters, generate=None):
         try:
             # top-level metadata minus `image` or `images`
-            metadata = self.get_system_config()
+            metadata = self.get_system_config(generate)
             # remove any image keys not mentioned in RFC #266
             rfc266_img_fields = [
                 "type",
@@ -1402,6 +1479,10 @@ class InvokeAIWebServer:
         step_index=None,
         postprocessing=False,
     ):
+        """
+        Saves the image under a new unique name in output_dir and returns its
+        path.
+        """
         try:
             pngwriter = PngWriter(output_dir)
 
@@ -1432,14 +1513,16 @@ class InvokeAIWebServer:
                 name=filename,
             )
 
+            # only does anything for images that are saved to the gallery
+            self.gallery_index.add(
+                path, image=image, metadata=metadata, dream_prompt=command
+            )
+
             return os.path.abspath(path)
 
         except Exception as e:
-            self.socketio.emit("error", {"message": (str(e))})
-            print("\n")
-
-            traceback.print_exc()
-            print("\n")
+            print(f">> Could not save image to {output_dir}: {str(e)}")
+            raise
 
     def make_unique_init_image_filename(self, name):
         try:
@@ -1529,6 +1612,19 @@ class InvokeAIWebServer:
             traceback.print_exc()
             print("\n")
 
+    def get_gallery_image(self, entry, category):
+        """Given a gallery index entry, returns the image description used by the client"""
+        return {
+            "url": self.get_url_from_image_path(entry["path"]),
+            "thumbnail": self.get_url_from_image_path(entry["thumbnail"]),
+            "mtime": entry["mtime"],
+            "metadata": entry["metadata"],
+            "dreamPrompt": entry["dream_prompt"],
+            "width": entry["width"],
+            "height": entry["height"],
+            "category": category,
+        }
+
     def save_file_unique_uuid_name(self, bytes, name, path):
         try:
             uuid = uuid4().hex
@@ -1667,10 +1763,10 @@ def dataURL_to_image(dataURL: str) -> ImageType:
 Converts an image into a base64 image dataURL.
 """
 
-def image_to_dataURL(image: ImageType) -> str:
+def image_to_dataURL(image: ImageType, format: str = "PNG", **save_args) -> str:
     buffered = io.BytesIO()
-    image.save(buffered, format="PNG")
-    image_base64 = "data:image/png;base64," + base64.b64encode(
+    image.save(buffered, format=format, **save_args)
+    image_base64 = f"data:image/{format.lower()};base64," + base64.b64encode(
         buffered.getvalue()
     ).decode("UTF-8")
     return image_base64
@@ -0,0 +1,269 @@
+"""
+An SQLite index of the images shown in the web UI gallery.
+
+Listing the gallery used to glob the whole output directory, stat every
+file several times and open each returned image to read its size and PNG
+metadata. The index keeps the path, mtime, dimensions, thumbnail path and
+parsed metadata of every gallery image, so that paging through the gallery
+is a range query on (category, mtime).
+
+The index is updated as the server saves and deletes images. Files written
+by other processes (e.g. the CLI writing to the same output directory) are
+picked up by reconcile(), which rescans a directory only when its mtime has
+changed since the last scan. The server's own saves and deletes record the
+directory's new mtime, so they do not cause a rescan; a file written by
+another process at the same moment is then picked up at the next change to
+the directory. For the same reason the database must not live in one of the
+indexed directories: writing its journal would change their mtime after
+every save. gallery_db_path() gives its default location.
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+from contextlib import closing
+from typing import Callable, Optional
+
+from PIL import Image
+from PIL.Image import Image as ImageType
+
+from ldm.invoke.globals import global_database_dir
+from ldm.invoke.pngwriter import retrieve_metadata
+
+GALLERY_EXTENSIONS = (".png", ".jpg", ".jpeg")
+
+
+def gallery_db_path(result_path: str) -> str:
+    """
+    Return the location of the gallery index of the output directory
+    result_path, in the InvokeAI databases directory.
+    """
+    digest = hashlib.sha256(os.path.abspath(result_path).encode("utf-8")).hexdigest()
+    return os.path.join(global_database_dir(), f"gallery-{digest[:16]}.db")
+
+
+class GalleryIndex:
+    def __init__(
+        self,
+        db_path: str,
+        directories: dict[str, str],
+        make_thumbnail: Callable[[ImageType, str], str],
+    ):
+        """
+        :param db_path: location of the SQLite database
+        :param directories: maps each gallery category to the directory holding its images
+        :param make_thumbnail: called with a PIL image and its file name, returns the thumbnail path
+        """
+        self.db_path = db_path
+        self.directories = {
+            category: os.path.abspath(path) for category, path in directories.items()
+        }
+        if os.path.dirname(os.path.abspath(db_path)) in self.directories.values():
+            raise ValueError(
+                f"The gallery index {db_path} can't be stored in a gallery directory"
+            )
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        self.make_thumbnail = make_thumbnail
+        self.scanned_mtimes = {}
+        self.lock = threading.Lock()
+
+        with self.lock, closing(self._connect()) as conn, conn:
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS images (
+                    path TEXT PRIMARY KEY,
+                    category TEXT NOT NULL,
+                    mtime REAL NOT NULL,
+                    width INTEGER,
+                    height INTEGER,
+                    thumbnail TEXT,
+                    metadata TEXT,
+                    dream_prompt TEXT
+                )"""
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS images_by_mtime ON images (category, mtime)"
+            )
+
+    def add(
+        self,
+        path: str,
+        image: Optional[ImageType] = None,
+        metadata: Optional[dict] = None,
+        dream_prompt: Optional[str] = None,
+    ) -> Optional[dict]:
+        """
+        Index the image at path, which must be in one of the gallery directories.
+        The image and its metadata are read from the file unless they are passed
+        in. Returns the indexed entry, or None if path is not a gallery image.
+        """
+        path = os.path.abspath(path)
+        category = self._category_for(path)
+        if category is None:
+            return None
+
+        if metadata is None:
+            if os.path.splitext(path)[1] == ".png":
+                all_metadata = retrieve_metadata(path)
+                metadata = all_metadata["sd-metadata"]
+                dream_prompt = all_metadata["Dream"]
+            else:
+                metadata = {}
+
+        if image is None:
+            with Image.open(path) as image:
+                image.load()
+                width, height = image.size
+                thumbnail = self.make_thumbnail(image, os.path.basename(path))
+        else:
+            width, height = image.size
+            thumbnail = self.make_thumbnail(image, os.path.basename(path))
+
+        entry = {
+            "path": path,
+            "category": category,
+            "mtime": os.path.getmtime(path),
+            "width": width,
+            "height": height,
+            "thumbnail": thumbnail,
+            "metadata": metadata,
+            "dream_prompt": dream_prompt,
+        }
+        with self.lock, closing(self._connect()) as conn, conn:
+            self._insert(conn, entry)
+            self._record_own_change(category)
+        return entry
+
+    def remove(self, path: str) -> None:
+        path = os.path.abspath(path)
+        with self.lock, closing(self._connect()) as conn, conn:
+            conn.execute("DELETE FROM images WHERE path=?", (path,))
+            category = self._category_for(path)
+            if category is not None:
+                self._record_own_change(category)
+
+    def images(
+        self,
+        category: str,
+        before_mtime: Optional[float] = None,
+        after_mtime: Optional[float] = None,
+        limit: Optional[int] = None,
+    ) -> list[dict]:
+        """
+        Return the indexed images of a category, newest first, optionally
+        restricted to mtimes strictly before and/or after the given ones.
+        """
+        query = "SELECT path, category, mtime, width, height, thumbnail, metadata, dream_prompt FROM images WHERE category=?"
+        params = [category]
+        if before_mtime:
+            query += " AND mtime < ?"
+            params.append(before_mtime)
+        if after_mtime is not None:
+            query += " AND mtime > ?"
+            params.append(after_mtime)
+        query += " ORDER BY mtime DESC"
+        if limit is not None:
+            query += " LIMIT ?"
+            params.append(limit)
+
+        with self.lock, closing(self._connect()) as conn:
+            rows = conn.execute(query, params).fetchall()
+
+        return [
+            {
+                "path": path,
+                "category": category,
+                "mtime": mtime,
+                "width": width,
+                "height": height,
+                "thumbnail": thumbnail,
+                "metadata": json.loads(metadata) if metadata else {},
+                "dream_prompt": dream_prompt,
+            }
+            for path, category, mtime, width, height, thumbnail, metadata, dream_prompt in rows
+        ]
+
+    def reconcile(self, category: Optional[str] = None, force: bool = False) -> None:
+        """
+        Bring the index in line with the gallery directories: index new or
+        modified images and drop entries whose files are gone. A directory
+        is only rescanned if its mtime changed since the last scan, or if
+        force is True.
+        """
+        categories = [category] if category else list(self.directories)
+        for category in categories:
+            directory = self.directories[category]
+            try:
+                dir_mtime = os.stat(directory).st_mtime_ns
+            except FileNotFoundError:
+                continue
+            if not force and self.scanned_mtimes.get(category) == dir_mtime:
+                continue
+
+            on_disk = {}
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if entry.is_file() and entry.name.lower().endswith(GALLERY_EXTENSIONS):
+                        on_disk[os.path.abspath(entry.path)] = entry.stat().st_mtime
+
+            with self.lock, closing(self._connect()) as conn:
+                indexed = dict(
+                    conn.execute(
+                        "SELECT path, mtime FROM images WHERE category=?", (category,)
+                    ).fetchall()
+                )
+
+            gone = [path for path in indexed if path not in on_disk]
+            if gone:
+                with self.lock, closing(self._connect()) as conn, conn:
+                    conn.executemany(
+                        "DELETE FROM images WHERE path=?", [(path,) for path in gone]
+                    )
+
+            changed = [
+                path for path, mtime in on_disk.items() if indexed.get(path) != mtime
+            ]
+            if len(changed) > 100:
+                print(f">> Indexing {len(changed)} gallery images in {directory}")
+            for path in changed:
+                try:
+                    self.add(path)
+                except Exception as e:
+                    print(f">> Unable to index {path}: {str(e)}")
+
+            self.scanned_mtimes[category] = dir_mtime
+
+    def _record_own_change(self, category: str) -> None:
+        # only once the directory has been scanned, so that a pending first scan is not skipped
+        if category not in self.scanned_mtimes:
+            return
+        try:
+            self.scanned_mtimes[category] = os.stat(self.directories[category]).st_mtime_ns
+        except FileNotFoundError:
+            pass
+
+    def _category_for(self, path: str) -> Optional[str]:
+        directory = os.path.dirname(path)
+        for category, category_dir in self.directories.items():
+            if directory == category_dir:
+                return category
+        return None
+
+    def _insert(self, conn: sqlite3.Connection, entry: dict) -> None:
+        conn.execute(
+            "INSERT OR REPLACE INTO images (path, category, mtime, width, height, thumbnail, metadata, dream_prompt) VALUES (?,?,?,?,?,?,?,?)",
+            (
+                entry["path"],
+                entry["category"],
+                entry["mtime"],
+                entry["width"],
+                entry["height"],
+                entry["thumbnail"],
+                json.dumps(entry["metadata"]),
+                entry["dream_prompt"],
+            ),
+        )
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.db_path, timeout=30)
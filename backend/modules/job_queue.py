@@ -0,0 +1,208 @@
+"""
+A queue of the jobs (generations, postprocessing, model changes) submitted
+by web UI clients, and the pool of worker threads that runs them.
+
+Jobs used to run inline in the socket.io handlers, on the server's event
+loop, so one client's generation held up every other client's requests.
+Now the handlers only submit jobs. Each worker thread owns its own
+Generate instance and takes the next job off the queue as soon as it is
+free: the highest priority first, and between jobs of the same priority,
+the session that was served least recently, so that one client queueing
+many jobs cannot starve the others.
+
+Workers never talk to socket.io themselves. Job.emit() puts events on a
+thread-safe queue, which the server drains on its event loop and sends to
+the session that submitted the job.
+"""
+
+import itertools
+import queue
+import threading
+import time
+import traceback
+from typing import Any, Callable, Optional
+from uuid import uuid4
+
+PRIORITY_NORMAL = 0
+PRIORITY_HIGH = 10  # short interactive jobs, e.g. postprocessing and model changes
+MAX_CLIENT_PRIORITY = 2  # clients may ask for priorities within +/- this of PRIORITY_NORMAL
+
+
+def client_priority(value: Any) -> int:
+    """
+    Returns the priority to give a job whose priority was chosen by a client:
+    value as an int, clamped to within MAX_CLIENT_PRIORITY of PRIORITY_NORMAL,
+    or PRIORITY_NORMAL if it is not a number.
+    """
+    try:
+        priority = int(value)
+    except (TypeError, ValueError, OverflowError):
+        return PRIORITY_NORMAL
+    return min(
+        max(priority, PRIORITY_NORMAL - MAX_CLIENT_PRIORITY),
+        PRIORITY_NORMAL + MAX_CLIENT_PRIORITY,
+    )
+
+
+class Job:
+    def __init__(
+        self,
+        session_id: Optional[str],
+        kind: str,
+        run: Callable[["Job", "Worker"], None],
+        priority: int = PRIORITY_NORMAL,
+    ):
+        """
+        :param session_id: socket.io session the job's events are sent to (None to broadcast)
+        :param kind: what the job does, e.g. "generation"; only used for reporting
+        :param run: called on a worker thread with the job and the worker
+        :param priority: jobs with a higher priority are started first
+        """
+        self.id = uuid4().hex
+        self.session_id = session_id
+        self.kind = kind
+        self.run = run
+        self.priority = priority
+        self.submitted = time.monotonic()
+        self.canceled = threading.Event()
+        self.events: Optional[queue.Queue] = None  # set when submitted
+
+    def emit(self, event: str, data: Any = None) -> None:
+        """
+        Send a socket.io event to the session that submitted the job.
+        Can be called from any thread.
+        """
+        self.events.put((event, data, self.session_id))
+
+    def broadcast(self, event: str, data: Any = None) -> None:
+        """
+        Send a socket.io event to every client. Can be called from any thread.
+        """
+        self.events.put((event, data, None))
+
+
+class JobQueue:
+    def __init__(self):
+        self.events = queue.Queue()
+        self.pending: dict[Optional[str], list[Job]] = {}
+        self.running: dict[str, Job] = {}
+        self.last_served: dict[Optional[str], int] = {}
+        self.serial = itertools.count()
+        self.lock = threading.Condition()
+
+    def submit(self, job: Job) -> int:
+        """
+        Queue a job. Returns the number of jobs queued ahead of it.
+        """
+        job.events = self.events
+        with self.lock:
+            self.pending.setdefault(job.session_id, []).append(job)
+            ahead = sum(
+                1
+                for jobs in self.pending.values()
+                for other in jobs
+                if other is not job and other.priority >= job.priority
+            )
+            self.lock.notify()
+        return ahead
+
+    def next_job(self, timeout: Optional[float] = None) -> Optional[Job]:
+        """
+        Wait for a job and take it off the queue. Returns None if no job
+        arrived within timeout seconds.
+        """
+        with self.lock:
+            if not self.lock.wait_for(self._has_pending, timeout):
+                return None
+            priority = max(
+                job.priority for jobs in self.pending.values() for job in jobs
+            )
+            session_id = min(
+                (
+                    session_id
+                    for session_id, jobs in self.pending.items()
+                    if any(job.priority == priority for job in jobs)
+                ),
+                key=lambda session_id: self.last_served.get(session_id, -1),
+            )
+            jobs = self.pending[session_id]
+            job = next(job for job in jobs if job.priority == priority)
+            jobs.remove(job)
+            if not jobs:
+                del self.pending[session_id]
+            self.last_served[session_id] = next(self.serial)
+            self.running[job.id] = job
+            return job
+
+    def finished(self, job: Job) -> None:
+        with self.lock:
+            self.running.pop(job.id, None)
+
+    def cancel(
+        self, job_id: Optional[str] = None, session_id: Optional[str] = None
+    ) -> list[Job]:
+        """
+        Cancel the job with job_id, or else every job of session_id. Queued
+        jobs are dropped; running jobs have their canceled event set and stop
+        at their next step. Returns the canceled jobs.
+        """
+        canceled = []
+        with self.lock:
+            for jobs_session_id, jobs in list(self.pending.items()):
+                for job in list(jobs):
+                    if job.id == job_id or (job_id is None and job.session_id == session_id):
+                        jobs.remove(job)
+                        canceled.append(job)
+                if not jobs:
+                    del self.pending[jobs_session_id]
+            for job in self.running.values():
+                if job.id == job_id or (job_id is None and job.session_id == session_id):
+                    canceled.append(job)
+        for job in canceled:
+            job.canceled.set()
+        return canceled
+
+    def forget_session(self, session_id: str) -> None:
+        """
+        Cancel the jobs of a client that has disconnected.
+        """
+        self.cancel(session_id=session_id)
+        with self.lock:
+            self.last_served.pop(session_id, None)
+
+    def _has_pending(self) -> bool:
+        return bool(self.pending)
+
+
+class Worker(threading.Thread):
+    def __init__(self, job_queue: JobQueue, index: int, generate_factory: Callable):
+        """
+        :param job_queue: where the worker takes its jobs from
+        :param index: number of the worker, for reporting
+        :param generate_factory: makes the Generate instance the worker owns,
+            called on first use
+        """
+        super().__init__(name=f"generation_worker_{index}", daemon=True)
+        self.job_queue = job_queue
+        self.index = index
+        self.generate_factory = generate_factory
+        self._generate = None
+
+    @property
+    def generate(self):
+        if self._generate is None:
+            self._generate = self.generate_factory()
+        return self._generate
+
+    def run(self) -> None:
+        while True:
+            job = self.job_queue.next_job()
+            try:
+                if not job.canceled.is_set():
+                    job.run(job, self)
+            except Exception as e:
+                print(f">> Worker {self.index}: {job.kind} job {job.id} failed")
+                traceback.print_exc()
+                job.emit("error", {"message": str(e)})
+            finally:
+                self.job_queue.finished(job)
@@ -117,6 +117,10 @@ gr = Generate(
           model:str         = symbolic name of the model in the configuration file
           precision:float   = float precision to be used
           safety_checker:bool = activate safety checker [False]
+          max_cache_size:float = GB of system RAM to use for caching models that are not in use [no limit]
+          max_vram_cache_size:float = GB of VRAM to use for keeping recently-used models on the GPU [0]
+          max_batch_size:int = denoise up to this many seeds of a multi-iteration request together,
+                               limited by available memory [1]
 
           # this value is sticky and maintained between generation calls
           sampler_name:str  = ['ddim', 'k_dpm_2_a', 'k_dpm_2', 'k_dpmpp_2', 'k_dpmpp_2_a', 'k_euler_a', 'k_euler', 'k_heun', 'k_lms', 'plms']  // k_lms
@@ -149,6 +153,9 @@ class Generate:
             free_gpu_mem: bool=False,
             safety_checker:bool=False,
             max_loaded_models:int=2,
+            max_cache_size:float=None,
+            max_vram_cache_size:float=0,
+            max_batch_size:int=1,
             # these are deprecated; if present they override values in the conf file
             weights = None,
             config = None,
@@ -181,6 +188,7 @@ class Generate:
         self.esrgan = esrgan
         self.free_gpu_mem = free_gpu_mem
         self.max_loaded_models = max_loaded_models,
+        self.max_batch_size = max_batch_size
         self.size_matters = True  # used to warn once about large image sizes and VRAM
         self.txt2mask = None
         self.safety_checker = None
@@ -204,7 +212,10 @@ class Generate:
         Globals.full_precision = self.precision=='float32'
 
         # model caching system for fast switching
-        self.model_manager = ModelManager(mconfig,self.device,self.precision,max_loaded_models=max_loaded_models)
+        self.model_manager = ModelManager(mconfig,self.device,self.precision,
+                                          max_loaded_models=max_loaded_models,
+                                          max_cache_size=max_cache_size,
+                                          max_vram_cache_size=max_vram_cache_size)
         # don't accept invalid models
         fallback = self.model_manager.default_model() or FALLBACK_MODEL_NAME
         model = model or fallback
@@ -476,7 +487,8 @@ class Generate:
             uc, c, extra_conditioning_info = get_uc_and_c_and_ec(
                 prompt, model =self.model,
                 skip_normalize_legacy_blend=skip_normalize,
-                log_tokens    =self.log_tokenization
+                log_tokens    =self.log_tokenization,
+                model_hash    =self.model_hash,
             )
 
             init_image, mask_image = self._make_images(
@@ -539,6 +551,7 @@ class Generate:
                 inpaint_width = inpaint_width,
                 enable_image_debugging = enable_image_debugging,
                 free_gpu_mem=self.free_gpu_mem,
+                max_batch_size=self.max_batch_size,
             )
 
             if init_color:
@@ -629,7 +642,8 @@ class Generate:
         uc, c, extra_conditioning_info = get_uc_and_c_and_ec(
             prompt, model=self.model,
             skip_normalize_legacy_blend=opt.skip_normalize,
-            log_tokens=ldm.invoke.conditioning.log_tokenization
+            log_tokens=ldm.invoke.conditioning.log_tokenization,
+            model_hash=self.model_hash,
         )
 
         if tool in ('gfpgan','codeformer','upscale'):
@@ -694,6 +708,7 @@ class Generate:
                 embiggen_tiles = opt.embiggen_tiles,
                 embiggen_strength = opt.embiggen_strength,
                 image_callback = callback,
+                max_batch_size = self.max_batch_size,
             )
         elif tool == 'outpaint':
             from ldm.invoke.restoration.outpaint import Outpaint
@@ -871,11 +886,8 @@ class Generate:
 
         seed_everything(random.randrange(0, np.iinfo(np.uint32).max))
         if self.embedding_path is not None:
-            for root, _, files in os.walk(self.embedding_path):
-                for name in files:
-                    ti_path = os.path.join(root, name)
-                    self.model.textual_inversion_manager.load_textual_inversion(ti_path,
-                                                                                defer_injecting_tokens=True)
+            self.model.textual_inversion_manager.load_textual_inversions(self.embedding_path,
+                                                                         defer_injecting_tokens=True)
             print(f'>> Textual inversions available: {", ".join(self.model.textual_inversion_manager.get_all_trigger_strings())}')
 
         self.model_name = model_name
@@ -922,7 +934,24 @@ class Generate:
                                 prefix = None,
     ):
 
-        for r in image_list:
+        # CodeFormer restores the faces of all the images in one go
+        restored_images = None
+        if strength > 0 and facetool == 'codeformer' and self.codeformer is not None:
+            cf_device = 'cpu' if str(self.device) == 'mps' else self.device
+            try:
+                restored_images = self.codeformer.process_batch(
+                    images   = [image for image, _ in image_list],
+                    strength = strength,
+                    device   = cf_device,
+                    seeds    = [seed for _, seed in image_list],
+                    fidelity = codeformer_fidelity,
+                )
+            except Exception as e:
+                print(
+                    f'>> Error running CodeFormer. Faces were not restored.\n{e}'
+                )
+
+        for i, r in enumerate(image_list):
             image, seed = r
             try:
                 if strength > 0:
@@ -935,9 +964,8 @@ class Generate:
                         if facetool == 'codeformer':
                             if self.codeformer is None:
                                 print('>> CodeFormer not found. Face restoration is disabled.')
-                            else:
-                                cf_device = 'cpu' if str(self.device) == 'mps' else self.device
-                                image = self.codeformer.process(image=image, strength=strength, device=cf_device, seed=seed, fidelity=codeformer_fidelity)
+                            elif restored_images is not None:
+                                image = restored_images[i]
                     else:
                         print(">> Face Restoration is disabled.")
                 if upscale is not None:
@@ -9,7 +9,7 @@ from ldm.generate import Generate
 from ldm.invoke.prompt_parser import PromptParser
 from ldm.invoke.readline import get_completer, Completer
 from ldm.invoke.args import Args, metadata_dumps, metadata_from_png, dream_cmd_from_png
-from ldm.invoke.pngwriter import PngWriter, retrieve_metadata, write_metadata
+from ldm.invoke.pngwriter import PngWriter, BackgroundImageWriter, retrieve_metadata, write_metadata
 from ldm.invoke.image_util import make_grid
 from ldm.invoke.log import write_log
 from ldm.invoke.model_manager import ModelManager
@@ -40,12 +40,17 @@ def main():
         if args.max_loaded_models <= 0:
             print('--max_loaded_models must be >= 1; using 1')
             args.max_loaded_models = 1
+    if args.max_batch_size <= 0:
+        print('--max_batch_size must be >= 1; using 1')
+        args.max_batch_size = 1
 
     # alert - setting a global here
     Globals.try_patchmatch = args.patchmatch
     Globals.always_use_cpu = args.always_use_cpu
     Globals.internet_available = args.internet_available and check_internet()
     Globals.disable_xformers = not args.xformers
+    Globals.vae_tile_size = args.vae_tile_size
+    Globals.vae_tiling_threshold = args.vae_tiling_threshold
     print(f'>> Internet connectivity is {Globals.internet_available}')
 
     if not args.conf:
@@ -98,21 +103,25 @@ def main():
             sys.exit(-1)
 
     # creating a Generate object:
+    generate_args = dict(
+        conf = opt.conf,
+        model = opt.model,
+        sampler_name = opt.sampler_name,
+        embedding_path = embedding_path,
+        full_precision = opt.full_precision,
+        precision = opt.precision,
+        gfpgan=gfpgan,
+        codeformer=codeformer,
+        esrgan=esrgan,
+        free_gpu_mem=opt.free_gpu_mem,
+        safety_checker=opt.safety_checker,
+        max_loaded_models=opt.max_loaded_models,
+        max_cache_size=opt.max_cache_size,
+        max_vram_cache_size=opt.max_vram_cache_size,
+        max_batch_size=opt.max_batch_size,
+    )
     try:
-        gen = Generate(
-            conf = opt.conf,
-            model = opt.model,
-            sampler_name = opt.sampler_name,
-            embedding_path = embedding_path,
-            full_precision = opt.full_precision,
-            precision = opt.precision,
-            gfpgan=gfpgan,
-            codeformer=codeformer,
-            esrgan=esrgan,
-            free_gpu_mem=opt.free_gpu_mem,
-            safety_checker=opt.safety_checker,
-            max_loaded_models=opt.max_loaded_models,
-            )
+        gen = Generate(**generate_args)
     except (FileNotFoundError, TypeError, AssertionError) as e:
         report_model_error(opt,e)
     except (IOError, KeyError) as e:
@@ -140,7 +149,9 @@ def main():
 
     # web server loops forever
     if opt.web or opt.gui:
-        invoke_ai_web_server_loop(gen, gfpgan, codeformer, esrgan)
+        # further web workers each get a Generate of their own
+        invoke_ai_web_server_loop(gen, gfpgan, codeformer, esrgan,
+                                  generate_factory=lambda: Generate(**generate_args))
         sys.exit(0)
 
     if not infile:
@@ -174,6 +185,9 @@ def main_loop(gen, opt):
         add_embedding_terms(gen, completer)
     output_cntr = completer.get_current_history_length()+1
 
+    # PNG encoding and writing happen on these threads while generation continues
+    background_writer = BackgroundImageWriter()
+
     # os.pathconf is not available on Windows
     if hasattr(os, 'pathconf'):
         path_max = os.pathconf(opt.outdir, 'PC_PATH_MAX')
@@ -296,12 +310,12 @@ def main_loop(gen, opt):
         # Here is where the images are actually generated!
         last_results = []
         try:
-            file_writer      = PngWriter(current_outdir)
+            file_writer      = PngWriter(current_outdir, background=background_writer)
             results          = []  # list of filename, prompt pairs
             grid_images      = dict()  # seed -> Image, only used if `opt.grid`
             prior_variations = opt.with_variations or []
             prefix = file_writer.unique_prefix()
-            step_callback = make_step_callback(gen, opt, prefix) if opt.save_intermediates > 0 else None
+            step_callback = make_step_callback(gen, opt, prefix, background_writer) if opt.save_intermediates > 0 else None
 
             def image_writer(image, seed, upscaled=False, first_seed=None, use_prefix=None, prompt_in=None, attention_maps_image=None):
                 # note the seed is the seed of the current image
@@ -319,7 +333,7 @@ def main_loop(gen, opt):
                     tm = opt.text_mask[0]
                     th = opt.text_mask[1] if len(opt.text_mask)>1 else 0.5
                     formatted_dream_prompt = f'!mask {opt.input_file_path} -tm {tm} {th}'
-                    path = file_writer.save_image_and_prompt_to_png(
+                    path = file_writer.submit_image_and_prompt_to_png(
                         image           = image,
                         dream_prompt    = formatted_dream_prompt,
                         metadata        = {},
@@ -342,7 +356,7 @@ def main_loop(gen, opt):
                         postprocessed,
                         first_seed
                     )
-                    path = file_writer.save_image_and_prompt_to_png(
+                    path = file_writer.submit_image_and_prompt_to_png(
                         image           = image,
                         dream_prompt    = formatted_dream_prompt,
                         metadata        = metadata_dumps(
@@ -357,6 +371,7 @@ def main_loop(gen, opt):
                     # update rfc metadata
                     if operation == 'postprocess':
                         tool = re.match('postprocess:(\w+)',opt.last_operation).groups()[0]
+                        file_writer.wait()  # the metadata is rewritten in place
                         add_postprocessing_to_metadata(
                             opt,
                             opt.input_file_path,
@@ -408,7 +423,7 @@ def main_loop(gen, opt):
                     seeds      = grid_seeds,
                     model_hash = gen.model_hash
                     )
-                path = file_writer.save_image_and_prompt_to_png(
+                path = file_writer.submit_image_and_prompt_to_png(
                     image        = grid_img,
                     dream_prompt = formatted_dream_prompt,
                     metadata     = metadata,
@@ -416,6 +431,9 @@ def main_loop(gen, opt):
                 )
                 results = [[path, formatted_dream_prompt]]
 
+            # make sure everything is on disk before the results are reported
+            file_writer.wait()
+
         except AssertionError as e:
             print(e)
             continue
@@ -429,7 +447,7 @@ def main_loop(gen, opt):
         output_cntr = write_log(results, log_path ,('txt', 'md'), output_cntr)
         print()
 
-
+    background_writer.shutdown()
     print(f'\nGoodbye!\nYou can start InvokeAI again by running the "invoke.bat" (or "invoke.sh") script from {Globals.root}')
 
 # TO DO: remove repetitive code and the awkward command.replace() trope
@@ -953,7 +971,7 @@ def get_next_command(infile=None, model_name='no model') -> str:  # command stri
             print(f'#{command}')
     return command
 
-def invoke_ai_web_server_loop(gen: Generate, gfpgan, codeformer, esrgan):
+def invoke_ai_web_server_loop(gen: Generate, gfpgan, codeformer, esrgan, generate_factory=None):
     print('\n* --web was specified, starting web server...')
     from backend.invoke_ai_web_server import InvokeAIWebServer
     # Change working directory to the stable-diffusion directory
@@ -961,7 +979,8 @@ def invoke_ai_web_server_loop(gen: Generate, gfpgan, codeformer, esrgan):
         os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
     )
 
-    invoke_ai_web_server = InvokeAIWebServer(generate=gen, gfpgan=gfpgan, codeformer=codeformer, esrgan=esrgan)
+    invoke_ai_web_server = InvokeAIWebServer(generate=gen, gfpgan=gfpgan, codeformer=codeformer, esrgan=esrgan,
+                                             generate_factory=generate_factory)
 
     try:
         invoke_ai_web_server.run()
@@ -1012,7 +1031,7 @@ def load_face_restoration(opt):
             else:
                 print('>> Face restoration disabled')
             if opt.esrgan:
-                esrgan = restoration.load_esrgan(opt.esrgan_bg_tile)
+                esrgan = restoration.load_esrgan(opt.esrgan_bg_tile, opt.esrgan_tile_workers)
             else:
                 print('>> Upscaling disabled')
         else:
@@ -1022,7 +1041,7 @@ def load_face_restoration(opt):
         print('>> You may need to install the ESRGAN and/or GFPGAN modules')
     return gfpgan,codeformer,esrgan
 
-def make_step_callback(gen, opt, prefix):
+def make_step_callback(gen, opt, prefix, background_writer):
     destination = os.path.join(opt.outdir,'intermediates',prefix)
     os.makedirs(destination,exist_ok=True)
     print(f'>> Intermediate images will be written into {destination}')
@@ -1030,7 +1049,7 @@ def make_step_callback(gen, opt, prefix):
         if step % opt.save_intermediates == 0 or step == opt.steps-1:
             filename = os.path.join(destination,f'{step:04}.png')
             image = gen.sample_to_image(img)
-            image.save(filename,'PNG')
+            background_writer.save_image(image, filename)
     return callback
 
 def retrieve_dream_command(opt,command,completer):
@@ -476,6 +476,27 @@ class Args(object):
             default=2,
             help='Maximum number of models to keep in memory for fast switching, including the one in GPU',
         )
+        model_group.add_argument(
+            '--max_cache_size',
+            dest='max_cache_size',
+            type=float,
+            default=None,
+            help='Maximum amount of system RAM (in GB) to use for caching models that are not in use. Least recently used models are purged first. Default is no limit beyond --max_loaded_models',
+        )
+        model_group.add_argument(
+            '--max_vram_cache_size',
+            dest='max_vram_cache_size',
+            type=float,
+            default=0,
+            help='Amount of VRAM (in GB) to use for keeping recently used models on the GPU, in addition to the active model. Default is 0 (offload inactive models to system RAM)',
+        )
+        model_group.add_argument(
+            '--max_batch_size',
+            dest='max_batch_size',
+            type=int,
+            default=1,
+            help='Maximum number of images of a multi-iteration (-n) request to generate together in one batch. The actual batch size is further limited by available memory.',
+        )
         model_group.add_argument(
             '--free_gpu_mem',
             dest='free_gpu_mem',
@@ -488,6 +509,18 @@ class Args(object):
             default=True,
             help='Enable/disable xformers support (default enabled if installed)',
         )
+        model_group.add_argument(
+            '--vae_tile_size',
+            type=int,
+            default=512,
+            help='Encode and decode large images in overlapping tiles of this many pixels to bound memory use. 0 disables tiling. Default: 512.',
+        )
+        model_group.add_argument(
+            '--vae_tiling_threshold',
+            type=float,
+            default=2.0,
+            help='Size in megapixels above which images are encoded and decoded in tiles. Default: 2.0.',
+        )
         model_group.add_argument(
             "--always_use_cpu",
             dest="always_use_cpu",
@@ -656,6 +689,12 @@ class Args(object):
             default=400,
             help='Tile size for background sampler, 0 for no tile during testing. Default: 400.',
         )
+        postprocessing_group.add_argument(
+            '--esrgan_tile_workers',
+            type=int,
+            default=1,
+            help='Number of threads that upscale ESRGAN tiles in parallel when running on the CPU. Default: 1.',
+        )
         postprocessing_group.add_argument(
             '--gfpgan_model_path',
             type=str,
@@ -709,6 +748,12 @@ class Args(object):
             default=None,
             help='Web server: Path to private key file to use for SSL. Use together with --certfile'
         )
+        web_server_group.add_argument(
+            '--web_workers',
+            type=int,
+            default=1,
+            help='Web server: Number of jobs to run at the same time. Each worker loads its own copy of the models. Default: 1.'
+        )
         web_server_group.add_argument(
             '--gui',
             dest='gui',
@@ -3,14 +3,134 @@ Query and install embeddings from the HuggingFace SD Concepts Library
 at https://huggingface.co/sd-concepts-library.
 
 The interface is through the Concepts() object.
+
+The names of the concepts in the library, and the trigger phrases of the
+concepts that have been used, are kept in a ConceptCatalog database so
+that prompts can be processed without waiting for the network. The list
+of concepts is refreshed in the background once it is older than
+CONCEPT_CATALOG_TTL.
 """
 import os
 import re
+import sqlite3
+import threading
+import time
 import traceback
-from typing import Callable
+from contextlib import closing
+from pathlib import Path
+from typing import Callable, Optional, Union
 from urllib import request, error as ul_error
 from huggingface_hub import HfFolder, hf_hub_url, ModelSearchArguments, ModelFilter, HfApi
-from ldm.invoke.globals import Globals
+from ldm.invoke.globals import Globals, global_database_dir
+
+CONCEPT_CATALOG_TTL = 24 * 60 * 60    # seconds before the list of concepts is fetched again
+CONCEPT_CATALOG_RETRY = 10 * 60       # seconds before a failed fetch is retried
+
+class ConceptCatalog(object):
+    def __init__(self, db_path:Union[str,Path]=None, ttl:float=CONCEPT_CATALOG_TTL):
+        '''
+        Open (creating if necessary) the concept catalog stored at db_path,
+        which defaults to concepts.db in the InvokeAI databases directory.
+        '''
+        self.db_path = Path(db_path or global_database_dir() / 'concepts.db')
+        self.ttl = ttl
+        self.names = None             # names of the concepts in the HuggingFace library
+        self.fetched_at = 0           # time.time() of the last successful fetch
+        self.failed_at = None         # time.monotonic() of the last failed fetch
+        self.triggers = dict()        # concept name to trigger phrase
+        self.trigger_concepts = dict() # trigger phrase to concept name
+        self._lock = threading.Lock()
+        self._refresh_thread = None
+        self._writable = True
+        try:
+            self.db_path.parent.mkdir(parents=True, exist_ok=True)
+            with closing(self._connect()) as conn, conn:
+                conn.execute('CREATE TABLE IF NOT EXISTS concepts (name TEXT PRIMARY KEY)')
+                conn.execute('CREATE TABLE IF NOT EXISTS catalog (key TEXT PRIMARY KEY, value)')
+                conn.execute('CREATE TABLE IF NOT EXISTS triggers (concept TEXT PRIMARY KEY, trigger TEXT NOT NULL)')
+                row = conn.execute("SELECT value FROM catalog WHERE key='fetched_at'").fetchone()
+                if row is not None:
+                    self.fetched_at = row[0]
+                    self.names = [name for name, in conn.execute('SELECT name FROM concepts ORDER BY rowid')]
+                for concept, trigger in conn.execute('SELECT concept, trigger FROM triggers ORDER BY rowid'):
+                    self.triggers[concept] = trigger
+                    self.trigger_concepts[trigger] = concept
+        except (OSError, sqlite3.Error) as e:
+            print(f'** Could not open the concept catalog at {self.db_path}: {str(e)}. The concepts list will not be cached.')
+            self._writable = False
+
+    def list_concepts(self, fetch:Callable[[], list[str]], wait:bool=False) -> Optional[list[str]]:
+        '''
+        Return the names of the concepts in the library, or None if they have
+        never been fetched. If the list is missing or older than the TTL,
+        fetch() is called on a background thread to refresh it. If wait is
+        True, waits for a refresh that is under way before returning.
+        '''
+        with self._lock:
+            stale = self.names is None or time.time() - self.fetched_at > self.ttl
+            retry = self.failed_at is None or time.monotonic() - self.failed_at > CONCEPT_CATALOG_RETRY
+            if stale and retry and Globals.internet_available and self._refresh_thread is None:
+                self._refresh_thread = threading.Thread(target=self._refresh, args=(fetch,), name='concept_catalog', daemon=True)
+                self._refresh_thread.start()
+            thread = self._refresh_thread
+        if wait and thread is not None:
+            thread.join()
+        return self.names
+
+    def record_trigger(self, concept_name:str, trigger:str):
+        self.triggers[concept_name] = trigger
+        self.trigger_concepts[trigger] = concept_name
+        if not self._writable:
+            return
+        try:
+            with self._lock, closing(self._connect()) as conn, conn:
+                conn.execute('INSERT OR REPLACE INTO triggers (concept, trigger) VALUES (?,?)', (concept_name, trigger))
+        except sqlite3.Error as e:
+            print(f'** Could not update the concept catalog: {str(e)}')
+
+    def _refresh(self, fetch:Callable[[], list[str]]):
+        try:
+            concept_names = fetch()
+        except Exception as e:
+            print(f' ** WARNING: Hugging Face textual inversion concepts libraries could not be loaded. The error was {str(e)}.')
+            print(' ** You may load .bin and .pt file(s) manually using the --embedding_directory argument.')
+            with self._lock:
+                self.failed_at = time.monotonic()
+                self._refresh_thread = None
+            return
+
+        fetched_at = time.time()
+        with self._lock:
+            self.names = concept_names
+            self.fetched_at = fetched_at
+            self.failed_at = None
+            self._refresh_thread = None
+            if not self._writable:
+                return
+            try:
+                with closing(self._connect()) as conn, conn:
+                    conn.execute('DELETE FROM concepts')
+                    conn.executemany('INSERT OR IGNORE INTO concepts (name) VALUES (?)', [(name,) for name in concept_names])
+                    conn.execute("INSERT OR REPLACE INTO catalog (key, value) VALUES ('fetched_at', ?)", (fetched_at,))
+            except sqlite3.Error as e:
+                print(f'** Could not update the concept catalog: {str(e)}')
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.db_path, timeout=30)
+
+_concept_catalogs = dict()
+_concept_catalogs_lock = threading.Lock()
+
+def get_concept_catalog(root:str=None) -> ConceptCatalog:
+    '''
+    Return the ConceptCatalog shared by the concept libraries of the process
+    that use the given root directory (default: the InvokeAI root).
+    '''
+    db_path = Path(root or Globals.root, Globals.database_dir, 'concepts.db')
+    with _concept_catalogs_lock:
+        if db_path not in _concept_catalogs:
+            _concept_catalogs[db_path] = ConceptCatalog(db_path)
+        return _concept_catalogs[db_path]
 
 class HuggingFaceConceptsLibrary(object):
     def __init__(self, root=None):
@@ -19,38 +139,32 @@ class HuggingFaceConceptsLibrary(object):
         '''
         self.root = root or Globals.root
         self.hf_api = HfApi()
+        self.catalog = get_concept_catalog(self.root)
         self.local_concepts = dict()
+        self.local_concepts_mtime = None  # of the embeddings directory when it was last scanned
         self.concept_list = None
+        self.concept_set = set()
+        self.remote_concepts = None
         self.concepts_loaded = dict()
-        self.triggers = dict()            # concept name to trigger phrase
-        self.concept_names = dict()       # trigger phrase to concept name
+        self.triggers = self.catalog.triggers                 # concept name to trigger phrase
+        self.concept_names = self.catalog.trigger_concepts    # trigger phrase to concept name
         self.match_trigger = re.compile('(<[\w\- >]+>)') # trigger is slightly less restrictive than HF concept name
         self.match_concept = re.compile('<([\w\-]+)>') # HF concept name can only contain A-Za-z0-9_-
 
-    def list_concepts(self)->list:
+    def list_concepts(self, wait:bool=False)->list:
         '''
         Return a list of all the concepts by name, without the 'sd-concepts-library' part.
-        Also adds local concepts in invokeai/embeddings folder.
+        Also adds local concepts in invokeai/embeddings folder. The HuggingFace concepts
+        come from the concept catalog and are refreshed in the background; pass wait=True
+        to wait for a refresh that is under way.
         '''
-        local_concepts_now = self.get_local_concepts(os.path.join(self.root, 'embeddings'))
-        local_concepts_to_add = set(local_concepts_now).difference(set(self.local_concepts))
-        self.local_concepts.update(local_concepts_now)
-
-        if self.concept_list is not None:
-            if local_concepts_to_add:
-                self.concept_list.extend(list(local_concepts_to_add))
-                return self.concept_list
-            return self.concept_list
-        else:
-            try:
-                models = self.hf_api.list_models(filter=ModelFilter(model_name='sd-concepts-library/'))
-                self.concept_list = [a.id.split('/')[1] for a in models]
-                # when init, add all in dir. when not init, add only concepts added between init and now
-                self.concept_list.extend(list(local_concepts_to_add))
-            except Exception as e:
-                print(f' ** WARNING: Hugging Face textual inversion concepts libraries could not be loaded. The error was {str(e)}.')
-                print(' ** You may load .bin and .pt file(s) manually using the --embedding_directory argument.')
-            return self.concept_list
+        local_changed = self._update_local_concepts()
+        remote_concepts = self.catalog.list_concepts(self._fetch_concept_names, wait=wait)
+        if self.concept_list is None or local_changed or remote_concepts is not self.remote_concepts:
+            self.remote_concepts = remote_concepts
+            self.concept_list = list(dict.fromkeys((remote_concepts or []) + list(self.local_concepts)))
+            self.concept_set = set(self.concept_list)
+        return self.concept_list
 
     def get_concept_model_path(self, concept_name:str)->str:
         '''
@@ -58,7 +172,11 @@ class HuggingFaceConceptsLibrary(object):
         the named concept. Returns None if invalid or cannot
         be downloaded.
         '''
-        if not concept_name in self.list_concepts():
+        self.list_concepts()
+        if not concept_name in self.concept_set:
+            # the catalog may be being fetched; the concept has to be downloaded anyway
+            self.list_concepts(wait=True)
+        if not concept_name in self.concept_set:
             print(f'This concept is not a local embedding trigger, nor is it a HuggingFace concept. Generation will continue without the concept.')
             return None
         return self.get_concept_file(concept_name.lower(),'learned_embeds.bin')
@@ -82,16 +200,14 @@ class HuggingFaceConceptsLibrary(object):
         with open(file,'r') as f:
             trigger = f.readline()
             trigger = trigger.strip()
-        self.triggers[concept_name] = trigger
-        self.concept_names[trigger] = concept_name
+        self.catalog.record_trigger(concept_name, trigger)
         return trigger
 
     def trigger_to_concept(self, trigger:str)->str:
         '''
         Given a trigger phrase, maps it to the concept library name.
         Only works if concept_to_trigger() has previously been called
-        on this library. There needs to be a persistent database for
-        this.
+        for the concept, in this or an earlier session.
         '''
         concept = self.concept_names.get(trigger,None)
         return f'<{concept}>' if concept else f'{trigger}'
@@ -154,6 +270,7 @@ class HuggingFaceConceptsLibrary(object):
         return path if os.path.exists(path) else None
 
     def concept_is_local(self, concept_name)->bool:
+        self._update_local_concepts()
         return concept_name in self.local_concepts
 
     def concept_is_downloaded(self, concept_name)->bool:
@@ -198,6 +315,26 @@ class HuggingFaceConceptsLibrary(object):
         print('...{:.2f}Kb'.format(bytes/1024))
         return succeeded
 
+    def _fetch_concept_names(self)->list[str]:
+        models = self.hf_api.list_models(filter=ModelFilter(model_name='sd-concepts-library/'))
+        return [a.id.split('/')[1] for a in models]
+
+    def _update_local_concepts(self)->bool:
+        '''
+        Rescan the embeddings directory if it has changed since it was last
+        scanned. Returns True if it was rescanned.
+        '''
+        loc_dir = os.path.join(self.root, 'embeddings')
+        try:
+            mtime = os.stat(loc_dir).st_mtime_ns
+        except OSError:
+            mtime = None
+        if mtime == self.local_concepts_mtime:
+            return False
+        self.local_concepts_mtime = mtime
+        self.local_concepts.update(self.get_local_concepts(loc_dir))
+        return True
+
     def _concept_id(self, concept_name:str)->str:
         return f'sd-concepts-library/{concept_name}'
 
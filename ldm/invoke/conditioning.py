@@ -5,8 +5,15 @@ Useful function exports:
 
 get_uc_and_c_and_ec()           get the conditioned and unconditioned latent, and edited conditioning if we're doing cross-attention control
 
+Useful class exports:
+
+PromptEmbeddingCache            LRU cache of the results of get_uc_and_c_and_ec()
+
 '''
+import functools
 import re
+import threading
+from collections import OrderedDict
 from typing import Union
 
 import torch
@@ -19,16 +26,99 @@ from ..modules.encoders.modules import WeightedFrozenCLIPEmbedder
 from ..modules.prompt_to_embeddings_converter import WeightedPromptFragmentsToEmbeddingsConverter
 
 
-def get_uc_and_c_and_ec(prompt_string, model, log_tokens=False, skip_normalize_legacy_blend=False):
+DEFAULT_PROMPT_CACHE_BYTES = 64 * 1024 * 1024
+PROMPT_PARSE_CACHE_SIZE = 256
+
+
+class PromptEmbeddingCache:
+    '''
+    Keeps the (uc, c, extra_conditioning_info) tuples made by get_uc_and_c_and_ec()
+    so that re-running a prompt with a new seed does not parse it and run the
+    text encoder again. Entries are keyed on the model hash, the normalized
+    prompt and the set of textual inversions whose tokens are in the tokenizer,
+    so loading or injecting an embedding implicitly invalidates what was cached
+    before. The least recently used entries are dropped once the tensors held
+    exceed max_bytes.
+    '''
+    def __init__(self, max_bytes: int = DEFAULT_PROMPT_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, key, conditioning):
+        size = self._size_of(conditioning)
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.total_bytes -= self.entries.pop(key)[1]
+            self.entries[key] = (conditioning, size)
+            self.total_bytes += size
+            while self.total_bytes > self.max_bytes:
+                _, (_, evicted_size) = self.entries.popitem(last=False)
+                self.total_bytes -= evicted_size
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.total_bytes = 0
+
+    @classmethod
+    def _size_of(cls, value) -> int:
+        if isinstance(value, torch.Tensor):
+            return value.element_size() * value.nelement()
+        if isinstance(value, dict):
+            return sum(cls._size_of(v) for v in value.values())
+        if isinstance(value, (list, tuple)):
+            return sum(cls._size_of(v) for v in value)
+        if isinstance(value, InvokeAIDiffuserComponent.ExtraConditioningInfo) and value.wants_cross_attention_control:
+            return cls._size_of(value.cross_attention_control_args.edited_conditioning)
+        return 0
+
+
+prompt_embedding_cache = PromptEmbeddingCache()
+
+
+def get_uc_and_c_and_ec(prompt_string, model, log_tokens=False, skip_normalize_legacy_blend=False, model_hash=None):
+    '''
+    If model_hash is given, results are served from and added to the prompt
+    embedding cache. The returned tensors may therefore be shared between
+    calls, and must not be modified in place.
+    '''
 
     # lazy-load any deferred textual inversions.
     # this might take a couple of seconds the first time a textual inversion is used.
     model.textual_inversion_manager.create_deferred_token_ids_for_any_trigger_terms(prompt_string)
 
+    cache_key = None
+    if model_hash is not None:
+        cache_key = (model_hash,
+                     ' '.join(prompt_string.split()),
+                     skip_normalize_legacy_blend,
+                     model.textual_inversion_manager.get_injected_trigger_strings())
+        # when logging, go through the encoder so that the tokenization is shown
+        if not log_tokens and (conditioning := prompt_embedding_cache.get(cache_key)) is not None:
+            return conditioning
+
     prompt, negative_prompt = get_prompt_structure(prompt_string,
                                                    skip_normalize_legacy_blend=skip_normalize_legacy_blend)
     conditioning = _get_conditioning_for_prompt(prompt, negative_prompt, model, log_tokens)
 
+    if cache_key is not None:
+        prompt_embedding_cache.put(cache_key, conditioning)
     return conditioning
 
 
@@ -36,6 +126,8 @@ def get_prompt_structure(prompt_string, skip_normalize_legacy_blend: bool = Fals
 Union[FlattenedPrompt, Blend], FlattenedPrompt):
     """
     parse the passed-in prompt string and return tuple (positive_prompt, negative_prompt)
+
+    Parse results are cached and shared between calls, and must not be modified.
     """
     prompt, negative_prompt = _parse_prompt_string(prompt_string,
                                                    skip_normalize_legacy_blend=skip_normalize_legacy_blend)
@@ -55,6 +147,7 @@ def get_tokens_for_prompt(model, parsed_prompt: FlattenedPrompt, truncate_if_too
     return tokens
 
 
+@functools.lru_cache(maxsize=PROMPT_PARSE_CACHE_SIZE)
 def _parse_prompt_string(prompt_string_uncleaned, skip_normalize_legacy_blend=False) -> Union[FlattenedPrompt, Blend]:
     # Extract Unconditioned Words From Prompt
     unconditioned_words = ''
@@ -99,24 +192,24 @@ def _get_conditioning_for_prompt(parsed_prompt: Union[Blend, FlattenedPrompt], p
     conditioning = None
     cac_args: cross_attention_control.Arguments = None
 
+    # the negative prompt is encoded in the same text encoder batch as the positive prompt(s)
     if type(parsed_prompt) is Blend:
-        conditioning = _get_conditioning_for_blend(model, parsed_prompt, log_tokens)
+        conditioning, unconditioning = _get_conditioning_for_blend(model, parsed_prompt, parsed_negative_prompt, log_tokens)
     elif type(parsed_prompt) is FlattenedPrompt:
         if parsed_prompt.wants_cross_attention_control:
-            conditioning, cac_args = _get_conditioning_for_cross_attention_control(model, parsed_prompt, log_tokens)
+            conditioning, unconditioning, cac_args = _get_conditioning_for_cross_attention_control(model,
+                                                                                                   parsed_prompt,
+                                                                                                   parsed_negative_prompt,
+                                                                                                   log_tokens)
 
         else:
-            conditioning, _ = _get_embeddings_and_tokens_for_prompt(model,
-                                                                    parsed_prompt,
-                                                                    log_tokens=log_tokens,
-                                                                    log_display_label="(prompt)")
+            (conditioning, _), (unconditioning, _) = _get_embeddings_and_tokens_for_prompts(model,
+                                                                                            [parsed_prompt, parsed_negative_prompt],
+                                                                                            log_tokens=log_tokens,
+                                                                                            log_display_labels=["(prompt)", "(unconditioning)"])
     else:
         raise ValueError(f"parsed_prompt is '{type(parsed_prompt)}' which is not a supported prompt type")
 
-    unconditioning, _ = _get_embeddings_and_tokens_for_prompt(model,
-                                                              parsed_negative_prompt,
-                                                              log_tokens=log_tokens,
-                                                              log_display_label="(unconditioning)")
     if isinstance(conditioning, dict):
         # hybrid conditioning is in play
         unconditioning, conditioning = _flatten_hybrid_conditioning(unconditioning, conditioning)
@@ -141,7 +234,8 @@ def _get_conditioning_for_prompt(parsed_prompt: Union[Blend, FlattenedPrompt], p
     )
 
 
-def _get_conditioning_for_cross_attention_control(model, prompt: FlattenedPrompt, log_tokens: bool = True):
+def _get_conditioning_for_cross_attention_control(model, prompt: FlattenedPrompt, negative_prompt: FlattenedPrompt,
+                                                  log_tokens: bool = True):
     original_prompt = FlattenedPrompt()
     edited_prompt = FlattenedPrompt()
     # for name, a0, a1, b0, b1 in edit_opcodes: only name == 'equal' is currently parsed
@@ -188,20 +282,19 @@ def _get_conditioning_for_cross_attention_control(model, prompt: FlattenedPrompt
     edit_options.append(None)
     original_token_count += 1
     edited_token_count += 1
-    original_embeddings, original_tokens = _get_embeddings_and_tokens_for_prompt(model,
-                                                                                 original_prompt,
-                                                                                 log_tokens=log_tokens,
-                                                                                 log_display_label="(.swap originals)")
     # naïvely building a single edited_embeddings like this disregards the effects of changing the absolute location of
     # subsequent tokens when there is >1 edit and earlier edits change the total token count.
     # eg "a cat.swap(smiling dog, s_start=0.5) eating a hotdog.swap(pizza)" - when the 'pizza' edit is active but the
     # 'cat' edit is not, the 'pizza' feature vector will nevertheless be affected by the introduction of the extra
     # token 'smiling' in the inactive 'cat' edit.
     # todo: build multiple edited_embeddings, one for each edit, and pass just the edited fragments through to the CrossAttentionControl functions
-    edited_embeddings, edited_tokens = _get_embeddings_and_tokens_for_prompt(model,
-                                                                             edited_prompt,
-                                                                             log_tokens=log_tokens,
-                                                                             log_display_label="(.swap replacements)")
+    (original_embeddings, original_tokens), (edited_embeddings, edited_tokens), (unconditioning, _) = \
+        _get_embeddings_and_tokens_for_prompts(model,
+                                               [original_prompt, edited_prompt, negative_prompt],
+                                               log_tokens=log_tokens,
+                                               log_display_labels=["(.swap originals)",
+                                                                   "(.swap replacements)",
+                                                                   "(unconditioning)"])
     conditioning = original_embeddings
     edited_conditioning = edited_embeddings
     # print('>> got edit_opcodes', edit_opcodes, 'options', edit_options)
@@ -210,22 +303,46 @@ def _get_conditioning_for_cross_attention_control(model, prompt: FlattenedPrompt
         edit_opcodes=edit_opcodes,
         edit_options=edit_options
     )
-    return conditioning, cac_args
-
-
-def _get_conditioning_for_blend(model, blend: Blend, log_tokens: bool = False):
-    embeddings_to_blend = None
-    for i, flattened_prompt in enumerate(blend.prompts):
-        this_embedding, _ = _get_embeddings_and_tokens_for_prompt(model,
-                                                                  flattened_prompt,
-                                                                  log_tokens=log_tokens,
-                                                                  log_display_label=f"(blend part {i + 1}, weight={blend.weights[i]})")
-        embeddings_to_blend = this_embedding if embeddings_to_blend is None else torch.cat(
-            (embeddings_to_blend, this_embedding))
+    return conditioning, unconditioning, cac_args
+
+
+def _get_conditioning_for_blend(model, blend: Blend, negative_prompt: FlattenedPrompt, log_tokens: bool = False):
+    labels = [f"(blend part {i + 1}, weight={blend.weights[i]})" for i in range(len(blend.prompts))]
+    embeddings_and_tokens = _get_embeddings_and_tokens_for_prompts(model,
+                                                                   blend.prompts + [negative_prompt],
+                                                                   log_tokens=log_tokens,
+                                                                   log_display_labels=labels + ["(unconditioning)"])
+    unconditioning, _ = embeddings_and_tokens.pop()
+    embeddings_to_blend = torch.cat([embeddings for embeddings, _ in embeddings_and_tokens])
     conditioning = WeightedPromptFragmentsToEmbeddingsConverter.apply_embedding_weights(embeddings_to_blend.unsqueeze(0),
                                                                       blend.weights,
                                                                       normalize=blend.normalize_weights)
-    return conditioning
+    return conditioning, unconditioning
+
+
+def _get_embeddings_and_tokens_for_prompts(model, flattened_prompts: list[FlattenedPrompt], log_tokens: bool = False,
+                                           log_display_labels: list[str] = None) -> list[tuple]:
+    """
+    Encode several prompts with a single batched call to the text encoder. Returns one (embeddings, tokens) tuple
+    per prompt, as _get_embeddings_and_tokens_for_prompt would have.
+    """
+    for flattened_prompt in flattened_prompts:
+        if type(flattened_prompt) is not FlattenedPrompt:
+            raise Exception(f"embeddings can only be made from FlattenedPrompts, got {type(flattened_prompt)} instead")
+    fragments = [[x.text for x in p.children] for p in flattened_prompts]
+    weights = [[x.weight for x in p.children] for p in flattened_prompts]
+    embeddings, tokens = model.get_learned_conditioning(fragments, return_tokens=True, fragment_weights=weights)
+    if not isinstance(embeddings, torch.Tensor) or embeddings.shape[1] % len(flattened_prompts) != 0:
+        # not a plain embeddings tensor that can be split up again; encode the prompts one at a time
+        return [_get_embeddings_and_tokens_for_prompt(model, p, log_tokens, label)
+                for p, label in zip(flattened_prompts, log_display_labels or [None] * len(flattened_prompts))]
+    if log_tokens:
+        for prompt_fragments, label in zip(fragments, log_display_labels or [None] * len(fragments)):
+            log_tokenization(" ".join(prompt_fragments), model, display_label=label)
+
+    # the prompts of a batch come back concatenated along the token dimension
+    return list(zip(embeddings.chunk(len(flattened_prompts), dim=1),
+                    tokens.chunk(len(flattened_prompts), dim=1)))
 
 
 def _get_embeddings_and_tokens_for_prompt(model, flattened_prompt: FlattenedPrompt, log_tokens: bool = False,
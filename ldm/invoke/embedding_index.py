@@ -0,0 +1,191 @@
+'''
+ldm.invoke.embedding_index keeps a persistent index of the textual
+inversion embeddings found in the embeddings directory, so that they do
+not have to be picklescanned and torch.load()ed again every time a model
+is loaded.
+
+The index is a SQLite database under the InvokeAI root directory. Each
+entry is keyed on the file's path, size and modification time, and
+records whether the file passed the security scan and could be parsed,
+its trigger string, its token dimension and the embedding itself,
+serialized with safetensors. Files are rescanned whenever their key
+changes. Embeddings that have been read once are also kept in memory,
+so that switching models only stat()s the embedding files.
+
+Useful exports:
+
+EmbeddingIndex        - look up, or scan and index, the embeddings in a directory
+IndexedEmbedding      - an embedding returned by the index
+get_embedding_index() - the EmbeddingIndex shared by all the models of the process
+'''
+from __future__ import annotations
+
+import os
+import sqlite3
+import threading
+from contextlib import closing
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Callable, Optional, Union
+
+import torch
+from safetensors.torch import load as load_safetensors
+from safetensors.torch import save as save_safetensors
+
+from ldm.invoke.globals import global_database_dir
+
+VERDICT_OK = 'ok'
+VERDICT_REJECTED = 'rejected'   # failed the security scan, or could not be parsed
+
+@dataclass(frozen=True)
+class IndexedEmbedding:
+    path: str
+    trigger_string: str
+    embedding: torch.Tensor
+
+    @property
+    def token_dim(self) -> int:
+        return self.embedding.shape[-1]
+
+class EmbeddingIndex(object):
+    def __init__(self, db_path:Union[str,Path]=None):
+        '''
+        Open (creating if necessary) the embedding index stored at db_path,
+        which defaults to embeddings.db in the InvokeAI databases directory.
+        '''
+        self.db_path = Path(db_path or global_database_dir() / 'embeddings.db')
+        self._lock = threading.Lock()
+        self._loaded = dict()     # path -> (key, IndexedEmbedding)
+        self._writable = True
+        try:
+            self.db_path.parent.mkdir(parents=True, exist_ok=True)
+            with closing(self._connect()) as conn, conn:
+                conn.execute(
+                    '''CREATE TABLE IF NOT EXISTS embeddings (
+                         path TEXT PRIMARY KEY,
+                         size INTEGER NOT NULL,
+                         mtime_ns INTEGER NOT NULL,
+                         verdict TEXT NOT NULL,
+                         trigger_string TEXT,
+                         token_dim INTEGER,
+                         embedding BLOB
+                       )'''
+                )
+        except (OSError, sqlite3.Error) as e:
+            print(f'** Could not open the embedding index at {self.db_path}: {str(e)}. Embeddings will be rescanned every time they are loaded.')
+            self._writable = False
+
+    def load_directory(self,
+                       directory:Union[str,Path],
+                       token_dim:int,
+                       scan_and_parse:Callable[[str], Optional[dict]],
+                       ) -> list[IndexedEmbedding]:
+        '''
+        Return the embeddings under directory whose token dimension is
+        token_dim, in the order os.walk() finds them. Files that are not in
+        the index, or have changed since they were indexed, are passed to
+        scan_and_parse(path), which returns a dict with the embedding's
+        'name' and 'embedding', or None to reject the file. Only the
+        compatible embeddings are read from the database.
+        '''
+        keys = dict()
+        for root, _, files in os.walk(directory):
+            for name in files:
+                if name == '.DS_Store':
+                    continue
+                path = os.path.realpath(os.path.join(root, name))
+                try:
+                    keys[path] = self._key(os.stat(path))
+                except OSError:
+                    continue
+
+        indexed = self._indexed_keys()
+        for path, key in keys.items():
+            if indexed.get(path, (None,))[:2] != key:
+                indexed[path] = (*key, *self._index_file(path, key, scan_and_parse))
+
+        compatible = [
+            path for path in keys
+            if indexed[path][2] == VERDICT_OK and indexed[path][3] == token_dim
+        ]
+        with self._lock:
+            missing = [path for path in compatible if self._loaded.get(path, (None,))[0] != keys[path]]
+        if missing:
+            self._read_embeddings(missing, keys)
+        with self._lock:
+            return [self._loaded[path][1] for path in compatible if path in self._loaded]
+
+    def _indexed_keys(self) -> dict[str, tuple]:
+        if not self._writable:
+            return dict()
+        with closing(self._connect()) as conn:
+            rows = conn.execute('SELECT path, size, mtime_ns, verdict, token_dim FROM embeddings').fetchall()
+        return {path: (size, mtime_ns, verdict, token_dim) for path, size, mtime_ns, verdict, token_dim in rows}
+
+    def _index_file(self, path:str, key:tuple[int,int], scan_and_parse:Callable[[str], Optional[dict]]) -> tuple[str, Optional[int]]:
+        try:
+            embedding_info = scan_and_parse(path)
+        except Exception as e:
+            print(f'>> Failed to load embedding located at {path}: {str(e)}')
+            embedding_info = None
+
+        if embedding_info:
+            embedding = embedding_info['embedding'].detach().contiguous()
+            entry = IndexedEmbedding(path=path, trigger_string=embedding_info['name'], embedding=embedding)
+            row = (VERDICT_OK, entry.trigger_string, entry.token_dim, save_safetensors({'embedding': embedding}))
+            with self._lock:
+                self._loaded[path] = (key, entry)
+        else:
+            row = (VERDICT_REJECTED, None, None, None)
+
+        # don't index a file that was modified, or deleted, while we were reading it
+        try:
+            unchanged = key == self._key(os.stat(path))
+        except OSError:
+            unchanged = False
+        if self._writable and unchanged:
+            try:
+                with self._lock, closing(self._connect()) as conn, conn:
+                    conn.execute(
+                        'INSERT OR REPLACE INTO embeddings (path, size, mtime_ns, verdict, trigger_string, token_dim, embedding) VALUES (?,?,?,?,?,?,?)',
+                        (path, *key, *row),
+                    )
+            except sqlite3.Error as e:
+                print(f'** Could not update the embedding index: {str(e)}')
+        return row[0], row[2]
+
+    def _read_embeddings(self, paths:list[str], keys:dict[str,tuple[int,int]]):
+        if not self._writable:
+            return
+        with closing(self._connect()) as conn:
+            rows = conn.execute(
+                f'SELECT path, size, mtime_ns, trigger_string, embedding FROM embeddings WHERE path IN ({",".join("?" * len(paths))})',
+                paths,
+            ).fetchall()
+        with self._lock:
+            for path, size, mtime_ns, trigger_string, blob in rows:
+                if (size, mtime_ns) != keys[path]:
+                    continue
+                embedding = load_safetensors(blob)['embedding']
+                self._loaded[path] = (keys[path], IndexedEmbedding(path=path, trigger_string=trigger_string, embedding=embedding))
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.db_path, timeout=30)
+
+    @staticmethod
+    def _key(stat:os.stat_result) -> tuple[int, int]:
+        return (stat.st_size, stat.st_mtime_ns)
+
+_embedding_index = None
+_embedding_index_lock = threading.Lock()
+
+def get_embedding_index() -> EmbeddingIndex:
+    '''
+    Return the EmbeddingIndex shared by all the models of the process,
+    creating it on first use (i.e. after the root directory has been set).
+    '''
+    global _embedding_index
+    with _embedding_index_lock:
+        if _embedding_index is None:
+            _embedding_index = EmbeddingIndex()
+        return _embedding_index
@@ -4,6 +4,7 @@ including img2img, txt2img, and inpaint
 '''
 from __future__ import annotations
 
+import inspect
 import os
 import os.path as osp
 import random
@@ -12,6 +13,7 @@ from contextlib import nullcontext
 
 import cv2
 import numpy as np
+import psutil
 import torch
 from PIL import Image, ImageFilter, ImageChops
 from diffusers import DiffusionPipeline
@@ -25,6 +27,17 @@ from ldm.util import rand_perlin_2d
 downsampling = 8
 CAUTION_IMG = 'assets/caution.png'
 
+def scheduler_adds_noise_per_step(scheduler, ddim_eta: float = 0.0) -> bool:
+    """
+    True if the scheduler injects fresh noise at every step (the ancestral samplers, DDPM, and
+    DDIM with eta > 0). That noise comes from the global torch RNG, which is shared by a whole
+    batch, so images denoised together would not match the images their seeds give alone.
+    """
+    name = type(scheduler).__name__
+    if 'Ancestral' in name or name == 'DDPMScheduler':
+        return True
+    return ddim_eta > 0 and 'eta' in inspect.signature(scheduler.step).parameters
+
 class Generator:
     downsampling_factor: int
     latent_channels: int
@@ -54,6 +67,15 @@ class Generator:
         """
         raise NotImplementedError("image_iterator() must be implemented in a descendent class")
 
+    # this may be overridden by generators that can denoise several seeds in one batch
+    def get_make_images(self,prompt,**kwargs):
+        """
+        Returns a function taking a batch of initial noise tensors (one per seed, stacked
+        along dim 0) and returning a list of images, one per batch entry, or None if
+        this generator cannot batch the request.
+        """
+        return None
+
     def set_variation(self, seed, variation_amount, with_variations):
         self.seed             = seed
         self.variation_amount = variation_amount
@@ -63,14 +85,14 @@ class Generator:
                  image_callback=None, step_callback=None, threshold=0.0, perlin=0.0,
                  safety_checker:dict=None,
                  free_gpu_mem: bool=False,
+                 max_batch_size: int=1,
                  **kwargs):
         scope = nullcontext
         self.safety_checker = safety_checker
         self.free_gpu_mem = free_gpu_mem
         attention_maps_images = []
         attention_maps_callback = lambda saver: attention_maps_images.append(saver.get_stacked_maps_image())
-        make_image = self.get_make_image(
-            prompt,
+        make_image_args = dict(
             sampler = sampler,
             init_image    = init_image,
             width         = width,
@@ -81,46 +103,103 @@ class Generator:
             attention_maps_callback = attention_maps_callback,
             **kwargs
         )
+        make_image = self.get_make_image(prompt, **make_image_args)
+        make_images = None
+        if max_batch_size > 1 and iterations > 1:
+            make_images = self.get_make_images(prompt, **make_image_args)
+        batch_size = 1
+        if make_images is not None:
+            batch_size = self.choose_batch_size(width, height, min(iterations, max_batch_size))
+
         results             = []
         seed                = seed if seed is not None and seed >= 0 else self.new_seed()
         first_seed          = seed
         seed, initial_noise = self.generate_initial_noise(seed, width, height)
 
+        def finish_image(image, image_seed):
+            if self.safety_checker is not None:
+                image = self.safety_check(image)
+
+            results.append([image, image_seed])
+
+            if image_callback is not None:
+                attention_maps_image = None if len(attention_maps_images)==0 else attention_maps_images[-1]
+                image_callback(image, image_seed, first_seed=first_seed, attention_maps_image=attention_maps_image)
+
         # There used to be an additional self.model.ema_scope() here, but it breaks
         # the inpaint-1.5 model. Not sure what it did.... ?
         with scope(self.model.device.type):
-            for n in trange(iterations, desc='Generating'):
-                x_T = None
-                if self.variation_amount > 0:
-                    seed_everything(seed)
-                    target_noise = self.get_noise(width,height)
-                    x_T = self.slerp(self.variation_amount, initial_noise, target_noise)
-                elif initial_noise is not None:
-                    # i.e. we specified particular variations
-                    x_T = initial_noise
-                else:
-                    seed_everything(seed)
-                    try:
-                        x_T = self.get_noise(width,height)
-                    except:
-                        print('** An error occurred while getting initial noise **')
-                        print(traceback.format_exc())
-
-                image = make_image(x_T)
-
-                if self.safety_checker is not None:
-                    image = self.safety_check(image)
-
-                results.append([image, seed])
-
-                if image_callback is not None:
-                    attention_maps_image = None if len(attention_maps_images)==0 else attention_maps_images[-1]
-                    image_callback(image, seed, first_seed=first_seed, attention_maps_image=attention_maps_image)
-
-                seed = self.new_seed()
+            if batch_size > 1:
+                print(f'>> Generating {iterations} images in batches of up to {batch_size}')
+                for start in trange(0, iterations, batch_size, desc='Generating'):
+                    # draw the seeds in the same order as the one-at-a-time loop below,
+                    # so that every image is reproducible from its seed alone
+                    seeds = []
+                    noises = []
+                    for _ in range(min(batch_size, iterations - start)):
+                        seeds.append(seed)
+                        noises.append(self.get_initial_noise_for_seed(seed, initial_noise, width, height))
+                        seed = self.new_seed()
+
+                    images = make_images(torch.cat(noises))
+
+                    for image, image_seed in zip(images, seeds):
+                        finish_image(image, image_seed)
+            else:
+                for n in trange(iterations, desc='Generating'):
+                    x_T = self.get_initial_noise_for_seed(seed, initial_noise, width, height)
+                    image = make_image(x_T)
+                    finish_image(image, seed)
+                    seed = self.new_seed()
 
         return results
 
+    def get_initial_noise_for_seed(self, seed, initial_noise, width, height):
+        """
+        Returns the starting noise x_T for the given seed, taking any requested
+        variations into account.
+        """
+        x_T = None
+        if self.variation_amount > 0:
+            seed_everything(seed)
+            target_noise = self.get_noise(width,height)
+            x_T = self.slerp(self.variation_amount, initial_noise, target_noise)
+        elif initial_noise is not None:
+            # i.e. we specified particular variations
+            x_T = initial_noise
+        else:
+            seed_everything(seed)
+            try:
+                x_T = self.get_noise(width,height)
+            except:
+                print('** An error occurred while getting initial noise **')
+                print(traceback.format_exc())
+        return x_T
+
+    def choose_batch_size(self, width, height, max_batch_size) -> int:
+        """
+        Returns the number of images, up to max_batch_size, whose working set
+        should fit into the memory currently free on the model's device.
+        """
+        device = self.model.device
+        if device.type == 'cuda':
+            free_mem, _ = torch.cuda.mem_get_info(device)
+        else:
+            free_mem = psutil.virtual_memory().available
+
+        # Rough per-image estimate of the largest transient allocations: the
+        # self-attention scores at latent resolution (CFG doubles the UNet batch,
+        # 8 heads) and the 512-channel feature maps of the VAE decoder.
+        element_size = torch.finfo(self.torch_dtype()).bits // 8
+        latent_pixels = (width // self.downsampling_factor) * (height // self.downsampling_factor)
+        attention_bytes = 2 * 8 * latent_pixels ** 2 * element_size
+        decoder_bytes = 3 * 512 * width * height * element_size
+        per_image_bytes = max(attention_bytes, decoder_bytes)
+
+        # leave some headroom for the model weights' own bookkeeping and fragmentation
+        fits = int(free_mem * 0.8) // per_image_bytes
+        return max(1, min(max_batch_size, fits))
+
     def sample_to_image(self,samples)->Image.Image:
         """
         Given samples returned from a sampler, converts
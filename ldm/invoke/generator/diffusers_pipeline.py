@@ -1,10 +1,12 @@
 from __future__ import annotations
 
 import dataclasses
+import hashlib
 import inspect
 import secrets
 import sys
 import warnings
+from collections import OrderedDict
 from dataclasses import dataclass, field
 from typing import List, Optional, Union, Callable, Type, TypeVar, Generic, Any
 
@@ -29,6 +31,7 @@ from ...modules.prompt_to_embeddings_converter import WeightedPromptFragmentsToE
 attention.CrossAttention = cross_attention_control.InvokeAIDiffusersCrossAttention
 
 from diffusers.models import AutoencoderKL, UNet2DConditionModel
+from diffusers.models.vae import DiagonalGaussianDistribution
 from diffusers.pipelines.stable_diffusion import StableDiffusionPipelineOutput
 from diffusers.pipelines.stable_diffusion.pipeline_stable_diffusion import StableDiffusionPipeline
 from diffusers.pipelines.stable_diffusion.pipeline_stable_diffusion_img2img import StableDiffusionImg2ImgPipeline
@@ -166,6 +169,70 @@ def image_resized_to_grid_as_tensor(image: PIL.Image.Image, normalize: bool=True
     return tensor
 
 
+VAE_SCALE_FACTOR = 8     # pixels per latent
+VAE_TILE_OVERLAP = 8     # latents shared by neighbouring VAE tiles
+INIT_LATENTS_CACHE_SIZE = 8     # encoded init images kept by each pipeline
+
+
+def _tile_starts(length: int, tile_size: int, overlap: int) -> List[int]:
+    if length <= tile_size:
+        return [0]
+    stride = tile_size - overlap
+    return list(range(0, length - tile_size, stride)) + [length - tile_size]
+
+
+def _feather(length: int, ramp: int, ramp_start: bool, ramp_end: bool, device) -> torch.Tensor:
+    """weights that ramp up linearly over the first and/or last `ramp` elements"""
+    positions = torch.arange(length, device=device, dtype=torch.float32) + 0.5
+    weights = torch.ones(length, device=device, dtype=torch.float32)
+    if ramp_start:
+        weights = torch.minimum(weights, positions / ramp)
+    if ramp_end:
+        weights = torch.minimum(weights, (length - positions) / ramp)
+    return weights
+
+
+def apply_in_tiles(op: Callable[[torch.Tensor], torch.Tensor], x: torch.Tensor,
+                   tile_size: int, overlap: int = VAE_TILE_OVERLAP,
+                   in_scale: int = 1, out_scale: int = 1) -> torch.Tensor:
+    """
+    Apply a VAE encoder or decoder to x in overlapping tiles.
+
+    Tiles are laid out in latent units: tile_size and overlap are measured in
+    latents, and x and the result of op hold in_scale and out_scale elements
+    per latent respectively. Neighbouring tiles are cross-faded over their
+    overlap so that no seams show. The result is float32.
+    """
+    height, width = x.shape[-2] // in_scale, x.shape[-1] // in_scale
+    ramp = max(1, overlap * out_scale)
+    output = weights = None
+    for top in _tile_starts(height, tile_size, overlap):
+        tile_height = min(tile_size, height)
+        for left in _tile_starts(width, tile_size, overlap):
+            tile_width = min(tile_size, width)
+            tile = x[..., top * in_scale:(top + tile_height) * in_scale,
+                          left * in_scale:(left + tile_width) * in_scale]
+            result = op(tile).float()
+            if output is None:
+                output = torch.zeros(result.shape[0], result.shape[1], height * out_scale, width * out_scale,
+                                     device=result.device, dtype=torch.float32)
+                weights = torch.zeros(height * out_scale, width * out_scale,
+                                      device=result.device, dtype=torch.float32)
+            weight = _feather(tile_height * out_scale, ramp, top > 0, top + tile_height < height, result.device)[:, None] \
+                * _feather(tile_width * out_scale, ramp, left > 0, left + tile_width < width, result.device)[None, :]
+            rows = slice(top * out_scale, (top + tile_height) * out_scale)
+            cols = slice(left * out_scale, (left + tile_width) * out_scale)
+            output[..., rows, cols] += result * weight
+            weights[rows, cols] += weight
+            del result, weight
+    return output / weights
+
+
+def tensor_digest(tensor: torch.Tensor) -> str:
+    """sha1 of the values of a tensor, to recognize an image we have seen before"""
+    return hashlib.sha1(tensor.detach().to('cpu', torch.float32).contiguous().numpy().tobytes()).hexdigest()
+
+
 def is_inpainting_model(unet: UNet2DConditionModel):
     return unet.conv_in.in_channels == 9
 
@@ -310,6 +377,9 @@ class StableDiffusionGeneratorPipeline(StableDiffusionPipeline):
         if is_xformers_available() and not Globals.disable_xformers:
             self.enable_xformers_memory_efficient_attention()
 
+        # VAE encodings of recent init images, so that further iterations and requests on them skip the encoder
+        self._init_latents_cache = OrderedDict()
+
     def image_from_embeddings(self, latents: torch.Tensor, num_inference_steps: int,
                               conditioning_data: ConditioningData,
                               *,
@@ -494,9 +564,7 @@ class StableDiffusionGeneratorPipeline(StableDiffusionPipeline):
                                             noise: torch.Tensor, run_id=None, callback=None
                                             ) -> InvokeAIStableDiffusionPipelineOutput:
         device = self.unet.device
-        img2img_pipeline = StableDiffusionImg2ImgPipeline(**self.components)
-        img2img_pipeline.scheduler.set_timesteps(num_inference_steps, device=device)
-        timesteps, _ = img2img_pipeline.get_timesteps(num_inference_steps, strength, device=device)
+        timesteps = self.get_img2img_timesteps(num_inference_steps, strength, device=device)
 
         result_latents, result_attention_maps = self.latents_from_embeddings(
             initial_latents, num_inference_steps, conditioning_data,
@@ -535,11 +603,7 @@ class StableDiffusionGeneratorPipeline(StableDiffusionPipeline):
         if init_image.dim() == 3:
             init_image = init_image.unsqueeze(0)
 
-        img2img_pipeline = StableDiffusionImg2ImgPipeline(**self.components)
-        img2img_pipeline.scheduler.set_timesteps(num_inference_steps, device=device)
-        timesteps, _ = img2img_pipeline.get_timesteps(num_inference_steps, strength, device=device)
-
-        assert img2img_pipeline.scheduler is self.scheduler
+        timesteps = self.get_img2img_timesteps(num_inference_steps, strength, device=device)
 
         # 6. Prepare latent variables
         # can't quite use upstream StableDiffusionImg2ImgPipeline.prepare_latents
@@ -578,14 +642,72 @@ class StableDiffusionGeneratorPipeline(StableDiffusionPipeline):
             output = InvokeAIStableDiffusionPipelineOutput(images=image, nsfw_content_detected=[], attention_map_saver=result_attention_maps)
             return self.check_for_safety(output, dtype=conditioning_data.dtype)
 
+    def get_img2img_timesteps(self, num_inference_steps: int, strength: float, device) -> torch.Tensor:
+        """
+        The timesteps of an img2img run of the given strength, computed by
+        the installed StableDiffusionImg2ImgPipeline.get_timesteps(). It only
+        needs the scheduler, so it is called on this pipeline rather than on
+        a new StableDiffusionImg2ImgPipeline built for each image.
+        """
+        # also resets the state the scheduler keeps between steps
+        self.scheduler.set_timesteps(num_inference_steps, device=device)
+        timesteps, _ = StableDiffusionImg2ImgPipeline.get_timesteps(self, num_inference_steps, strength, device=device)
+        return timesteps
+
     def non_noised_latents_from_image(self, init_image, *, device, dtype):
-        init_image = init_image.to(device=device, dtype=dtype)
         with torch.inference_mode():
-            init_latent_dist = self.vae.encode(init_image).latent_dist
+            init_latent_dist = DiagonalGaussianDistribution(
+                self._init_image_moments(init_image, device=device, dtype=dtype))
             init_latents = init_latent_dist.sample().to(dtype=dtype)  # FIXME: uses torch.randn. make reproducible!
         init_latents = 0.18215 * init_latents
         return init_latents
 
+    def _init_image_moments(self, init_image, *, device, dtype) -> torch.Tensor:
+        """
+        The mean and log variance of the VAE encoding of init_image. They are
+        cached by image content, and a fresh sample is drawn from them each time.
+        """
+        key = (tensor_digest(init_image), tuple(init_image.shape), dtype)
+        moments = self._init_latents_cache.get(key)
+        if moments is not None:
+            self._init_latents_cache.move_to_end(key)
+            return moments.to(device=device)
+
+        init_image = init_image.to(device=device, dtype=dtype)
+        tile_size = self.vae_tile_size(*init_image.shape[-2:])
+        if tile_size:
+            # blend the means and variances of the tiles, and sample once from the blend
+            moments = apply_in_tiles(lambda tile: self.vae.encode(tile).latent_dist.parameters,
+                                     init_image, tile_size, in_scale=VAE_SCALE_FACTOR).to(dtype=dtype)
+        else:
+            moments = self.vae.encode(init_image).latent_dist.parameters
+        self._init_latents_cache[key] = moments
+        while len(self._init_latents_cache) > INIT_LATENTS_CACHE_SIZE:
+            self._init_latents_cache.popitem(last=False)
+        return moments
+
+    def decode_latents(self, latents):
+        tile_size = self.vae_tile_size(latents.shape[-2] * VAE_SCALE_FACTOR, latents.shape[-1] * VAE_SCALE_FACTOR)
+        if not tile_size:
+            return super().decode_latents(latents)
+        latents = 1 / 0.18215 * latents
+        image = apply_in_tiles(lambda tile: self.vae.decode(tile).sample,
+                               latents, tile_size, out_scale=VAE_SCALE_FACTOR)
+        image = (image / 2 + 0.5).clamp(0, 1)
+        return image.cpu().permute(0, 2, 3, 1).numpy()
+
+    def vae_tile_size(self, height: int, width: int) -> int:
+        """
+        The size in latents of the tiles an image of height x width pixels
+        should be encoded or decoded in, or 0 if it should be done in one go.
+        """
+        tile_size = Globals.vae_tile_size // VAE_SCALE_FACTOR
+        if tile_size <= 0 or height * width <= Globals.vae_tiling_threshold * 1_000_000:
+            return 0
+        if height <= tile_size * VAE_SCALE_FACTOR and width <= tile_size * VAE_SCALE_FACTOR:
+            return 0
+        return max(tile_size, 2 * VAE_TILE_OVERLAP)
+
     def check_for_safety(self, output, dtype):
         with torch.inference_mode():
             screened_images, has_nsfw_concept = self.run_safety_checker(
@@ -56,6 +56,7 @@ class Embiggen(Generator):
         embiggen,
         embiggen_tiles,
         step_callback=None,
+        max_batch_size=1,
         **kwargs
     ):
         """
@@ -169,27 +170,17 @@ class Embiggen(Generator):
         # agradientT is Top-side transparent
         agradientT = Image.linear_gradient('L').resize((width, overlap_size_y))
         # radial corner is the left-top corner, made full circle then cut to just the left-top quadrant
-        agradientC = Image.new('L', (256, 256))
-        for y in range(256):
-            for x in range(256):
-                # Find distance to lower right corner (numpy takes arrays)
-                distanceToLR = np.sqrt([(255 - x) ** 2 + (255 - y) ** 2])[0]
-                # Clamp values to max 255
-                if distanceToLR > 255:
-                    distanceToLR = 255
-                #Place the pixel as invert of distance
-                agradientC.putpixel((x, y), round(255 - distanceToLR))
+        # (computed on the whole 256x256 grid at once rather than pixel by pixel)
+        gradienty, gradientx = np.mgrid[0:256, 0:256].astype(np.float64)
+        # Distance to lower right corner, clamped to 255, placed as its inverse
+        distanceToLR = np.minimum(np.sqrt((255 - gradientx) ** 2 + (255 - gradienty) ** 2), 255)
+        agradientC = Image.fromarray(np.round(255 - distanceToLR).astype(np.uint8), 'L')
 
         # Create alternative asymmetric diagonal corner to use on "tailing" intersections to prevent hard edges
         # Fits for a left-fading gradient on the bottom side and full opacity on the right side.
-        agradientAsymC = Image.new('L', (256, 256))
-        for y in range(256):
-            for x in range(256):
-                value = round(max(0, x-(255-y)) * (255 / max(1,y)))
-                #Clamp values
-                value = max(0, value)
-                value = min(255, value)
-                agradientAsymC.putpixel((x, y), value)
+        asymvalues = np.round(np.maximum(0, gradientx - (255 - gradienty)) * (255 / np.maximum(1, gradienty)))
+        agradientAsymC = Image.fromarray(np.clip(asymvalues, 0, 255).astype(np.uint8), 'L')
+        del gradientx, gradienty, distanceToLR, asymvalues
 
         # Create alpha layers default fully white
         alphaLayerL = Image.new("L", (width, height), 255)
@@ -284,6 +275,117 @@ class Embiggen(Generator):
         del agradientT
         del agradientC
 
+        def composite_tile(outputsuperimage, intileimage, tile):
+            """
+            Gives a finished tile the alpha gradients that blend it into its neighbours
+            and layers it onto the output image. Tiles must arrive in tile order.
+            """
+            intileimage = intileimage.convert('RGBA')
+            # Get row and column entries
+            emb_row_i = tile // emb_tiles_x
+            emb_column_i = tile % emb_tiles_x
+            if emb_row_i == 0 and emb_column_i == 0 and not embiggen_tiles:
+                left = 0
+                top = 0
+            else:
+                # Determine upper-left point
+                if emb_column_i + 1 == emb_tiles_x:
+                    left = initsuperwidth - width
+                else:
+                    left = round(emb_column_i *
+                                 (width - overlap_size_x))
+                if emb_row_i + 1 == emb_tiles_y:
+                    top = initsuperheight - height
+                else:
+                    top = round(emb_row_i * (height - overlap_size_y))
+                # Handle gradients for various conditions
+                # Handle emb_rerun case
+                if embiggen_tiles:
+                    # top of image
+                    if emb_row_i == 0:
+                        if emb_column_i == 0:
+                            if (tile+1) in embiggen_tiles:  # Look-ahead right
+                                if (tile+emb_tiles_x) not in embiggen_tiles:  # Look-ahead down
+                                    intileimage.putalpha(alphaLayerB)
+                                # Otherwise do nothing on this tile
+                            elif (tile+emb_tiles_x) in embiggen_tiles:  # Look-ahead down only
+                                intileimage.putalpha(alphaLayerR)
+                            else:
+                                intileimage.putalpha(alphaLayerRBC)
+                        elif emb_column_i == emb_tiles_x - 1:
+                            if (tile+emb_tiles_x) in embiggen_tiles:  # Look-ahead down
+                                intileimage.putalpha(alphaLayerL)
+                            else:
+                                intileimage.putalpha(alphaLayerLBC)
+                        else:
+                            if (tile+1) in embiggen_tiles:  # Look-ahead right
+                                if (tile+emb_tiles_x) in embiggen_tiles:  # Look-ahead down
+                                    intileimage.putalpha(alphaLayerL)
+                                else:
+                                    intileimage.putalpha(alphaLayerLBC)
+                            elif (tile+emb_tiles_x) in embiggen_tiles:  # Look-ahead down only
+                                intileimage.putalpha(alphaLayerLR)
+                            else:
+                                intileimage.putalpha(alphaLayerABT)
+                    # bottom of image
+                    elif emb_row_i == emb_tiles_y - 1:
+                        if emb_column_i == 0:
+                            if (tile+1) in embiggen_tiles: # Look-ahead right
+                                intileimage.putalpha(alphaLayerTaC)
+                            else:
+                                intileimage.putalpha(alphaLayerRTC)
+                        elif emb_column_i == emb_tiles_x - 1:
+                            # No tiles to look ahead to
+                            intileimage.putalpha(alphaLayerLTC)
+                        else:
+                            if (tile+1) in embiggen_tiles: # Look-ahead right
+                                intileimage.putalpha(alphaLayerLTaC)
+                            else:
+                                intileimage.putalpha(alphaLayerABB)
+                    # vertical middle of image
+                    else:
+                        if emb_column_i == 0:
+                            if (tile+1) in embiggen_tiles: # Look-ahead right
+                                if (tile+emb_tiles_x) in embiggen_tiles: # Look-ahead down
+                                    intileimage.putalpha(alphaLayerTaC)
+                                else:
+                                    intileimage.putalpha(alphaLayerTB)
+                            elif (tile+emb_tiles_x) in embiggen_tiles:  # Look-ahead down only
+                                intileimage.putalpha(alphaLayerRTC)
+                            else:
+                                intileimage.putalpha(alphaLayerABL)
+                        elif emb_column_i == emb_tiles_x - 1:
+                            if (tile+emb_tiles_x) in embiggen_tiles:  # Look-ahead down
+                                intileimage.putalpha(alphaLayerLTC)
+                            else:
+                                intileimage.putalpha(alphaLayerABR)
+                        else:
+                            if (tile+1) in embiggen_tiles: # Look-ahead right
+                                if (tile+emb_tiles_x) in embiggen_tiles: # Look-ahead down
+                                    intileimage.putalpha(alphaLayerLTaC)
+                                else:
+                                    intileimage.putalpha(alphaLayerABR)
+                            elif (tile+emb_tiles_x) in embiggen_tiles:  # Look-ahead down only
+                                intileimage.putalpha(alphaLayerABB)
+                            else:
+                                intileimage.putalpha(alphaLayerAA)
+                # Handle normal tiling case (much simpler - since we tile left to right, top to bottom)
+                else:
+                    if emb_row_i == 0 and emb_column_i >= 1:
+                        intileimage.putalpha(alphaLayerL)
+                    elif emb_row_i >= 1 and emb_column_i == 0:
+                        if emb_column_i + 1 == emb_tiles_x: # If we don't have anything that can be placed to the right
+                            intileimage.putalpha(alphaLayerT)
+                        else:
+                            intileimage.putalpha(alphaLayerTaC)
+                    else:
+                        if emb_column_i + 1 == emb_tiles_x: # If we don't have anything that can be placed to the right
+                            intileimage.putalpha(alphaLayerLTC)
+                        else:
+                            intileimage.putalpha(alphaLayerLTaC)
+            # Layer tile onto final image
+            outputsuperimage.alpha_composite(intileimage, (left, top))
+
         def make_image():
             # Make main tiles -------------------------------------------------
             if embiggen_tiles:
@@ -292,13 +394,13 @@ class Embiggen(Generator):
                 print(
                     f'>> Making {(emb_tiles_x * emb_tiles_y)} Embiggen tiles ({emb_tiles_x}x{emb_tiles_y})...')
 
-            emb_tile_store = []
             # Although we could use the same seed for every tile for determinism, at higher strengths this may
             # produce duplicated structures for each tile and make the tiling effect more obvious
             # instead track and iterate a local seed we pass to Img2Img
             seed = self.seed
             seedintlimit = np.iinfo(np.uint32).max - 1 # only retreive this one from numpy
 
+            tiles = []
             for tile in range(emb_tiles_x * emb_tiles_y):
                 # Don't iterate on first tile
                 if tile != 0:
@@ -310,188 +412,104 @@ class Embiggen(Generator):
                 # Determine if this is a re-run and replace
                 if embiggen_tiles and not tile in embiggen_tiles:
                     continue
-                # Get row and column entries
-                emb_row_i = tile // emb_tiles_x
-                emb_column_i = tile % emb_tiles_x
-                # Determine bounds to cut up the init image
-                # Determine upper-left point
-                if emb_column_i + 1 == emb_tiles_x:
-                    left = initsuperwidth - width
-                else:
-                    left = round(emb_column_i * (width - overlap_size_x))
-                if emb_row_i + 1 == emb_tiles_y:
-                    top = initsuperheight - height
-                else:
-                    top = round(emb_row_i * (height - overlap_size_y))
-                right = left + width
-                bottom = top + height
-
-                # Cropped image of above dimension (does not modify the original)
-                newinitimage = initsuperimage.crop((left, top, right, bottom))
-                # DEBUG:
-                # newinitimagepath = init_img[0:-4] + f'_emb_Ti{tile}.png'
-                # newinitimage.save(newinitimagepath)
-
-                if embiggen_tiles:
-                    print(
-                        f'Making tile #{tile + 1} ({embiggen_tiles.index(tile) + 1} of {len(embiggen_tiles)} requested)')
-                else:
-                    print(
-                        f'Starting {tile + 1} of {(emb_tiles_x * emb_tiles_y)} tiles')
-
-                # create a torch tensor from an Image
-                newinitimage = np.array(
-                    newinitimage).astype(np.float32) / 255.0
-                newinitimage = newinitimage[None].transpose(0, 3, 1, 2)
-                newinitimage = torch.from_numpy(newinitimage)
-                newinitimage = 2.0 * newinitimage - 1.0
-                newinitimage = newinitimage.to(self.model.device)
-
-                tile_results = gen_img2img.generate(
+                tiles.append((tile, seed))
+
+            # Every tile is made from its own crop of the init image, so tiles do not depend on each other
+            # and several can be denoised together. Batches are made in tile order, and their tiles are
+            # layered onto the output as soon as they are done.
+            make_images = None
+            batch_size = 1
+            if max_batch_size > 1 and len(tiles) > 1:
+                make_images = gen_img2img.get_make_images_from_init_images(
                     prompt,
-                    iterations     = 1,
-                    seed           = seed,
-                    sampler        = sampler,
-                    steps          = steps,
-                    cfg_scale      = cfg_scale,
-                    conditioning   = conditioning,
-                    ddim_eta       = ddim_eta,
-                    image_callback = None,  # called only after the final image is generated
-                    step_callback  = step_callback,   # called after each intermediate image is generated
-                    width          = width,
-                    height         = height,
-                    init_image     = newinitimage,    # notice that init_image is different from init_img
-                    mask_image     = None,
-                    strength       = strength,
+                    sampler       = sampler,
+                    steps         = steps,
+                    cfg_scale     = cfg_scale,
+                    ddim_eta      = ddim_eta,
+                    conditioning  = conditioning,
+                    strength      = strength,
+                    width         = width,
+                    height        = height,
+                    step_callback = step_callback,
                 )
+            if make_images is not None:
+                batch_size = gen_img2img.choose_batch_size(width, height, min(len(tiles), max_batch_size))
+                print(f'>> Making Embiggen tiles in batches of up to {batch_size}')
 
-                emb_tile_store.append(tile_results[0][0])
-                # DEBUG (but, also has other uses), worth saving if you want tiles without a transparency overlap to manually composite
-                # emb_tile_store[-1].save(init_img[0:-4] + f'_emb_To{tile}.png')
-                del newinitimage
+            outputsuperimage = Image.new(
+                "RGBA", (initsuperwidth, initsuperheight))
+            if embiggen_tiles:
+                outputsuperimage.alpha_composite(
+                    initsuperimage.convert('RGBA'), (0, 0))
 
-            # Sanity check we have them all
-            if len(emb_tile_store) == (emb_tiles_x * emb_tiles_y) or (embiggen_tiles != [] and len(emb_tile_store) == len(embiggen_tiles)):
-                outputsuperimage = Image.new(
-                    "RGBA", (initsuperwidth, initsuperheight))
-                if embiggen_tiles:
-                    outputsuperimage.alpha_composite(
-                        initsuperimage.convert('RGBA'), (0, 0))
-                for tile in range(emb_tiles_x * emb_tiles_y):
-                    if embiggen_tiles:
-                        if tile in embiggen_tiles:
-                            intileimage = emb_tile_store.pop(0)
-                        else:
-                            continue
-                    else:
-                        intileimage = emb_tile_store[tile]
-                    intileimage = intileimage.convert('RGBA')
+            for start in range(0, len(tiles), batch_size):
+                batch = tiles[start:start + batch_size]
+                newinitimages = []
+                for tile, seed in batch:
                     # Get row and column entries
                     emb_row_i = tile // emb_tiles_x
                     emb_column_i = tile % emb_tiles_x
-                    if emb_row_i == 0 and emb_column_i == 0 and not embiggen_tiles:
-                        left = 0
-                        top = 0
+                    # Determine bounds to cut up the init image
+                    # Determine upper-left point
+                    if emb_column_i + 1 == emb_tiles_x:
+                        left = initsuperwidth - width
                     else:
-                        # Determine upper-left point
-                        if emb_column_i + 1 == emb_tiles_x:
-                            left = initsuperwidth - width
-                        else:
-                            left = round(emb_column_i *
-                                         (width - overlap_size_x))
-                        if emb_row_i + 1 == emb_tiles_y:
-                            top = initsuperheight - height
-                        else:
-                            top = round(emb_row_i * (height - overlap_size_y))
-                        # Handle gradients for various conditions
-                        # Handle emb_rerun case
-                        if embiggen_tiles:
-                            # top of image
-                            if emb_row_i == 0:
-                                if emb_column_i == 0:
-                                    if (tile+1) in embiggen_tiles:  # Look-ahead right
-                                        if (tile+emb_tiles_x) not in embiggen_tiles:  # Look-ahead down
-                                            intileimage.putalpha(alphaLayerB)
-                                        # Otherwise do nothing on this tile
-                                    elif (tile+emb_tiles_x) in embiggen_tiles:  # Look-ahead down only
-                                        intileimage.putalpha(alphaLayerR)
-                                    else:
-                                        intileimage.putalpha(alphaLayerRBC)
-                                elif emb_column_i == emb_tiles_x - 1:
-                                    if (tile+emb_tiles_x) in embiggen_tiles:  # Look-ahead down
-                                        intileimage.putalpha(alphaLayerL)
-                                    else:
-                                        intileimage.putalpha(alphaLayerLBC)
-                                else:
-                                    if (tile+1) in embiggen_tiles:  # Look-ahead right
-                                        if (tile+emb_tiles_x) in embiggen_tiles:  # Look-ahead down
-                                            intileimage.putalpha(alphaLayerL)
-                                        else:
-                                            intileimage.putalpha(alphaLayerLBC)
-                                    elif (tile+emb_tiles_x) in embiggen_tiles:  # Look-ahead down only
-                                        intileimage.putalpha(alphaLayerLR)
-                                    else:
-                                        intileimage.putalpha(alphaLayerABT)
-                            # bottom of image
-                            elif emb_row_i == emb_tiles_y - 1:
-                                if emb_column_i == 0:
-                                    if (tile+1) in embiggen_tiles: # Look-ahead right
-                                        intileimage.putalpha(alphaLayerTaC)
-                                    else:
-                                        intileimage.putalpha(alphaLayerRTC)
-                                elif emb_column_i == emb_tiles_x - 1:
-                                    # No tiles to look ahead to
-                                    intileimage.putalpha(alphaLayerLTC)
-                                else:
-                                    if (tile+1) in embiggen_tiles: # Look-ahead right
-                                        intileimage.putalpha(alphaLayerLTaC)
-                                    else:
-                                        intileimage.putalpha(alphaLayerABB)
-                            # vertical middle of image
-                            else:
-                                if emb_column_i == 0:
-                                    if (tile+1) in embiggen_tiles: # Look-ahead right
-                                        if (tile+emb_tiles_x) in embiggen_tiles: # Look-ahead down
-                                            intileimage.putalpha(alphaLayerTaC)
-                                        else:
-                                            intileimage.putalpha(alphaLayerTB)
-                                    elif (tile+emb_tiles_x) in embiggen_tiles:  # Look-ahead down only
-                                        intileimage.putalpha(alphaLayerRTC)
-                                    else:
-                                        intileimage.putalpha(alphaLayerABL)
-                                elif emb_column_i == emb_tiles_x - 1:
-                                    if (tile+emb_tiles_x) in embiggen_tiles:  # Look-ahead down
-                                        intileimage.putalpha(alphaLayerLTC)
-                                    else:
-                                        intileimage.putalpha(alphaLayerABR)
-                                else:
-                                    if (tile+1) in embiggen_tiles: # Look-ahead right
-                                        if (tile+emb_tiles_x) in embiggen_tiles: # Look-ahead down
-                                            intileimage.putalpha(alphaLayerLTaC)
-                                        else:
-                                            intileimage.putalpha(alphaLayerABR)
-                                    elif (tile+emb_tiles_x) in embiggen_tiles:  # Look-ahead down only
-                                        intileimage.putalpha(alphaLayerABB)
-                                    else:
-                                        intileimage.putalpha(alphaLayerAA)
-                        # Handle normal tiling case (much simpler - since we tile left to right, top to bottom)
-                        else:
-                            if emb_row_i == 0 and emb_column_i >= 1:
-                                intileimage.putalpha(alphaLayerL)
-                            elif emb_row_i >= 1 and emb_column_i == 0:
-                                if emb_column_i + 1 == emb_tiles_x: # If we don't have anything that can be placed to the right
-                                    intileimage.putalpha(alphaLayerT)
-                                else:
-                                    intileimage.putalpha(alphaLayerTaC)
-                            else:
-                                if emb_column_i + 1 == emb_tiles_x: # If we don't have anything that can be placed to the right
-                                    intileimage.putalpha(alphaLayerLTC)
-                                else:
-                                    intileimage.putalpha(alphaLayerLTaC)
-                    # Layer tile onto final image
-                    outputsuperimage.alpha_composite(intileimage, (left, top))
-            else:
-                print('Error: could not find all Embiggen output tiles in memory? Something must have gone wrong with img2img generation.')
+                        left = round(emb_column_i * (width - overlap_size_x))
+                    if emb_row_i + 1 == emb_tiles_y:
+                        top = initsuperheight - height
+                    else:
+                        top = round(emb_row_i * (height - overlap_size_y))
+                    right = left + width
+                    bottom = top + height
+
+                    # Cropped image of above dimension (does not modify the original)
+                    newinitimage = initsuperimage.crop((left, top, right, bottom))
+                    # DEBUG:
+                    # newinitimagepath = init_img[0:-4] + f'_emb_Ti{tile}.png'
+                    # newinitimage.save(newinitimagepath)
+
+                    if embiggen_tiles:
+                        print(
+                            f'Making tile #{tile + 1} ({embiggen_tiles.index(tile) + 1} of {len(embiggen_tiles)} requested)')
+                    else:
+                        print(
+                            f'Starting {tile + 1} of {(emb_tiles_x * emb_tiles_y)} tiles')
+
+                    # create a torch tensor from an Image
+                    newinitimage = np.array(
+                        newinitimage).astype(np.float32) / 255.0
+                    newinitimage = newinitimage[None].transpose(0, 3, 1, 2)
+                    newinitimage = torch.from_numpy(newinitimage)
+                    newinitimage = 2.0 * newinitimage - 1.0
+                    newinitimages.append(newinitimage.to(self.model.device))
+
+                if len(batch) > 1:
+                    tile_images = make_images(torch.cat(newinitimages), [seed for _, seed in batch])
+                else:
+                    tile_results = gen_img2img.generate(
+                        prompt,
+                        iterations     = 1,
+                        seed           = batch[0][1],
+                        sampler        = sampler,
+                        steps          = steps,
+                        cfg_scale      = cfg_scale,
+                        conditioning   = conditioning,
+                        ddim_eta       = ddim_eta,
+                        image_callback = None,  # called only after the final image is generated
+                        step_callback  = step_callback,   # called after each intermediate image is generated
+                        width          = width,
+                        height         = height,
+                        init_image     = newinitimages[0],    # notice that init_image is different from init_img
+                        mask_image     = None,
+                        strength       = strength,
+                    )
+                    tile_images = [tile_results[0][0]]
+                del newinitimages
+
+                for (tile, _), intileimage in zip(batch, tile_images):
+                    # DEBUG (but, also has other uses), worth saving if you want tiles without a transparency overlap to manually composite
+                    # intileimage.save(init_img[0:-4] + f'_emb_To{tile}.png')
+                    composite_tile(outputsuperimage, intileimage, tile)
 
             # after internal loops and patching up return Embiggen image
             return outputsuperimage
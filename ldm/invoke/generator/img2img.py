@@ -2,11 +2,16 @@
 ldm.invoke.generator.img2img descends from ldm.invoke.generator
 '''
 
+import dataclasses
+
+import PIL.Image
 import torch
 from diffusers import logging
+from pytorch_lightning import seed_everything
 
-from ldm.invoke.generator.base import Generator
-from ldm.invoke.generator.diffusers_pipeline import StableDiffusionGeneratorPipeline, ConditioningData
+from ldm.invoke.generator.base import Generator, scheduler_adds_noise_per_step
+from ldm.invoke.generator.diffusers_pipeline import StableDiffusionGeneratorPipeline, ConditioningData, \
+    PipelineIntermediateState, image_resized_to_grid_as_tensor
 from ldm.models.diffusion.shared_invokeai_diffusion import ThresholdSettings
 
 
@@ -36,6 +41,9 @@ class Img2Img(Generator):
                 threshold = ThresholdSettings(threshold, warmup=0.2) if threshold else None)
             .add_scheduler_args_if_applicable(pipeline.scheduler, eta=ddim_eta))
 
+        # resize once rather than for every iteration; the pipeline caches the encoding of the result
+        if isinstance(init_image, PIL.Image.Image):
+            init_image = image_resized_to_grid_as_tensor(init_image.convert('RGB'))
 
         def make_image(x_T):
             # FIXME: use x_T for initial seeded noise
@@ -53,6 +61,68 @@ class Img2Img(Generator):
 
         return make_image
 
+    @torch.no_grad()
+    def get_make_images_from_init_images(self,prompt,sampler,steps,cfg_scale,ddim_eta,
+                                         conditioning,strength,width,height,step_callback=None,
+                                         **kwargs):
+        """
+        Returns a function taking a batch of init image tensors (stacked along dim 0)
+        and the seed to use for each, which denoises them together in one pass through
+        the UNet and returns a list of images. Each image comes out as generate() would
+        make it from its init image and seed alone. Returns None if the conditioning
+        cannot be batched.
+        """
+        uc, c, extra_conditioning_info = conditioning
+        if not isinstance(c, torch.Tensor) \
+                or (extra_conditioning_info is not None and extra_conditioning_info.wants_cross_attention_control):
+            # hybrid conditioning and cross-attention control are set up for a batch of one
+            return None
+        if scheduler_adds_noise_per_step(sampler, ddim_eta):
+            # the per-step noise would be drawn for the whole batch after the last seed
+            return None
+
+        self.perlin = 0.0
+
+        # noinspection PyTypeChecker
+        pipeline: StableDiffusionGeneratorPipeline = self.model
+        pipeline.scheduler = sampler
+
+        def preview_first_in_batch(state: PipelineIntermediateState):
+            # progress callbacks expect the latents of a single image
+            predicted_original = state.predicted_original
+            if predicted_original is not None:
+                predicted_original = predicted_original[:1]
+            step_callback(dataclasses.replace(state, latents=state.latents[:1],
+                                              predicted_original=predicted_original))
+
+        def make_images(init_images, seeds) -> list[PIL.Image.Image]:
+            device = pipeline.unet.device
+            latents_dtype = pipeline.unet.dtype
+            initial_latents = []
+            noises = []
+            for init_image, seed in zip(init_images, seeds):
+                # draw from the RNG in the same order as generate() and make_image() do
+                seed_everything(seed)
+                self.get_noise(width, height)
+                latents = pipeline.non_noised_latents_from_image(init_image[None], device=device, dtype=latents_dtype)
+                initial_latents.append(latents)
+                noises.append(self.get_noise_like(latents))
+
+            batch_size = len(seeds)
+            conditioning_data = (
+                ConditioningData(
+                    uc.expand(batch_size, -1, -1), c.expand(batch_size, -1, -1),
+                    cfg_scale, extra_conditioning_info)
+                .add_scheduler_args_if_applicable(pipeline.scheduler, eta=ddim_eta))
+            logging.set_verbosity_error()   # quench safety check warnings
+            pipeline_output = pipeline.img2img_from_latents_and_embeddings(
+                torch.cat(initial_latents), steps, conditioning_data, strength, torch.cat(noises),
+                callback=preview_first_in_batch if step_callback is not None else None,
+            )
+            return pipeline.numpy_to_pil(pipeline_output.images)
+
+        return make_images
+
     def get_noise_like(self, like: torch.Tensor):
         device = like.device
         if device.type == 'mps':
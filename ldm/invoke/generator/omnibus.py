@@ -15,6 +15,10 @@ class Omnibus(Img2Img,Txt2Img):
         self.pil_mask = None
         self.pil_image = None
 
+    def get_make_images(self, prompt, **kwargs):
+        # the batched path inherited from Txt2Img knows nothing about masks and init images
+        return None
+
     def get_make_image(
             self,
             prompt,
@@ -1,11 +1,13 @@
 '''
 ldm.invoke.generator.txt2img inherits from ldm.invoke.generator
 '''
+import dataclasses
+
 import PIL.Image
 import torch
 
-from .base import Generator
-from .diffusers_pipeline import StableDiffusionGeneratorPipeline, ConditioningData
+from .base import Generator, scheduler_adds_noise_per_step
+from .diffusers_pipeline import StableDiffusionGeneratorPipeline, ConditioningData, PipelineIntermediateState
 from ...models.diffusion.shared_invokeai_diffusion import ThresholdSettings
 
 
@@ -50,6 +52,61 @@ class Txt2Img(Generator):
 
         return make_image
 
+    @torch.no_grad()
+    def get_make_images(self,prompt,sampler,steps,cfg_scale,ddim_eta,
+                        conditioning,width,height,step_callback=None,threshold=0.0,perlin=0.0,
+                        attention_maps_callback=None,
+                        **kwargs):
+        """
+        Returns a function that denoises a whole batch of seeds in one pass through the UNet
+        and decodes them together, or None if the conditioning cannot be batched.
+        """
+        uc, c, extra_conditioning_info = conditioning
+        if not isinstance(c, torch.Tensor) \
+                or (extra_conditioning_info is not None and extra_conditioning_info.wants_cross_attention_control):
+            # hybrid conditioning and cross-attention control are set up for a batch of one
+            return None
+        if threshold:
+            # thresholding looks at the min/max of the whole batch, which would make results
+            # depend on the other seeds in the batch
+            return None
+        if scheduler_adds_noise_per_step(sampler, ddim_eta):
+            # the per-step noise would be drawn for the whole batch after the last seed
+            return None
+
+        self.perlin = perlin
+
+        # noinspection PyTypeChecker
+        pipeline: StableDiffusionGeneratorPipeline = self.model
+        pipeline.scheduler = sampler
+
+        def preview_first_in_batch(state: PipelineIntermediateState):
+            # progress callbacks expect the latents of a single image
+            predicted_original = state.predicted_original
+            if predicted_original is not None:
+                predicted_original = predicted_original[:1]
+            step_callback(dataclasses.replace(state, latents=state.latents[:1],
+                                              predicted_original=predicted_original))
+
+        def make_images(x_T) -> list[PIL.Image.Image]:
+            batch_size = x_T.shape[0]
+            conditioning_data = (
+                ConditioningData(
+                    uc.expand(batch_size, -1, -1), c.expand(batch_size, -1, -1),
+                    cfg_scale, extra_conditioning_info)
+                .add_scheduler_args_if_applicable(pipeline.scheduler, eta=ddim_eta))
+            pipeline_output = pipeline.image_from_embeddings(
+                latents=torch.zeros_like(x_T,dtype=self.torch_dtype()),
+                noise=x_T,
+                num_inference_steps=steps,
+                conditioning_data=conditioning_data,
+                callback=preview_first_in_batch if step_callback is not None else None,
+            )
+            if pipeline_output.attention_map_saver is not None and attention_maps_callback is not None:
+                attention_maps_callback(pipeline_output.attention_map_saver)
+            return pipeline.numpy_to_pil(pipeline_output.images)
+
+        return make_images
 
     # returns a tensor filled with random numbers from a normal distribution
     def get_noise(self,width,height):
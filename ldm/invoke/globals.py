@@ -9,6 +9,8 @@ the attributes:
   - initfile       - path to the initialization file
   - try_patchmatch - option to globally disable loading of 'patchmatch' module
   - always_use_cpu - force use of CPU even if GPU is available
+  - vae_tile_size  - size in pixels of the tiles large images are VAE encoded and decoded in
+  - vae_tiling_threshold - size in megapixels above which images are VAE encoded and decoded in tiles
 '''
 
 import os
@@ -33,6 +35,7 @@ Globals.models_file = 'models.yaml'
 Globals.models_dir = 'models'
 Globals.config_dir = 'configs'
 Globals.autoscan_dir = 'weights'
+Globals.database_dir = 'databases'
 
 # Try loading patchmatch
 Globals.try_patchmatch = True
@@ -50,6 +53,10 @@ Globals.disable_xformers = False
 # whether we are forcing full precision
 Globals.full_precision = False
 
+# Encode and decode images larger than this many megapixels in tiles of this many pixels (0 to never tile)
+Globals.vae_tiling_threshold = 2.0
+Globals.vae_tile_size = 512
+
 def global_config_file()->Path:
     return Path(Globals.root, Globals.config_dir, Globals.models_file)
 
@@ -62,6 +69,9 @@ def global_models_dir()->Path:
 def global_autoscan_dir()->Path:
     return Path(Globals.root, Globals.autoscan_dir)
 
+def global_database_dir()->Path:
+    return Path(Globals.root, Globals.database_dir)
+
 def global_set_root(root_dir:Union[str,Path]):
     Globals.root = root_dir
 
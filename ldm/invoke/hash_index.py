@@ -0,0 +1,152 @@
+'''
+ldm.invoke.hash_index keeps a persistent index of the sha256 content
+hashes of model files, so that they do not have to be rehashed every
+time a model is loaded or imported.
+
+The index is a small SQLite database under the InvokeAI root directory
+rather than a set of sidecar files next to the models, so it works with
+read-only and shared model stores. Each entry is keyed on the file's
+path, size, modification time and inode, and is recomputed whenever
+any of these change.
+
+Useful class exports:
+
+ModelHashIndex - look up or compute the hash of a weights file or of a
+                 diffusers model directory
+'''
+from __future__ import annotations
+
+import hashlib
+import os
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+from pathlib import Path
+from typing import Optional, Union
+
+from ldm.invoke.globals import global_database_dir
+
+HASH_CHUNK_SIZE = 16 * 1024 * 1024
+DEFAULT_HASH_WORKERS = min(8, os.cpu_count() or 1)
+
+class ModelHashIndex(object):
+    def __init__(self, db_path:Union[str,Path]=None, max_workers:int=DEFAULT_HASH_WORKERS):
+        '''
+        Open (creating if necessary) the hash index stored at db_path, which
+        defaults to model_hashes.db in the InvokeAI databases directory.
+        max_workers is the number of files that will be hashed in parallel.
+        '''
+        self.db_path = Path(db_path or global_database_dir() / 'model_hashes.db')
+        self.max_workers = max_workers
+        self._lock = threading.Lock()
+        self._writable = True
+        try:
+            self.db_path.parent.mkdir(parents=True, exist_ok=True)
+            with closing(self._connect()) as conn, conn:
+                conn.execute(
+                    '''CREATE TABLE IF NOT EXISTS file_hashes (
+                         path TEXT PRIMARY KEY,
+                         size INTEGER NOT NULL,
+                         mtime_ns INTEGER NOT NULL,
+                         inode INTEGER NOT NULL,
+                         sha256 TEXT NOT NULL
+                       )'''
+                )
+        except (OSError, sqlite3.Error) as e:
+            print(f'** Could not open the model hash index at {self.db_path}: {str(e)}. Hashes will not be cached.')
+            self._writable = False
+
+    def lookup(self, path:Union[str,Path]) -> Optional[str]:
+        '''
+        Return the indexed sha256 of the file at path, or None if the file
+        has not been hashed yet or has changed since. Only stat()s the file.
+        '''
+        if not self._writable:
+            return None
+        path = os.path.realpath(path)
+        key = self._key(os.stat(path))
+        with closing(self._connect()) as conn:
+            row = conn.execute(
+                'SELECT size, mtime_ns, inode, sha256 FROM file_hashes WHERE path=?', (path,)
+            ).fetchone()
+        if row is None or tuple(row[:3]) != key:
+            return None
+        return row[3]
+
+    def file_hash(self, path:Union[str,Path]) -> str:
+        '''
+        Return the sha256 of the file at path, computing and indexing it if needed.
+        '''
+        return self.lookup(path) or self._hash_and_index(path)
+
+    def directory_hash(self, path:Union[str,Path], ignore:tuple[str, ...]=()) -> str:
+        '''
+        Return a hash of the names and content of all the files under the
+        directory at path. Files that are not in the index are hashed in
+        parallel. Files reached through more than one name (e.g. the
+        symlinks in a HuggingFace cache snapshot) only count once, under
+        the first of their names in sorted order.
+
+        This is not the hash older versions computed by reading all the
+        files in one stream, which depended on the order os.walk() listed
+        them in. ModelManager keeps reporting those hashes for models that
+        already have one recorded in a checksum.sha256 file.
+        '''
+        files = dict()   # real path -> name relative to path
+        for root, dirs, names in os.walk(path, followlinks=False):
+            for name in names:
+                if name in ignore:
+                    continue
+                file = os.path.join(root, name)
+                relative_name = Path(file).relative_to(path).as_posix()
+                real_path = os.path.realpath(file)
+                if real_path not in files or relative_name < files[real_path]:
+                    files[real_path] = relative_name
+
+        hashes = dict()
+        missing = list()
+        for file in sorted(files):
+            if (hash := self.lookup(file)):
+                hashes[file] = hash
+            else:
+                missing.append(file)
+
+        if missing:
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                hashes.update(zip(missing, executor.map(self._hash_and_index, missing)))
+
+        sha = hashlib.sha256()
+        for real_path, relative_name in sorted(files.items(), key=lambda item: item[1]):
+            sha.update(f'{relative_name}\0{hashes[real_path]}\n'.encode('utf-8'))
+        return sha.hexdigest()
+
+    def _hash_and_index(self, path:Union[str,Path]) -> str:
+        path = os.path.realpath(path)
+        before = os.stat(path)
+        sha = hashlib.sha256()
+        with open(path, 'rb') as f:
+            while chunk := f.read(HASH_CHUNK_SIZE):
+                sha.update(chunk)
+        hash = sha.hexdigest()
+
+        # don't index a file that was modified while we were reading it
+        key = self._key(before)
+        if not self._writable or key != self._key(os.stat(path)):
+            return hash
+        try:
+            with self._lock, closing(self._connect()) as conn, conn:
+                conn.execute(
+                    'INSERT OR REPLACE INTO file_hashes (path, size, mtime_ns, inode, sha256) VALUES (?,?,?,?,?)',
+                    (path, *key, hash),
+                )
+        except sqlite3.Error as e:
+            print(f'** Could not update the model hash index: {str(e)}')
+        return hash
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.db_path, timeout=30)
+
+    @staticmethod
+    def _key(stat:os.stat_result) -> tuple[int, int, int]:
+        return (stat.st_size, stat.st_mtime_ns, stat.st_ino)
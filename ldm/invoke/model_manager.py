@@ -8,11 +8,12 @@ from __future__ import annotations
 
 import contextlib
 import gc
-import hashlib
-import io
+import inspect
+import itertools
 import os
 import sys
 import textwrap
+import threading
 import time
 import traceback
 import warnings
@@ -34,9 +35,12 @@ from picklescan.scanner import scan_file_path
 
 from ldm.invoke.generator.diffusers_pipeline import StableDiffusionGeneratorPipeline
 from ldm.invoke.globals import Globals, global_models_dir, global_autoscan_dir, global_cache_dir
+from ldm.invoke.hash_index import ModelHashIndex
 from ldm.util import instantiate_from_config, ask_user
 
 DEFAULT_MAX_MODELS=2
+LEGACY_DIRECTORY_CHECKSUM='checksum.sha256'   # where older versions recorded the hash of a diffusers model
+GIG=1024 * 1024 * 1024
 VAE_TO_REPO_ID = { # hack, see note in convert_and_import()
     'vae-ft-mse-840000-ema-pruned':  'stabilityai/sd-vae-ft-mse',
     }
@@ -46,13 +50,19 @@ class ModelManager(object):
                  config:OmegaConf,
                  device_type:str='cpu',
                  precision:str='float16',
-                 max_loaded_models=DEFAULT_MAX_MODELS):
+                 max_loaded_models=DEFAULT_MAX_MODELS,
+                 max_cache_size:float=None,
+                 max_vram_cache_size:float=0):
         '''
         Initialize with the path to the models.yaml config file,
-        the torch device type, and precision. The optional
-        min_avail_mem argument specifies how much unused system
-        (CPU) memory to preserve. The cache of models in RAM will
-        grow until this value is approached. Default is 2G.
+        the torch device type, and precision. The cache of models
+        is limited to max_loaded_models entries. In addition,
+        max_cache_size (in GB) limits the system RAM used by the
+        models parked on the CPU, and max_vram_cache_size (in GB)
+        allows recently-used models to stay in VRAM when they are
+        not the active model. When a limit is reached, the least
+        recently used model is moved to the CPU or evicted, and
+        will be loaded from disk when next needed.
         '''
         # prevent nasty-looking CLIP log message
         transformers.logging.set_verbosity_error()
@@ -60,9 +70,18 @@ class ModelManager(object):
         self.precision = precision
         self.device = torch.device(device_type)
         self.max_loaded_models = max_loaded_models
+        self.max_cache_bytes = None if max_cache_size is None else int(max_cache_size * GIG)
+        self.max_vram_cache_bytes = int((max_vram_cache_size or 0) * GIG)
         self.models = {}
         self.stack = []  # this is an LRU FIFO
         self.current_model = None
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.cache_evictions = 0
+        self.hash_index = ModelHashIndex()
+        self._prefetch_lock = threading.Lock()
+        self._prefetch_threads = {}  # model name -> thread loading it in the background
+        self._prefetched = {}        # model name -> cache entry waiting to be claimed by get_model()
 
     def valid_model(self, model_name:str)->bool:
         '''
@@ -82,29 +101,45 @@ class ModelManager(object):
             return self.current_model
 
         if self.current_model != model_name:
+            prefetched = self._claim_prefetched_model(model_name)
             if model_name not in self.models: # make room for a new one
                 self._make_cache_room()
-            self.offload_model(self.current_model)
+            self._deactivate_model(self.current_model)
+            if prefetched is not None:
+                self.models[model_name] = prefetched
 
         if model_name in self.models:
-            requested_model = self.models[model_name]['model']
-            print(f'>> Retrieving model {model_name} from system RAM cache')
-            self.models[model_name]['model'] = self._model_from_cpu(requested_model)
-            width = self.models[model_name]['width']
-            height = self.models[model_name]['height']
-            hash = self.models[model_name]['hash']
+            self.cache_hits += 1
+            cached = self.models[model_name]
+            requested_model = cached['model']
+            if cached['location'] == 'cpu':
+                print(f'>> Retrieving model {model_name} from system RAM cache')
+                cached['model'] = requested_model = self._model_from_cpu(requested_model)
+                cached['location'] = self._active_location()
+            else:
+                print(f'>> Retrieving model {model_name} from VRAM cache')
+            width = cached['width']
+            height = cached['height']
+            hash = cached['hash']
 
         else: # we're about to load a new model, so potentially offload the least recently used one
+            self.cache_misses += 1
+            # the model we just deactivated may now be taking up system RAM
+            self._make_cache_room()
             requested_model, width, height, hash = self._load_model(model_name)
             self.models[model_name] = {
                 'model': requested_model,
                 'width': width,
                 'height': height,
                 'hash': hash,
+                'size': self._model_size(requested_model),
+                'location': self._active_location(),
             }
 
         self.current_model = model_name
         self._push_newest_model(model_name)
+        # when running on the CPU the active model counts against the RAM budget too
+        self._make_cache_room(incoming=0, keep=model_name)
         return {
             'model':requested_model,
             'width':width,
@@ -112,6 +147,61 @@ class ModelManager(object):
             'hash': hash
         }
 
+    def prefetch(self, model_name:str) -> bool:
+        '''
+        Start loading the named model into the system RAM cache on a
+        background thread, while the current model keeps working. A
+        subsequent get_model() will wait for the load to finish if
+        necessary, and then only has to move the model to the device.
+        Returns True if a background load was started. Prefetched models
+        count against max_loaded_models and max_cache_size.
+        '''
+        if not self.valid_model(model_name) or model_name in self.models:
+            return False
+        with self._prefetch_lock:
+            if model_name in self._prefetch_threads or model_name in self._prefetched:
+                return False
+        self._make_cache_room(keep=self.current_model)
+        if len(self.models) + self._pending_count() >= self.max_loaded_models:
+            print(f'>> No room in the model cache to load {model_name} in the background')
+            return False
+        with self._prefetch_lock:
+            thread = threading.Thread(
+                target=self._prefetch_model,
+                args=(model_name,),
+                name=f'prefetch-{model_name}',
+                daemon=True,
+            )
+            self._prefetch_threads[model_name] = thread
+        print(f'>> Loading {model_name} into system RAM in the background')
+        thread.start()
+        return True
+
+    def is_prefetching(self, model_name:str) -> bool:
+        '''
+        Return True if the named model is still being loaded in the background.
+        '''
+        with self._prefetch_lock:
+            return model_name in self._prefetch_threads
+
+    def cache_stats(self) -> dict:
+        '''
+        Return a dict of model cache statistics: hit, miss and eviction
+        counters, and the bytes of model parameters currently held in
+        system RAM and on the device, alongside the configured budgets.
+        '''
+        return {
+            'hits': self.cache_hits,
+            'misses': self.cache_misses,
+            'evictions': self.cache_evictions,
+            'models': len(self.models),
+            'max_models': self.max_loaded_models,
+            'ram_bytes': self._cache_bytes('cpu'),
+            'max_ram_bytes': self.max_cache_bytes,
+            'vram_bytes': self._cache_bytes('device'),
+            'max_vram_cache_bytes': self.max_vram_cache_bytes,
+        }
+
     def default_model(self) -> str | None:
         '''
         Returns the name of the default model, or None
@@ -234,6 +324,12 @@ class ModelManager(object):
             if models[name]['status'] == 'active':
                 line = f'\033[1m{line}\033[0m'
             print(line)
+        stats = self.cache_stats()
+        print(
+            f'>> Model cache: {stats["hits"]} hits, {stats["misses"]} misses, {stats["evictions"]} evictions;',
+            '%4.2fG in RAM,' % (stats['ram_bytes'] / GIG),
+            '%4.2fG cached in VRAM' % (stats['vram_bytes'] / GIG),
+        )
 
     def del_model(self, model_name:str, delete_files:bool=False) -> None:
         '''
@@ -290,16 +386,18 @@ class ModelManager(object):
         if clobber:
             self._invalidate_cached_model(model_name)
 
-    def _load_model(self, model_name:str):
-        """Load and initialize the model from configuration variables passed at object creation time"""
+    def _load_model(self, model_name:str, device:torch.device=None, scanned:bool=False):
+        """Load and initialize the model from configuration variables passed at object creation time.
+        Pass scanned=True if the weights have already been found safe by the picklescanner."""
         if model_name not in self.config:
             print(f'"{model_name}" is not a known model name. Please check your models.yaml file')
             return
 
         mconfig = self.config[model_name]
+        device = device or self.device
 
         # for usage statistics
-        if self._has_cuda():
+        if device.type == 'cuda':
             torch.cuda.reset_peak_memory_stats()
             torch.cuda.empty_cache()
 
@@ -310,18 +408,18 @@ class ModelManager(object):
         if model_format == 'ckpt':
             weights = mconfig.weights
             print(f'>> Loading {model_name} from {weights}')
-            model, width, height, model_hash = self._load_ckpt_model(model_name, mconfig)
+            model, width, height, model_hash = self._load_ckpt_model(model_name, mconfig, device, scanned)
         elif model_format == 'diffusers':
             with warnings.catch_warnings():
                 warnings.simplefilter('ignore')
-                model, width, height, model_hash = self._load_diffusers_model(mconfig)
+                model, width, height, model_hash = self._load_diffusers_model(mconfig, device)
         else:
             raise NotImplementedError(f"Unknown model format {model_name}: {model_format}")
 
         # usage statistics
         toc = time.time()
         print('>> Model loaded in', '%4.2fs' % (toc - tic))
-        if self._has_cuda():
+        if device.type == 'cuda':
             print(
                 '>> Max VRAM used to load the model:',
                 '%4.2fG' % (torch.cuda.max_memory_allocated() / 1e9),
@@ -330,7 +428,7 @@ class ModelManager(object):
             )
         return model, width, height, model_hash
 
-    def _load_ckpt_model(self, model_name, mconfig):
+    def _load_ckpt_model(self, model_name, mconfig, device:torch.device, scanned:bool=False):
         config = mconfig.config
         weights = mconfig.weights
         vae = mconfig.get('vae')
@@ -342,12 +440,13 @@ class ModelManager(object):
         if not os.path.isabs(weights):
             weights = os.path.normpath(os.path.join(Globals.root,weights))
         # scan model
-        self.scan_model(model_name, weights)
+        if not scanned:
+            self.scan_model(model_name, weights)
 
         print(f'>> Loading {model_name} from {weights}')
 
         # for usage statistics
-        if self._has_cuda():
+        if device.type == 'cuda':
             torch.cuda.reset_peak_memory_stats()
             torch.cuda.empty_cache()
 
@@ -357,15 +456,8 @@ class ModelManager(object):
         if not os.path.isabs(config):
             config = os.path.join(Globals.root,config)
         omega_config = OmegaConf.load(config)
-        with open(weights,'rb') as f:
-            weight_bytes = f.read()
-        model_hash = self._cached_sha256(weights, weight_bytes)
-        sd = None
-        if weights.endswith('.safetensors'):
-            sd = safetensors.torch.load(weight_bytes)
-        else:
-            sd = torch.load(io.BytesIO(weight_bytes), map_location='cpu')
-        del weight_bytes
+        model_hash = self._cached_sha256(weights)
+        sd = self._load_weights_file(weights)
         # merged models from auto11 merge board are flat for some reason
         if 'state_dict' in sd:
             sd = sd['state_dict']
@@ -374,6 +466,7 @@ class ModelManager(object):
         gc.collect()
         model = instantiate_from_config(omega_config.model)
         model.load_state_dict(sd, strict=False)
+        del sd
 
         if self.precision == 'float16':
             print('   | Using faster float16 precision')
@@ -389,19 +482,17 @@ class ModelManager(object):
                 print(f'   | Loading VAE weights from: {vae}')
                 vae_ckpt = None
                 vae_dict = None
-                if vae.endswith('.safetensors'):
-                    vae_ckpt = safetensors.torch.load_file(vae)
-                    vae_dict = {k: v for k, v in vae_ckpt.items() if k[0:4] != "loss"}
-                else:
-                    vae_ckpt = torch.load(vae, map_location="cpu")
-                    vae_dict = {k: v for k, v in vae_ckpt['state_dict'].items() if k[0:4] != "loss"}
+                vae_ckpt = self._load_weights_file(vae)
+                if not vae.endswith('.safetensors'):
+                    vae_ckpt = vae_ckpt['state_dict']
+                vae_dict = {k: v for k, v in vae_ckpt.items() if k[0:4] != "loss"}
                 model.first_stage_model.load_state_dict(vae_dict, strict=False)
             else:
                 print(f'   | VAE file {vae} not found. Skipping.')
 
-        model.to(self.device)
+        model.to(device)
         # model.to doesn't change the cond_stage_model.device used to move the tokenizer output, so set it here
-        model.cond_stage_model.device = self.device
+        model.cond_stage_model.device = device
 
         model.eval()
 
@@ -413,7 +504,7 @@ class ModelManager(object):
         toc = time.time()
         print('>> Model loaded in', '%4.2fs' % (toc - tic))
 
-        if self._has_cuda():
+        if device.type == 'cuda':
             print(
                 '>> Max VRAM used to load the model:',
                 '%4.2fG' % (torch.cuda.max_memory_allocated() / 1e9),
@@ -423,7 +514,7 @@ class ModelManager(object):
 
         return model, width, height, model_hash
 
-    def _load_diffusers_model(self, mconfig):
+    def _load_diffusers_model(self, mconfig, device:torch.device):
         name_or_path = self.model_name_or_path(mconfig)
         using_fp16 = self.precision == 'float16'
 
@@ -472,7 +563,7 @@ class ModelManager(object):
         dlogging.set_verbosity(verbosity)
         assert pipeline is not None, OSError(f'"{name_or_path}" could not be loaded')
 
-        pipeline.to(self.device)
+        pipeline.to(device)
 
         model_hash = self._diffuser_sha256(name_or_path)
 
@@ -513,6 +604,7 @@ class ModelManager(object):
         print(f'>> Offloading {model_name} to CPU')
         model = self.models[model_name]['model']
         self.models[model_name]['model'] = self._model_to_cpu(model)
+        self.models[model_name]['location'] = 'cpu'
 
         gc.collect()
         if self._has_cuda():
@@ -743,14 +835,168 @@ class ModelManager(object):
 
         return search_folder, found_models
 
-    def _make_cache_room(self) -> None:
-        num_loaded_models = len(self.models)
-        if num_loaded_models >= self.max_loaded_models:
-            least_recent_model = self._pop_oldest_model()
-            print(f'>> Cache limit (max={self.max_loaded_models}) reached. Purging {least_recent_model}')
-            if least_recent_model is not None:
-                del self.models[least_recent_model]
-                gc.collect()
+    def _make_cache_room(self, incoming:int=1, keep:str=None) -> None:
+        '''
+        Evict least recently used models until there is room for `incoming`
+        more models under max_loaded_models, and the models held in system
+        RAM fit within max_cache_size. Only models held in system RAM are
+        evicted to free RAM. Models that are being, or have been,
+        prefetched count against both limits; they are only discarded once
+        there are no cached models left to evict. The model named by `keep`
+        is never evicted.
+        '''
+        while True:
+            over_count = len(self.models) + self._pending_count() + incoming > self.max_loaded_models
+            over_ram = self.max_cache_bytes is not None and \
+                self._cache_bytes('cpu') + self._prefetched_bytes() > self.max_cache_bytes
+            if not (over_count or over_ram):
+                break
+            candidates = [
+                x for x in self.stack
+                if x != keep and (over_count or self.models.get(x, {}).get('location') == 'cpu')
+            ]
+            if not candidates:
+                if not self._discard_prefetched_model(keep):
+                    break
+                continue
+            least_recent_model = candidates[0]
+            self.stack.remove(least_recent_model)
+            if over_count:
+                print(f'>> Cache limit (max={self.max_loaded_models}) reached. Purging {least_recent_model}')
+            else:
+                print(f'>> RAM cache limit (max={self.max_cache_bytes/GIG:4.2f}G) reached. Purging {least_recent_model}')
+            if self.models.pop(least_recent_model, None) is not None:
+                self.cache_evictions += 1
+                if least_recent_model == self.current_model:
+                    self.current_model = None
+            gc.collect()
+
+    def _prefetch_model(self, model_name:str) -> None:
+        cached = None
+        try:
+            mconfig = self.config[model_name]
+            if mconfig.get('format', 'ckpt') == 'ckpt':
+                # scan_model() may need to ask the user what to do, which we can't do from here
+                weights = str(self._abs_path(mconfig.weights))
+                if scan_file_path(weights).infected_files != 0:
+                    print(f'** {model_name} could not be verified as safe; it will be loaded when it is selected')
+                    return
+                print(f'>> Model {model_name} scanned ok!')
+            model, width, height, hash = self._load_model(model_name, device=torch.device('cpu'), scanned=True)
+            cached = {
+                'model': model,
+                'width': width,
+                'height': height,
+                'hash': hash,
+                'size': self._model_size(model),
+                'location': 'cpu',
+            }
+            if self.max_cache_bytes is not None and cached['size'] > self.max_cache_bytes:
+                print(f'>> {model_name} does not fit in the RAM cache (max={self.max_cache_bytes/GIG:4.2f}G); it will be loaded when it is selected')
+                cached = None
+                return
+            print(f'>> {model_name} is ready in system RAM')
+        except Exception as e:
+            print(f'** Background load of {model_name} failed: {str(e)}')
+        finally:
+            with self._prefetch_lock:
+                if cached is not None:
+                    self._prefetched[model_name] = cached
+                del self._prefetch_threads[model_name]
+
+    def _claim_prefetched_model(self, model_name:str) -> dict | None:
+        '''
+        Wait for any background load of the named model to finish, and return
+        its cache entry, or None if it was not prefetched.
+        '''
+        with self._prefetch_lock:
+            thread = self._prefetch_threads.get(model_name)
+        if thread is not None:
+            print(f'>> Waiting for the background load of {model_name} to finish')
+            thread.join()
+        with self._prefetch_lock:
+            return self._prefetched.pop(model_name, None)
+
+    def _pending_count(self) -> int:
+        '''
+        Return the number of models being loaded, or waiting to be claimed, by prefetch().
+        '''
+        with self._prefetch_lock:
+            return len(self._prefetch_threads.keys() | self._prefetched.keys())
+
+    def _prefetched_bytes(self) -> int:
+        with self._prefetch_lock:
+            return sum(cached['size'] for cached in self._prefetched.values())
+
+    def _discard_prefetched_model(self, keep:str=None) -> bool:
+        '''
+        Drop the oldest prefetched model other than `keep`. Returns False
+        if there was none.
+        '''
+        with self._prefetch_lock:
+            candidates = [x for x in self._prefetched if x != keep]
+            if not candidates:
+                return False
+            del self._prefetched[candidates[0]]
+        print(f'>> Model cache limit reached. Discarding the background load of {candidates[0]}')
+        self.cache_evictions += 1
+        gc.collect()
+        return True
+
+    def _deactivate_model(self, model_name:str) -> None:
+        '''
+        Called when the named model stops being the active one. If the
+        VRAM cache budget allows, the model stays on the device; older
+        models in the VRAM cache are moved to the CPU to make room for
+        it. Otherwise the model itself is offloaded to the CPU.
+        '''
+        if model_name not in self.models:
+            return
+        cached = self.models[model_name]
+        if cached['location'] != 'device':
+            return
+
+        if cached['size'] <= self.max_vram_cache_bytes:
+            for other_model in list(self.stack):
+                if self._cache_bytes('device') + cached['size'] <= self.max_vram_cache_bytes:
+                    break
+                if other_model != model_name and self.models.get(other_model, {}).get('location') == 'device':
+                    self.offload_model(other_model)
+            if self._cache_bytes('device') + cached['size'] <= self.max_vram_cache_bytes:
+                print(f'>> Keeping {model_name} in VRAM cache')
+                return
+
+        self.offload_model(model_name)
+
+    def _cache_bytes(self, location:str) -> int:
+        '''
+        Return the number of bytes of model parameters held in the given
+        location ('cpu' or 'device'), not counting the active model when
+        it is on the device.
+        '''
+        return sum(
+            cached['size'] for name, cached in self.models.items()
+            if cached['location'] == location and not (location == 'device' and name == self.current_model)
+        )
+
+    def _active_location(self) -> str:
+        return 'cpu' if self.device.type == 'cpu' else 'device'
+
+    @staticmethod
+    def _model_size(model) -> int:
+        '''
+        Return the number of bytes taken up by the parameters and buffers of
+        a legacy model or of all the torch modules of a diffusers pipeline.
+        '''
+        if isinstance(model, torch.nn.Module):
+            modules = [model]
+        else:
+            modules = [x for x in model.components.values() if isinstance(x, torch.nn.Module)]
+        return sum(
+            tensor.numel() * tensor.element_size()
+            for module in modules
+            for tensor in itertools.chain(module.parameters(), module.buffers())
+        )
 
     def print_vram_usage(self) -> None:
         if self._has_cuda:
@@ -870,6 +1116,8 @@ class ModelManager(object):
         if model_name in self.stack:
             self.stack.remove(model_name)
         self.models.pop(model_name,None)
+        with self._prefetch_lock:
+            self._prefetched.pop(model_name,None)
 
     def _model_to_cpu(self,model):
         if self.device == 'cpu':
@@ -904,14 +1152,6 @@ class ModelManager(object):
 
         return model
 
-    def _pop_oldest_model(self):
-        '''
-        Remove the first element of the FIFO, which ought
-        to be the least recently accessed model. Do not
-        pop the last one, because it is in active use!
-        '''
-        return self.stack.pop(0)
-
     def _push_newest_model(self,model_name:str) -> None:
         '''
         Maintain a simple FIFO. First element is always the
@@ -933,50 +1173,48 @@ class ModelManager(object):
             path = Path(global_cache_dir('diffusers') / f'models--{owner}--{repo}')
         if not path.exists():
             return None
-        hashpath = path / 'checksum.sha256'
+        # Keep reporting the hash recorded by older versions, which hashed the directory
+        # differently, so that model hashes already stored in image metadata stay valid.
+        # Models without a recorded hash (or modified since) get the hash index's format.
+        hashpath = path / LEGACY_DIRECTORY_CHECKSUM
         if hashpath.exists() and path.stat().st_mtime <= hashpath.stat().st_mtime:
             with open(hashpath) as f:
-                hash = f.read()
-            return hash
+                return f.read()
         print('  | Calculating sha256 hash of model files')
         tic = time.time()
-        sha = hashlib.sha256()
-        count = 0
-        for root, dirs, files in os.walk(path, followlinks=False):
-            for name in files:
-                count += 1
-                with open(os.path.join(root,name),'rb') as f:
-                    sha.update(f.read())
-        hash = sha.hexdigest()
+        hash = self.hash_index.directory_hash(path, ignore=(LEGACY_DIRECTORY_CHECKSUM,))
         toc = time.time()
-        print(f'  | sha256 = {hash} ({count} files hashed in','%4.2fs)' % (toc - tic))
-        with open(hashpath,'w') as f:
-            f.write(hash)
+        print(f'  | sha256 = {hash}','(%4.2fs)' % (toc - tic))
         return hash
 
-    def _cached_sha256(self,path,data) -> Union[str, bytes]:
-        dirname    = os.path.dirname(path)
-        basename   = os.path.basename(path)
-        base, _    = os.path.splitext(basename)
-        hashpath   = os.path.join(dirname,base+'.sha256')
-
-        if os.path.exists(hashpath) and os.path.getmtime(path) <= os.path.getmtime(hashpath):
-            with open(hashpath) as f:
-                hash = f.read()
+    def _cached_sha256(self,path) -> Union[str, bytes]:
+        if (hash := self.hash_index.lookup(path)):
             return hash
 
         print('   | Calculating sha256 hash of weights file')
         tic = time.time()
-        sha = hashlib.sha256()
-        sha.update(data)
-        hash = sha.hexdigest()
+        hash = self.hash_index.file_hash(path)
         toc = time.time()
         print(f'>> sha256 = {hash}','(%4.2fs)' % (toc - tic))
-
-        with open(hashpath,'w') as f:
-            f.write(hash)
         return hash
 
+    @staticmethod
+    def _load_weights_file(path:str) -> dict:
+        '''
+        Load a .ckpt or .safetensors file into a state dict without first
+        reading the whole file into memory. Where the file format and the
+        installed torch allow it, the tensors are memory-mapped rather than
+        copied, so they are paged in only while load_state_dict() needs them.
+        '''
+        if path.endswith('.safetensors'):
+            return safetensors.torch.load_file(path, device='cpu')
+        if 'mmap' in inspect.signature(torch.load).parameters:
+            try:
+                return torch.load(path, map_location='cpu', mmap=True)
+            except RuntimeError:
+                pass  # legacy (pre-zipfile) checkpoints can't be memory-mapped
+        return torch.load(path, map_location='cpu')
+
     def _load_vae(self, vae_config):
         vae_args = {}
         name_or_path = self.model_name_or_path(vae_config)
@@ -1,35 +1,49 @@
 """
-Two helper classes for dealing with PNG images and their path names.
+Helper classes for dealing with PNG images and their path names.
 PngWriter -- Converts Images generated by T2I into PNGs, finds
              appropriate names for them, and writes prompt metadata
              into the PNG.
+PrefixAllocator -- Hands out the unique numeric prefixes used to
+             name the files in an output directory.
+BackgroundImageWriter -- Encodes and writes images on worker threads
+             so that saving does not hold up generation.
 
 Exports function retrieve_metadata(path)
 """
 import os
 import re
 import json
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
 from PIL import PngImagePlugin, Image
 
+if os.name == 'nt':
+    import msvcrt
+else:
+    import fcntl
+
+# zlib level used for throwaway images such as intermediate steps;
+# level 1 is several times faster than the default of 6
+FAST_PNG_COMPRESSION = 1
+
 # -------------------image generation utils-----
 
 
 class PngWriter:
-    def __init__(self, outdir):
+    def __init__(self, outdir, background=None):
+        '''
+        If a BackgroundImageWriter is passed as background, images saved
+        with submit_image_and_prompt_to_png() are written on its threads.
+        '''
         self.outdir = outdir
+        self.background = background
+        self.pending = dict()  # path -> Future of the last write submitted to it
         os.makedirs(outdir, exist_ok=True)
 
     # gives the next unique prefix in outdir
     def unique_prefix(self):
-        # sort reverse alphabetically until we find max+1
-        dirlist = sorted(os.listdir(self.outdir), reverse=True)
-        # find the first filename that matches our pattern or return 000000.0.png
-        existing_name = next(
-            (f for f in dirlist if re.match('^(\d+)\..*\.png', f)),
-            '0000000.0.png',
-        )
-        basecount = int(existing_name.split('.', 1)[0]) + 1
-        return f'{basecount:06}'
+        return PrefixAllocator.for_directory(self.outdir).next_prefix()
 
     # saves image named _image_ to outdir/name, writing metadata from prompt
     # returns full path of output
@@ -42,6 +56,35 @@ class PngWriter:
         image.save(path, 'PNG', pnginfo=info, compress_level=compress_level)
         return path
 
+    def submit_image_and_prompt_to_png(self, image, dream_prompt, name, metadata=None, compress_level=6):
+        '''
+        Like save_image_and_prompt_to_png(), but leaves the encoding and writing
+        to the background writer and returns the path of the file at once. The
+        image must not be modified afterwards, and the file must not be read
+        back before wait() has returned. Writes to the same name happen in the
+        order they were submitted.
+        '''
+        if self.background is None:
+            return self.save_image_and_prompt_to_png(image, dream_prompt, name, metadata, compress_level)
+        path = os.path.join(self.outdir, name)
+        previous = self.pending.pop(path, None)
+        if previous is not None:
+            # e.g. an upscaled image replacing the raw one: don't let the two writes overlap
+            previous.result()
+        self.pending[path] = self.background.submit(
+            self.save_image_and_prompt_to_png, image, dream_prompt, name, metadata, compress_level
+        )
+        return path
+
+    def wait(self):
+        '''
+        Blocks until all submitted images are on disk, re-raising the first
+        error that occurred while writing them.
+        '''
+        pending, self.pending = self.pending, dict()
+        for future in pending.values():
+            future.result()
+
     def retrieve_metadata(self,img_basename):
         '''
         Given a PNG filename stored in outdir, returns the "sd-metadata"
@@ -51,6 +94,118 @@ class PngWriter:
         all_metadata = retrieve_metadata(path)
         return all_metadata['sd-metadata']
 
+class PrefixAllocator:
+    '''
+    Allocates increasing numeric file name prefixes for an output
+    directory. The directory is scanned for the highest existing prefix
+    only once; after that the next value is kept in a small counter file
+    in the directory, which is read and updated under an exclusive file
+    lock. This makes allocation independent of the number of files, and
+    safe across threads and across processes (e.g. the CLI and the web
+    server) sharing the same directory.
+    '''
+    COUNTER_FILE = '.next_prefix'
+
+    _allocators = dict()
+    _allocators_lock = threading.Lock()
+
+    @classmethod
+    def for_directory(cls, outdir):
+        '''
+        Returns the allocator shared by everything in this process
+        that writes into outdir.
+        '''
+        key = os.path.realpath(outdir)
+        with cls._allocators_lock:
+            if key not in cls._allocators:
+                cls._allocators[key] = cls(key)
+            return cls._allocators[key]
+
+    def __init__(self, outdir):
+        self.outdir = outdir
+        self.counter_path = os.path.join(outdir, self.COUNTER_FILE)
+        self.lock = threading.Lock()
+
+    def next_prefix(self):
+        with self.lock, self._locked_counter_file() as f:
+            f.seek(0)
+            value = f.read().strip()
+            next_value = int(value) if value.isdigit() else self._scan_for_next_value()
+            f.seek(0)
+            f.truncate()
+            f.write(str(next_value + 1))
+            f.flush()
+        return f'{next_value:06}'
+
+    def _scan_for_next_value(self):
+        # find the highest prefix of the files that match our pattern, or start from 1
+        highest = 0
+        for f in os.listdir(self.outdir):
+            if (match := re.match(r'^(\d+)\..*\.png', f)):
+                highest = max(highest, int(match.group(1)))
+        return highest + 1
+
+    @contextmanager
+    def _locked_counter_file(self):
+        os.makedirs(self.outdir, exist_ok=True)
+        fd = os.open(self.counter_path, os.O_RDWR | os.O_CREAT)
+        with os.fdopen(fd, 'r+') as f:
+            if os.name == 'nt':
+                msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+            else:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                yield f
+            finally:
+                if os.name == 'nt':
+                    f.seek(0)
+                    msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+                else:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+class BackgroundImageWriter:
+    '''
+    Encodes and saves images on a small pool of worker threads, so that
+    PNG compression and disk I/O overlap with the denoising of the next
+    step or image. PIL releases the GIL while it encodes, so threads run
+    in parallel with the generator without the cost of pickling images
+    across to a process pool. At most max_pending images are held in
+    memory: submit() blocks when that many are waiting, so a slow disk
+    throttles generation instead of piling up unwritten images.
+    '''
+    def __init__(self, max_workers=2, max_pending=8):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='image_writer')
+        self.slots = threading.BoundedSemaphore(max_pending)
+
+    def submit(self, fn, *args, **kwargs) -> Future:
+        '''
+        Runs fn(*args, **kwargs) on a worker thread and returns its Future,
+        blocking first if the writer already has max_pending jobs.
+        '''
+        self.slots.acquire()
+        try:
+            future = self.executor.submit(fn, *args, **kwargs)
+        except BaseException:
+            self.slots.release()
+            raise
+        future.add_done_callback(lambda _: self.slots.release())
+        return future
+
+    def save_image(self, image, path, compress_level=FAST_PNG_COMPRESSION) -> Future:
+        '''
+        Writes image to path as a PNG without metadata, by default with fast
+        compression. Meant for intermediates: errors are reported, not raised.
+        '''
+        future = self.submit(image.save, path, 'PNG', compress_level=compress_level)
+        def report_error(future):
+            if future.exception() is not None:
+                print(f'** Could not write {path}: {str(future.exception())}')
+        future.add_done_callback(report_error)
+        return future
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+
 def retrieve_metadata(img_path):
     '''
     Given a path to a PNG image, returns the "sd-metadata"
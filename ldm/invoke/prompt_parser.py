@@ -1,3 +1,4 @@
+import functools
 import string
 from typing import Union, Optional
 import re
@@ -269,7 +270,7 @@ class PromptParser():
 
     def __init__(self, attention_plus_base=1.1, attention_minus_base=0.9):
 
-        self.conjunction, self.prompt = build_parser_syntax(attention_plus_base, attention_minus_base)
+        self.conjunction, self.prompt = get_parser_syntax(attention_plus_base, attention_minus_base)
 
 
     def parse_conjunction(self, prompt: str) -> Conjunction:
@@ -383,6 +384,17 @@ class PromptParser():
 
 
 
+@functools.lru_cache(maxsize=None)
+def get_parser_syntax(attention_plus_base: float, attention_minus_base: float):
+    """
+    Build the grammar for the given attention bases once per process, and share it between PromptParsers.
+    Packrat parsing is enabled first: the grammar backtracks heavily, and without memoization long weighted
+    prompts take a large fraction of a second to parse.
+    """
+    pp.ParserElement.enable_packrat()
+    return build_parser_syntax(attention_plus_base, attention_minus_base)
+
+
 def build_parser_syntax(attention_plus_base: float, attention_minus_base: float):
     def make_operator_object(x):
         #print('making operator for', x)
@@ -31,8 +31,8 @@ class Restoration():
         return CodeFormerRestoration()
 
     # Upscale Models
-    def load_esrgan(self, esrgan_bg_tile=400):
+    def load_esrgan(self, esrgan_bg_tile=400, esrgan_tile_workers=1):
         from ldm.invoke.restoration.realesrgan import ESRGAN
-        esrgan = ESRGAN(esrgan_bg_tile)
+        esrgan = ESRGAN(esrgan_bg_tile, esrgan_tile_workers)
         print('>> ESRGAN Initialized')
         return esrgan;
@@ -4,9 +4,13 @@ import numpy as np
 import warnings
 import sys
 from ldm.invoke.globals import Globals
+from ldm.invoke.restoration.model_pool import postprocessor_models, move_face_helper
 
 pretrained_model_url = 'https://github.com/sczhou/CodeFormer/releases/download/v0.1.0/codeformer.pth'
 
+# number of 512x512 face crops run through the network at once
+CODEFORMER_BATCH_SIZE = 8
+
 class CodeFormerRestoration():
     def __init__(self,
             codeformer_dir='models/codeformer',
@@ -22,73 +26,101 @@ class CodeFormerRestoration():
             print('## NOT FOUND: CodeFormer model not found at ' + self.model_path)
         sys.path.append(os.path.abspath(codeformer_dir))
 
+    def load_codeformer(self, device):
+        '''
+        Returns the CodeFormer network and the face helper used to find,
+        align and paste back the faces, both on device.
+        '''
+        from basicsr.utils.download_util import load_file_from_url
+        from facexlib.utils.face_restoration_helper import FaceRestoreHelper
+        from ldm.invoke.restoration.codeformer_arch import CodeFormer
+
+        cf = CodeFormer(
+            dim_embd=512,
+            codebook_size=1024,
+            n_head=8,
+            n_layers=9,
+            connect_list=['32', '64', '128', '256']
+        ).to(device)
+
+        # note that this file should already be downloaded and cached at
+        # this point
+        checkpoint_path = load_file_from_url(url=pretrained_model_url,
+                                             model_dir=os.path.abspath(os.path.dirname(self.model_path)),
+                                             progress=True
+        )
+        checkpoint = torch.load(checkpoint_path, map_location='cpu')['params_ema']
+        cf.load_state_dict(checkpoint)
+        cf.eval()
+
+        face_helper = FaceRestoreHelper(
+            upscale_factor=1,
+            use_parse=True,
+            device=device,
+            model_rootpath=os.path.join(Globals.root,'models','gfpgan','weights'),
+        )
+        return cf, face_helper
+
+    @staticmethod
+    def _move_codeformer(models, device):
+        cf, face_helper = models
+        cf.to(device)
+        move_face_helper(face_helper, device)
+
     def process(self, image, strength, device, seed=None, fidelity=0.75):
-        if seed is not None:
-            print(f'>> CodeFormer - Restoring Faces for image seed:{seed}')
+        return self.process_batch([image], strength, device, seeds=[seed], fidelity=fidelity)[0]
+
+    def process_batch(self, images, strength, device, seeds=None, fidelity=0.75, batch_size=CODEFORMER_BATCH_SIZE):
+        '''
+        Restores the faces in a list of images. The faces of all the images are
+        detected and aligned first, and then run through CodeFormer together in
+        batches of up to batch_size crops. Returns the list of restored images.
+        '''
+        for seed in seeds or []:
+            if seed is not None:
+                print(f'>> CodeFormer - Restoring Faces for image seed:{seed}')
         with warnings.catch_warnings():
             warnings.filterwarnings('ignore', category=DeprecationWarning)
             warnings.filterwarnings('ignore', category=UserWarning)
 
-            from basicsr.utils.download_util import load_file_from_url
-            from basicsr.utils import img2tensor, tensor2img
-            from facexlib.utils.face_restoration_helper import FaceRestoreHelper
-            from ldm.invoke.restoration.codeformer_arch import CodeFormer
-            from torchvision.transforms.functional import normalize
-            from PIL import Image
-
-            cf_class = CodeFormer
-
-            cf = cf_class(
-                dim_embd=512,
-                codebook_size=1024,
-                n_head=8,
-                n_layers=9,
-                connect_list=['32', '64', '128', '256']
-            ).to(device)
-
-            # note that this file should already be downloaded and cached at
-            # this point
-            checkpoint_path = load_file_from_url(url=pretrained_model_url,
-                                                 model_dir=os.path.abspath(os.path.dirname(self.model_path)),
-                                                 progress=True
-            )
-            checkpoint = torch.load(checkpoint_path)['params_ema']
-            cf.load_state_dict(checkpoint)
-            cf.eval()
-
-            image = image.convert('RGB')
+            # the network and face helper stay loaded in the shared postprocessor pool between images
+            with postprocessor_models.use(f'codeformer-{self.model_path}',
+                                          self.load_codeformer,
+                                          device,
+                                          self._move_codeformer) as (cf, face_helper):
+                return self._process_batch(cf, face_helper, images, strength, device, fidelity, batch_size)
+
+    def _process_batch(self, cf, face_helper, images, strength, device, fidelity, batch_size):
+        from PIL import Image
+
+        images = [image.convert('RGB') for image in images]
+
+        # find and align the faces of every image, keeping what the helper
+        # needs to paste each image's faces back later
+        helper_states = []
+        cropped_faces = []
+        for image in images:
             # Codeformer expects a BGR np array; make array and flip channels
             bgr_image_array = np.array(image, dtype=np.uint8)[...,::-1]
 
-            face_helper = FaceRestoreHelper(
-                upscale_factor=1,
-                use_parse=True,
-                device=device,
-                model_rootpath=os.path.join(Globals.root,'models','gfpgan','weights'),
-            )
             face_helper.clean_all()
             face_helper.read_image(bgr_image_array)
             face_helper.get_face_landmarks_5(resize=640, eye_dist_threshold=5)
             face_helper.align_warp_face()
 
-            for idx, cropped_face in enumerate(face_helper.cropped_faces):
-                cropped_face_t = img2tensor(cropped_face / 255., bgr2rgb=True, float32=True)
-                normalize(cropped_face_t, (0.5, 0.5, 0.5), (0.5, 0.5, 0.5), inplace=True)
-                cropped_face_t = cropped_face_t.unsqueeze(0).to(device)
-
-                try:
-                    with torch.no_grad():
-                        output = cf(cropped_face_t, w=fidelity, adain=True)[0]
-                        restored_face = tensor2img(output.squeeze(0), rgb2bgr=True, min_max=(-1, 1))
-                    del output
-                    torch.cuda.empty_cache()
-                except RuntimeError as error:
-                    print(f'\tFailed inference for CodeFormer: {error}.')
-                    restored_face = cropped_face
-
-                restored_face = restored_face.astype('uint8')
-                face_helper.add_restored_face(restored_face)
+            helper_states.append({k: v for k, v in vars(face_helper).items() if not isinstance(v, torch.nn.Module)})
+            cropped_faces.extend(face_helper.cropped_faces)
+
+        restored_faces = self._restore_faces(cf, cropped_faces, device, fidelity, batch_size)
 
+        results = []
+        first = 0
+        for image, state in zip(images, helper_states):
+            vars(face_helper).update(state)
+            face_count = len(face_helper.cropped_faces)
+            for restored_face in restored_faces[first:first + face_count]:
+                face_helper.add_restored_face(restored_face)
+            first += face_count
 
             face_helper.get_inverse_affine(None)
 
@@ -103,6 +135,37 @@ class CodeFormerRestoration():
                     image = image.resize(res.size)
                 res = Image.blend(image, res, strength)
 
-            cf = None
+            results.append(res)
+
+        # don't hold on to the images between calls
+        face_helper.clean_all()
+        return results
 
-            return res
+    def _restore_faces(self, cf, cropped_faces, device, fidelity, batch_size):
+        from basicsr.utils import img2tensor, tensor2img
+        from torchvision.transforms.functional import normalize
+
+        restored_faces = []
+        for start in range(0, len(cropped_faces), batch_size):
+            batch = cropped_faces[start:start + batch_size]
+            cropped_faces_t = []
+            for cropped_face in batch:
+                cropped_face_t = img2tensor(cropped_face / 255., bgr2rgb=True, float32=True)
+                normalize(cropped_face_t, (0.5, 0.5, 0.5), (0.5, 0.5, 0.5), inplace=True)
+                cropped_faces_t.append(cropped_face_t)
+            cropped_faces_t = torch.stack(cropped_faces_t).to(device)
+
+            try:
+                with torch.no_grad():
+                    output = cf(cropped_faces_t, w=fidelity, adain=True)[0]
+                    restored_faces.extend(
+                        tensor2img(face, rgb2bgr=True, min_max=(-1, 1)).astype('uint8')
+                        for face in output
+                    )
+                del output
+                torch.cuda.empty_cache()
+            except RuntimeError as error:
+                print(f'\tFailed inference for CodeFormer: {error}.')
+                restored_faces.extend(face.astype('uint8') for face in batch)
+
+        return restored_faces
@@ -4,6 +4,7 @@ import os
 import sys
 import numpy as np
 from ldm.invoke.globals import Globals
+from ldm.invoke.restoration.model_pool import postprocessor_models, move_face_helper
 
 from PIL import Image
 
@@ -26,44 +27,58 @@ class GFPGAN():
     def model_exists(self):
         return os.path.isfile(self.model_path)
 
+    def load_gfpganer(self, device):
+        cwd = os.getcwd()
+        os.chdir(os.path.join(Globals.root,'models'))
+        try:
+            from gfpgan import GFPGANer
+            return GFPGANer(
+                model_path=self.model_path,
+                upscale=1,
+                arch='clean',
+                channel_multiplier=2,
+                bg_upsampler=None,
+                device=device,
+            )
+        except Exception:
+            import traceback
+            print('>> Error loading GFPGAN:', file=sys.stderr)
+            print(traceback.format_exc(), file=sys.stderr)
+            print(
+                f'>> Download https://github.com/TencentARC/GFPGAN/releases/download/v1.3.0/GFPGANv1.4.pth to {self.model_path}'
+            )
+            raise
+        finally:
+            os.chdir(cwd)
+
+    @staticmethod
+    def _move_gfpganer(gfpganer, device):
+        gfpganer.gfpgan.to(device)
+        gfpganer.device = device
+        move_face_helper(gfpganer.face_helper, device)
+
     def process(self, image, strength: float, seed: str = None):
         if seed is not None:
             print(f'>> GFPGAN - Restoring Faces for image seed:{seed}')
 
+        # the restorer stays loaded in the shared postprocessor pool between images
+        device = 'cuda' if torch.cuda.is_available() else 'cpu'
         with warnings.catch_warnings():
             warnings.filterwarnings('ignore', category=DeprecationWarning)
             warnings.filterwarnings('ignore', category=UserWarning)
-            cwd = os.getcwd()
-            os.chdir(os.path.join(Globals.root,'models'))
-            try:
-                from gfpgan import GFPGANer
-                self.gfpgan = GFPGANer(
-                    model_path=self.model_path,
-                    upscale=1,
-                    arch='clean',
-                    channel_multiplier=2,
-                    bg_upsampler=None,
-                )
-            except Exception:
-                import traceback
-                print('>> Error loading GFPGAN:', file=sys.stderr)
-                print(traceback.format_exc(), file=sys.stderr)
-            os.chdir(cwd)
-
-        if self.gfpgan is None:
-            print(
-                f'>> WARNING: GFPGAN not initialized.'
-            )
-            print(
-                f'>> Download https://github.com/TencentARC/GFPGAN/releases/download/v1.3.0/GFPGANv1.4.pth to {self.model_path}'
-            )
+            with postprocessor_models.use(f'gfpgan-{self.model_path}',
+                                          self.load_gfpganer,
+                                          device,
+                                          self._move_gfpganer) as gfpganer:
+                return self._process(gfpganer, image, strength)
 
+    def _process(self, gfpganer, image, strength: float):
         image = image.convert('RGB')
 
         # GFPGAN expects a BGR np array; make array and flip channels
         bgr_image_array = np.array(image, dtype=np.uint8)[...,::-1]
 
-        _, _, restored_img = self.gfpgan.enhance(
+        _, _, restored_img = gfpganer.enhance(
             bgr_image_array,
             has_aligned=False,
             only_center_face=False,
@@ -79,9 +94,4 @@ class GFPGAN():
                 image = image.resize(res.size)
             res = Image.blend(image, res, strength)
 
-
-        if torch.cuda.is_available():
-            torch.cuda.empty_cache()
-        self.gfpgan = None
-
         return res
@@ -0,0 +1,167 @@
+'''
+ldm.invoke.restoration.model_pool keeps the networks used by the
+postprocessors (Real-ESRGAN, GFPGAN and CodeFormer) loaded between
+images, instead of rebuilding them and reloading their weights from
+disk every time an image is upscaled or has its faces restored.
+
+A model stays on the device it was last used on. Once it has been idle
+for offload_after seconds it is moved to the CPU to give back VRAM, and
+once it has been idle for evict_after seconds it is dropped altogether.
+
+Useful exports:
+
+postprocessor_models  - the PostprocessorModelPool shared by all postprocessors
+move_face_helper()    - moves a facexlib FaceRestoreHelper to another device
+'''
+import gc
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Callable
+
+import torch
+
+DEFAULT_OFFLOAD_AFTER = 60     # seconds idle before a model is moved to the CPU
+DEFAULT_EVICT_AFTER = 600      # seconds idle before a model is unloaded
+
+class _PooledModel(object):
+    def __init__(self, model, device, mover):
+        self.model = model
+        self.device = device
+        self.mover = mover
+        self.last_used = time.monotonic()
+        self.users = 0
+        # the postprocessors keep per-image state on their models
+        self.busy = threading.Lock()
+
+class PostprocessorModelPool(object):
+    def __init__(self, offload_after:float=DEFAULT_OFFLOAD_AFTER, evict_after:float=DEFAULT_EVICT_AFTER):
+        self.offload_after = offload_after
+        self.evict_after = evict_after
+        self.models = dict()
+        self.lock = threading.RLock()
+        self._loading = dict()  # name -> lock held while that model is being loaded
+        self._sweeper = None
+
+    @contextmanager
+    def use(self,
+            name:str,
+            loader:Callable[[torch.device], Any],
+            device,
+            mover:Callable[[Any, torch.device], None]=None,
+            ):
+        '''
+        Context manager that yields the model registered under name, ready
+        to run on device. The first time, the model is created by calling
+        loader(device); after that it is reused, and moved with
+        mover(model, device) if it is not on device already. The default
+        mover handles plain torch modules. A model is used by one thread at
+        a time, and is never offloaded or evicted while it is in use.
+        Loading one model does not hold up the use of the others.
+        '''
+        device = torch.device(device)
+        entry = self._acquire(name, loader, device, mover or _move_module)
+        try:
+            with entry.busy:
+                if entry.device != device:
+                    entry.mover(entry.model, device)
+                    entry.device = device
+                yield entry.model
+        finally:
+            with self.lock:
+                entry.users -= 1
+                entry.last_used = time.monotonic()
+            self._start_sweeper()
+
+    def _acquire(self, name:str, loader:Callable[[torch.device], Any], device:torch.device, mover) -> _PooledModel:
+        '''
+        Returns the entry for name, loading it first if needed, with its
+        users count raised. Threads that want a model that is being loaded
+        wait for that load instead of starting another one.
+        '''
+        while True:
+            with self.lock:
+                entry = self.models.get(name)
+                if entry is not None:
+                    entry.users += 1
+                    return entry
+                loading = self._loading.setdefault(name, threading.Lock())
+            with loading:
+                with self.lock:
+                    if name in self.models:
+                        continue
+                model = loader(device)
+                with self.lock:
+                    entry = _PooledModel(model, device, mover)
+                    entry.users += 1
+                    self.models[name] = entry
+                    return entry
+
+    def offload_idle_models(self):
+        '''
+        Moves models that have been idle for offload_after seconds to the CPU
+        and unloads those that have been idle for evict_after seconds.
+        '''
+        now = time.monotonic()
+        freed = False
+        with self.lock:
+            for name, entry in list(self.models.items()):
+                if entry.users > 0:
+                    continue
+                idle = now - entry.last_used
+                if idle >= self.evict_after:
+                    del self.models[name]
+                    freed = True
+                elif idle >= self.offload_after and entry.device.type != 'cpu':
+                    entry.mover(entry.model, torch.device('cpu'))
+                    entry.device = torch.device('cpu')
+                    freed = True
+        if freed:
+            gc.collect()
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+
+    def clear(self):
+        '''
+        Unloads every model that is not in use.
+        '''
+        with self.lock:
+            for name in [name for name, entry in self.models.items() if entry.users == 0]:
+                del self.models[name]
+        gc.collect()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+    def _start_sweeper(self):
+        with self.lock:
+            if self._sweeper is not None:
+                return
+            self._sweeper = threading.Thread(target=self._sweep, name='postprocessor_model_pool', daemon=True)
+            self._sweeper.start()
+
+    def _sweep(self):
+        interval = max(1.0, min(self.offload_after, self.evict_after) / 4)
+        while True:
+            time.sleep(interval)
+            self.offload_idle_models()
+            with self.lock:
+                if not self.models:
+                    self._sweeper = None
+                    return
+
+def move_face_helper(helper, device:torch.device):
+    '''
+    Moves the face detection and parsing networks of a facexlib
+    FaceRestoreHelper, which keep their own record of their device.
+    '''
+    helper.device = device
+    for net in (getattr(helper, 'face_det', None), getattr(helper, 'face_parse', None)):
+        if net is not None:
+            net.to(device)
+            if hasattr(net, 'device'):
+                net.device = device
+
+def _move_module(model, device:torch.device):
+    model.to(device)
+
+postprocessor_models = PostprocessorModelPool()
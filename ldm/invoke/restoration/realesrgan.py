@@ -2,21 +2,39 @@ import torch
 import warnings
 import numpy as np
 import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 
 from ldm.invoke.globals import Globals
+from ldm.invoke.restoration.model_pool import postprocessor_models
 from PIL import Image
 from PIL.Image import Image as ImageType
 
+# input pixels over which neighbouring tiles are cross-faded
+TILE_OVERLAP = 8
+# input pixels of context each tile sees beyond the area it contributes to
+TILE_PAD = 10
+# tiles of the same shape run through the network together
+TILE_BATCH_SIZE = 4
+# outputs larger than this are assembled in a memory-mapped temporary file
+MEMMAP_THRESHOLD = 1024**3
+
 class ESRGAN():
-    def __init__(self, bg_tile_size=400) -> None:
+    def __init__(self, bg_tile_size=400, tile_workers=1) -> None:
+        '''
+        bg_tile_size is the size of the tiles the image is upscaled in, or 0 to
+        upscale it in one piece. tile_workers is the number of threads that run
+        tiles through the network in parallel on the CPU.
+        '''
         self.bg_tile_size = bg_tile_size
+        self.tile_workers = tile_workers
 
         if not torch.cuda.is_available():  # CPU or MPS on M1
             use_half_precision = False
         else:
             use_half_precision = True
 
-    def load_esrgan_bg_upsampler(self):
+    def load_esrgan_bg_upsampler(self, device=None):
         if not torch.cuda.is_available():  # CPU or MPS on M1
             use_half_precision = False
         else:
@@ -37,23 +55,40 @@ class ESRGAN():
             tile_pad=10,
             pre_pad=0,
             half=use_half_precision,
+            device=device,
         )
 
         return bg_upsampler
 
+    @staticmethod
+    def _move_upsampler(upsampler, device):
+        upsampler.model.to(device)
+        upsampler.device = device
+
     def process(self, image: ImageType, strength: float, seed: str = None, upsampler_scale: int = 2):
+        # the upsampler stays loaded in the shared postprocessor pool between images
+        device = 'cuda' if torch.cuda.is_available() else 'cpu'
         with warnings.catch_warnings():
             warnings.filterwarnings('ignore', category=DeprecationWarning)
             warnings.filterwarnings('ignore', category=UserWarning)
 
-            try:
-                upsampler = self.load_esrgan_bg_upsampler()
-            except Exception:
-                import traceback
-                import sys
-                print('>> Error loading Real-ESRGAN:', file=sys.stderr)
-                print(traceback.format_exc(), file=sys.stderr)
-
+            with postprocessor_models.use(f'realesrgan-{self.bg_tile_size}',
+                                          self._load_upsampler,
+                                          device,
+                                          self._move_upsampler) as upsampler:
+                return self._process(upsampler, image, strength, seed, upsampler_scale)
+
+    def _load_upsampler(self, device):
+        try:
+            return self.load_esrgan_bg_upsampler(device)
+        except Exception:
+            import traceback
+            import sys
+            print('>> Error loading Real-ESRGAN:', file=sys.stderr)
+            print(traceback.format_exc(), file=sys.stderr)
+            raise
+
+    def _process(self, upsampler, image: ImageType, strength: float, seed: str, upsampler_scale: int):
         if upsampler_scale == 0:
             print('>> Real-ESRGAN: Invalid scaling option. Image not upscaled.')
             return image
@@ -65,26 +100,134 @@ class ESRGAN():
         # ESRGAN outputs images with partial transparency if given RGBA images; convert to RGB
         image = image.convert("RGB")
 
-        # REALSRGAN expects a BGR np array; make array and flip channels
-        bgr_image_array = np.array(image, dtype=np.uint8)[...,::-1]
+        if self.bg_tile_size > 0:
+            output = upscale_in_tiles(
+                upsampler.model,
+                np.asarray(image, dtype=np.uint8),
+                tile_size=self.bg_tile_size,
+                device=upsampler.device,
+                half=upsampler.half,
+                scale=upsampler.scale,
+                workers=self.tile_workers if upsampler.device.type == 'cpu' else 1,
+            )
+            res = Image.fromarray(output)
+            del output
+            if upsampler_scale != upsampler.scale:
+                res = res.resize((image.width * upsampler_scale, image.height * upsampler_scale), Image.LANCZOS)
+        else:
+            # REALSRGAN expects a BGR np array; make array and flip channels
+            bgr_image_array = np.array(image, dtype=np.uint8)[...,::-1]
 
-        output, _ = upsampler.enhance(
-            bgr_image_array,
-            outscale=upsampler_scale,
-            alpha_upsampler='realesrgan',
-        )
+            output, _ = upsampler.enhance(
+                bgr_image_array,
+                outscale=upsampler_scale,
+                alpha_upsampler='realesrgan',
+            )
 
-        # Flip the channels back to RGB
-        res = Image.fromarray(output[...,::-1])
+            # Flip the channels back to RGB
+            res = Image.fromarray(output[...,::-1])
 
         if strength < 1.0:
             # Resize the image to the new image if the sizes have changed
-            if output.size != image.size:
+            if res.size != image.size:
                 image = image.resize(res.size)
             res = Image.blend(image, res, strength)
 
-        if torch.cuda.is_available():
-            torch.cuda.empty_cache()
-        upsampler = None
-
         return res
+
+
+def upscale_in_tiles(
+        model:torch.nn.Module,
+        image:np.ndarray,
+        tile_size:int,
+        device:torch.device,
+        half:bool=False,
+        scale:int=4,
+        overlap:int=TILE_OVERLAP,
+        pad:int=TILE_PAD,
+        batch_size:int=TILE_BATCH_SIZE,
+        workers:int=1,
+)->np.ndarray:
+    '''
+    Upscales an RGB uint8 array of shape (H, W, 3) with an upsampling network
+    that takes and returns RGB tensors in [0, 1], and returns the uint8 result.
+
+    The image is split into tile_size squares. Each tile is run with pad
+    pixels of extra context, and neighbouring tiles are cross-faded over
+    2*overlap pixels so that no seams show. Tiles of the same shape are
+    batched, and on the CPU batches can be spread over several threads.
+    Rows of tiles are written into the output as soon as they are complete,
+    so apart from the output only one row of tiles is held in float.
+    '''
+    height, width = image.shape[:2]
+    overlap = max(1, min(overlap, tile_size // 4))
+    rows = [(y, min(y + tile_size, height)) for y in range(0, height, tile_size)]
+    cols = [(x, min(x + tile_size, width)) for x in range(0, width, tile_size)]
+
+    output_shape = (height * scale, width * scale, 3)
+    if np.prod(output_shape) > MEMMAP_THRESHOLD:
+        output = np.memmap(tempfile.TemporaryFile(), dtype=np.uint8, mode='w+', shape=output_shape)
+    else:
+        output = np.empty(output_shape, dtype=np.uint8)
+
+    def run_batch(crops):
+        batch = torch.from_numpy(np.stack(crops)).to(device).permute(0, 3, 1, 2)
+        batch = batch.half() if half else batch.float()
+        with torch.no_grad():
+            result = model(batch / 255.0)
+        return result.clamp_(0, 1).permute(0, 2, 3, 1).float().cpu().numpy()
+
+    executor = ThreadPoolExecutor(max_workers=workers) if workers > 1 else None
+    try:
+        carry = None    # the blended rows shared with the next row of tiles
+        for row_index, (y0, y1) in enumerate(rows):
+            ey0, ey1 = max(0, y0 - overlap), min(height, y1 + overlap)
+            cy0, cy1 = max(0, ey0 - pad), min(height, ey1 + pad)
+            band = np.zeros(((ey1 - ey0) * scale, width * scale, 3), dtype=np.float32)
+            if carry is not None:
+                band[:len(carry)] = carry
+            row_weights = _blend_weights(ey0, ey1, y0, y1, height, overlap, scale)
+
+            # group the tiles of this row by shape, so that each batch can be stacked
+            tiles = dict()
+            for x0, x1 in cols:
+                ex0, ex1 = max(0, x0 - overlap), min(width, x1 + overlap)
+                cx0, cx1 = max(0, ex0 - pad), min(width, ex1 + pad)
+                tiles.setdefault((cx1 - cx0), []).append((x0, x1, ex0, ex1, cx0, cx1))
+            batches = list()
+            for same_shape in tiles.values():
+                for start in range(0, len(same_shape), batch_size):
+                    batches.append(same_shape[start:start + batch_size])
+            crops = [[image[cy0:cy1, cx0:cx1] for _, _, _, _, cx0, cx1 in batch] for batch in batches]
+            results = executor.map(run_batch, crops) if executor else map(run_batch, crops)
+
+            for batch, upscaled in zip(batches, results):
+                for (x0, x1, ex0, ex1, cx0, cx1), tile in zip(batch, upscaled):
+                    tile = tile[(ey0 - cy0) * scale:(ey1 - cy0) * scale, (ex0 - cx0) * scale:(ex1 - cx0) * scale]
+                    col_weights = _blend_weights(ex0, ex1, x0, x1, width, overlap, scale)
+                    band[:, ex0 * scale:ex1 * scale] += tile * row_weights[:, None, None] * col_weights[None, :, None]
+
+            # everything above the overlap with the next row of tiles is final
+            done = (y1 - overlap - ey0) * scale if row_index < len(rows) - 1 else len(band)
+            output[ey0 * scale:ey0 * scale + done] = np.rint(band[:done] * 255.0)
+            carry = band[done:]
+    finally:
+        if executor:
+            executor.shutdown()
+
+    return output
+
+def _blend_weights(start:int, end:int, core_start:int, core_end:int, length:int, overlap:int, scale:int)->np.ndarray:
+    '''
+    Weights, at output resolution, of a tile covering input pixels [start, end)
+    whose own area is [core_start, core_end). They ramp linearly across the
+    2*overlap pixels centred on each inner edge, so that the weights of two
+    neighbouring tiles add up to 1 everywhere.
+    '''
+    centres = start + (np.arange((end - start) * scale, dtype=np.float32) + 0.5) / scale
+    weights = np.ones_like(centres)
+    if core_start > 0:
+        weights = np.minimum(weights, np.clip((centres - (core_start - overlap)) / (2 * overlap), 0, 1))
+    if core_end < length:
+        weights = np.minimum(weights, np.clip(((core_end + overlap) - centres) / (2 * overlap), 0, 1))
+    return weights
@@ -1,11 +1,13 @@
 import enum
 import math
+import time
 from typing import Optional, Callable
 
 import psutil
 import torch
 import diffusers
 from torch import nn
+from torch.nn import functional as F
 from diffusers.models.unet_2d_condition import UNet2DConditionModel
 from ldm.invoke.devices import torch_dtype
 
@@ -182,6 +184,11 @@ class InvokeAICrossAttentionMixin:
     through both to an attention_slice_wrangler and a slicing_strategy_getter for custom attention map wrangling
     and dymamic slicing strategy selection.
     """
+
+    # fastest query slice size for scaled_dot_product_attention on the CPU, found by benchmarking
+    # the first attention of each shape and shared by all modules: (dtype, batch, query length, key length) -> size
+    cpu_slice_sizes = dict()
+
     def __init__(self):
         self.mem_total_gb = psutil.virtual_memory().total // (1 << 30)
         self.attention_slice_wrangler = None
@@ -288,12 +295,63 @@ class InvokeAICrossAttentionMixin:
         return self.einsum_op_tensor_mem(q, k, v, mem_free_total / 3.3 / (1 << 20))
 
 
+    def einsum_op_cpu(self, q, k, v):
+        # replay a saved slicing strategy, as on cuda, so that saved attention maps line up
+        slicing_strategy_getter = self.slicing_strategy_getter
+        if slicing_strategy_getter is not None:
+            (dim, slice_size) = slicing_strategy_getter(self)
+            if dim == 0:
+                return self.einsum_op_slice_dim0(q, k, v, slice_size)
+            elif dim == 1:
+                return self.einsum_op_slice_dim1(q, k, v, slice_size)
+
+        # Divide factor of safety as there's copying and fragmentation
+        mem_budget = psutil.virtual_memory().available / 3.3
+        if self.attention_slice_wrangler is not None or self.attention_slice_calculated_callback is not None \
+                or not hasattr(F, 'scaled_dot_product_attention'):
+            # the attention maps themselves are needed, so calculate them explicitly
+            return self.einsum_op_tensor_mem(q, k, v, mem_budget / (1 << 20))
+        return self.sdpa_op_cpu(q, k, v, mem_budget)
+
+    def sdpa_op_cpu(self, q, k, v, mem_budget):
+        # scaled_dot_product_attention divides by sqrt(head dim); fold our own scale into q instead
+        q = q * (self.scale * math.sqrt(q.shape[-1]))
+        bytes_per_query = q.shape[0] * k.shape[1] * q.element_size()
+        max_slice_size = int(max(1, min(q.shape[1], mem_budget // bytes_per_query)))
+
+        shape_key = (q.dtype, q.shape[0], q.shape[1], k.shape[1])
+        slice_size = self.cpu_slice_sizes.get(shape_key)
+        if slice_size is not None:
+            return self.sdpa_op_slice_dim1(q, k, v, min(slice_size, max_slice_size))
+
+        # first attention of this shape: time a few slice sizes that fit in memory and remember the fastest
+        candidates = sorted({max(1, max_slice_size >> n) for n in range(4)}, reverse=True)
+        timings = dict()
+        for candidate in candidates:
+            start = time.perf_counter()
+            r = self.sdpa_op_slice_dim1(q, k, v, candidate)
+            timings[candidate] = time.perf_counter() - start
+        InvokeAICrossAttentionMixin.cpu_slice_sizes[shape_key] = min(timings, key=timings.get)
+        return r
+
+    def sdpa_op_slice_dim1(self, q, k, v, slice_size):
+        if slice_size >= q.shape[1]:
+            return F.scaled_dot_product_attention(q, k, v)
+        r = torch.empty(q.shape[0], q.shape[1], v.shape[2], device=q.device, dtype=q.dtype)
+        for i in range(0, q.shape[1], slice_size):
+            end = i + slice_size
+            r[:, i:end] = F.scaled_dot_product_attention(q[:, i:end], k, v)
+        return r
+
     def get_invokeai_attention_mem_efficient(self, q, k, v):
         if q.device.type == 'cuda':
             #print("in get_attention_mem_efficient with q shape", q.shape, ", k shape", k.shape, ", free memory is", get_mem_free_total(q.device))
             return self.einsum_op_cuda(q, k, v)
 
-        if q.device.type == 'mps' or q.device.type == 'cpu':
+        if q.device.type == 'cpu':
+            return self.einsum_op_cpu(q, k, v)
+
+        if q.device.type == 'mps':
             if self.mem_total_gb >= 32:
                 return self.einsum_op_mps_v1(q, k, v)
             return self.einsum_op_mps_v2(q, k, v)
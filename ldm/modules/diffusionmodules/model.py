@@ -4,6 +4,7 @@ import math
 import torch
 import torch.nn as nn
 from torch.nn.functional import silu
+import torch.nn.functional as F
 import numpy as np
 from einops import rearrange
 
@@ -157,6 +158,56 @@ class LinAttnBlock(LinearAttention):
         super().__init__(dim=in_channels, heads=1, dim_head=in_channels)
 
 
+# bytes of scratch memory needed per element of the attention weights: the weights, their softmax and copying
+ATTENTION_MEMORY_FACTOR = 2.5
+
+def get_attention_memory_budget(device:torch.device) -> int:
+    '''
+    Returns the number of bytes that attention may use for its weights on device.
+    '''
+    if device.type == 'cuda':
+        stats = torch.cuda.memory_stats(device)
+        mem_active = stats['active_bytes.all.current']
+        mem_reserved = stats['reserved_bytes.all.current']
+        mem_free_cuda, _ = torch.cuda.mem_get_info(device)
+        mem_free_torch = mem_reserved - mem_active
+        return mem_free_cuda + mem_free_torch
+    # leave room for the rest of the process, and for fragmentation
+    return int(psutil.virtual_memory().available / 3.3)
+
+def attention_in_chunks(q, k, v, scale:float):
+    '''
+    Single-head attention over q (b,hw,c), k (b,c,hw) and v (b,c,hw), returning
+    the attended values as b,c,hw. Queries are processed in the largest chunks
+    whose weights fit in the device's free memory, writing into one preallocated
+    output buffer. Uses scaled_dot_product_attention where torch provides it,
+    which does not materialize the weights at all on most backends.
+    '''
+    b, hw, c = q.shape
+    bytes_per_query = b * k.shape[2] * q.element_size() * ATTENTION_MEMORY_FACTOR
+    chunk_size = int(max(1, min(hw, get_attention_memory_budget(q.device) // bytes_per_query)))
+
+    vt = v.transpose(1, 2)   # b,hw,c
+    out = torch.empty(b, hw, v.shape[1], device=q.device, dtype=q.dtype)
+
+    if hasattr(F, 'scaled_dot_product_attention'):
+        # scaled_dot_product_attention scales by 1/sqrt(c) itself; fold in our scale instead
+        q = q * (scale * math.sqrt(c))
+        kt = k.transpose(1, 2)   # b,hw,c
+        for i in range(0, hw, chunk_size):
+            end = i + chunk_size
+            out[:, i:end] = F.scaled_dot_product_attention(q[:, i:end], kt, vt)
+    else:
+        for i in range(0, hw, chunk_size):
+            end = i + chunk_size
+            w_ = torch.bmm(q[:, i:end], k)   # b,chunk,hw    w[b,i,j]=sum_c q[b,i,c]k[b,c,j]
+            w_ *= scale
+            w_ = torch.softmax(w_, dim=2)
+            out[:, i:end] = torch.bmm(w_, vt)   # b,chunk,c    out[b,i,c] = sum_j w[b,i,j] v[b,c,j]
+            del w_
+
+    return out.transpose(1, 2)   # b,c,hw
+
 class AttnBlock(nn.Module):
     def __init__(self, in_channels):
         super().__init__()
@@ -204,47 +255,9 @@ class AttnBlock(nn.Module):
         k = k1.reshape(b, c, h*w) # b,c,hw
         del k1
 
-        h_ = torch.zeros_like(k, device=q.device)
-
-        if q.device.type == 'cuda':
-            stats = torch.cuda.memory_stats(q.device)
-            mem_active = stats['active_bytes.all.current']
-            mem_reserved = stats['reserved_bytes.all.current']
-            mem_free_cuda, _ = torch.cuda.mem_get_info(torch.cuda.current_device())
-            mem_free_torch = mem_reserved - mem_active
-            mem_free_total = mem_free_cuda + mem_free_torch
-
-            tensor_size = q.shape[0] * q.shape[1] * k.shape[2] * 4
-            mem_required = tensor_size * 2.5
-            steps = 1
-
-            if mem_required > mem_free_total:
-                steps = 2**(math.ceil(math.log(mem_required / mem_free_total, 2)))
-
-            slice_size = q.shape[1] // steps if (q.shape[1] % steps) == 0 else q.shape[1]
-
-        else:
-            if psutil.virtual_memory().available / (1024**3) < 12:
-                slice_size = 1
-            else:
-                slice_size = min(q.shape[1], math.floor(2**30 / (q.shape[0] * q.shape[1])))
-
-        for i in range(0, q.shape[1], slice_size):
-            end = i + slice_size
-
-            w1 = torch.bmm(q[:, i:end], k)     # b,hw,hw    w[b,i,j]=sum_c q[b,i,c]k[b,c,j]
-            w2 = w1 * (int(c)**(-0.5))
-            del w1
-            w3 = torch.nn.functional.softmax(w2, dim=2)
-            del w2
-
-            # attend to values
-            v1 = v.reshape(b, c, h*w)
-            w4 = w3.permute(0, 2, 1)   # b,hw,hw (first hw of k, second of q)
-            del w3
-
-            h_[:, :, i:end] = torch.bmm(v1, w4)     # b, c,hw (hw of q) h_[b,c,j] = sum_i v[b,c,i] w_[b,i,j]
-            del v1, w4
+        v = v.reshape(b, c, h*w)
+        h_ = attention_in_chunks(q, k, v, int(c)**(-0.5))   # b,c,hw
+        del q, k, v
 
         h2 = h_.reshape(b, c, h, w)
         del h_
@@ -38,8 +38,11 @@ class WeightedPromptFragmentsToEmbeddingsConverter():
         if len(text) != len(fragment_weights):
             raise ValueError(f"lengths of text and fragment_weights lists are not the same ({len(text)} != {len(fragment_weights)})")
 
-        batch_z = None
-        batch_tokens = None
+        # Collect every token sequence needed for the whole batch, so that the text encoder runs only once.
+        all_token_ids = []
+        all_per_token_weights = []
+        per_prompt_lerp_weights = []
+        per_prompt_tokens = []
         for fragments, weights in zip(text, fragment_weights):
 
             # First, weight tokens in individual fragments by scaling the feature vectors as requested (effectively
@@ -54,10 +57,10 @@ class WeightedPromptFragmentsToEmbeddingsConverter():
 
             # handle weights >=1
             tokens, per_token_weights = self.get_token_ids_and_expand_weights(fragments, weights, device=device)
-            base_embedding = self.build_weighted_embedding_tensor(tokens, per_token_weights)
+            all_token_ids.append(tokens)
+            all_per_token_weights.append(per_token_weights)
 
             # this is our starting point
-            embeddings = base_embedding.unsqueeze(0)
             per_embedding_weights = [1.0]
 
             # now handle weights <1
@@ -73,9 +76,9 @@ class WeightedPromptFragmentsToEmbeddingsConverter():
                     fragments_without_this = fragments[:index] + fragments[index+1:]
                     weights_without_this = weights[:index] + weights[index+1:]
                     tokens, per_token_weights = self.get_token_ids_and_expand_weights(fragments_without_this, weights_without_this, device=device)
-                    embedding_without_this = self.build_weighted_embedding_tensor(tokens, per_token_weights)
+                    all_token_ids.append(tokens)
+                    all_per_token_weights.append(per_token_weights)
 
-                    embeddings = torch.cat((embeddings, embedding_without_this.unsqueeze(0)), dim=1)
                     # weight of the embedding *without* this fragment gets *stronger* as its weight approaches 0
                     # if fragment_weight = 0, basically we want embedding_without_this to completely overwhelm base_embedding
                     # therefore:
@@ -94,6 +97,20 @@ class WeightedPromptFragmentsToEmbeddingsConverter():
 
                     per_embedding_weights.append(embedding_lerp_weight)
 
+            per_prompt_lerp_weights.append(per_embedding_weights)
+            per_prompt_tokens.append(tokens)
+
+        all_embeddings = self.build_weighted_embedding_tensors(torch.stack(all_token_ids),
+                                                               torch.stack(all_per_token_weights))
+
+        batch_z = None
+        batch_tokens = None
+        first = 0
+        for per_embedding_weights, tokens in zip(per_prompt_lerp_weights, per_prompt_tokens):
+            # the full prompt followed by each of its "without this fragment" variants
+            embeddings = all_embeddings[first:first + len(per_embedding_weights)].unsqueeze(0)
+            first += len(per_embedding_weights)
+
             lerped_embeddings = self.apply_embedding_weights(embeddings, per_embedding_weights, normalize=True).squeeze(0)
 
             #print(f"assembled tokens for '{fragments}' into tensor of shape {lerped_embeddings.shape}")
@@ -224,12 +241,25 @@ class WeightedPromptFragmentsToEmbeddingsConverter():
         if token_ids.shape != torch.Size([self.max_length]):
             raise ValueError(f"token_ids has shape {token_ids.shape} - expected [{self.max_length}]")
 
-        z = self.text_encoder.forward(input_ids=token_ids.unsqueeze(0),
-                                      return_dict=False)[0]
+        return self.build_weighted_embedding_tensors(token_ids.unsqueeze(0), per_token_weights.unsqueeze(0))
+
+    def build_weighted_embedding_tensors(self, token_ids: torch.Tensor, per_token_weights: torch.Tensor) -> torch.Tensor:
+        '''
+        Batched version of `build_weighted_embedding_tensor`: embeds all the token sequences, together with the empty
+        prompt the weights are applied relative to, in a single forward pass of the text encoder.
+        :param token_ids: A tensor of shape `[B, self.max_length]` containing token IDs (ints)
+        :param per_token_weights: A tensor of shape `[B, self.max_length]` containing weights (floats)
+        :return: A tensor of shape `[B, self.max_length, token_dim]`.
+        '''
+        if token_ids.dim() != 2 or token_ids.shape[1] != self.max_length:
+            raise ValueError(f"token_ids has shape {token_ids.shape} - expected [B, {self.max_length}]")
+
         empty_token_ids = torch.tensor([self.tokenizer.bos_token_id] +
                                     [self.tokenizer.pad_token_id] * (self.max_length-2) +
-                                    [self.tokenizer.eos_token_id], dtype=torch.int, device=token_ids.device).unsqueeze(0)
-        empty_z = self.text_encoder(input_ids=empty_token_ids).last_hidden_state
+                                    [self.tokenizer.eos_token_id], dtype=token_ids.dtype, device=token_ids.device).unsqueeze(0)
+        all_z = self.text_encoder.forward(input_ids=torch.cat([token_ids, empty_token_ids]),
+                                          return_dict=False)[0]
+        z, empty_z = all_z[:-1], all_z[-1:]
         batch_weights_expanded = per_token_weights.reshape(per_token_weights.shape + (1,)).expand(z.shape)
         z_delta_from_empty = z - empty_z
         weighted_z = empty_z + (z_delta_from_empty * batch_weights_expanded)
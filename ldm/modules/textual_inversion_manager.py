@@ -1,5 +1,6 @@
 import os
 import traceback
+from collections import deque
 from typing import Optional
 
 import torch
@@ -8,6 +9,7 @@ from picklescan.scanner import scan_file_path
 from transformers import CLIPTokenizer, CLIPTextModel
 
 from ldm.invoke.concepts_lib import HuggingFaceConceptsLibrary
+from ldm.invoke.embedding_index import get_embedding_index
 
 
 @dataclass
@@ -21,6 +23,53 @@ class TextualInversion:
     def embedding_vector_length(self) -> int:
         return self.embedding.shape[0]
 
+class TriggerStringMatcher():
+    """
+    Finds which of a set of trigger strings occur in a prompt with an Aho-Corasick automaton, in a single
+    pass over the prompt however many trigger strings there are. Occurrences may overlap, so that the
+    result is the same as testing `trigger_string in prompt` for every trigger string.
+    """
+    def __init__(self, trigger_strings: list[str]):
+        self.goto: list[dict[str, int]] = [{}]
+        self.fail: list[int] = [0]
+        self.output: list[list[str]] = [[]]
+        for trigger_string in trigger_strings:
+            node = 0
+            for char in trigger_string:
+                if char not in self.goto[node]:
+                    self.goto[node][char] = len(self.goto)
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.output.append([])
+                node = self.goto[node][char]
+            self.output[node].append(trigger_string)
+
+        # breadth-first, so that the failure links of shallower nodes are complete before they are followed
+        queue = deque(self.goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for char, child in self.goto[node].items():
+                queue.append(child)
+                fail = self.fail[node]
+                while fail != 0 and char not in self.goto[fail]:
+                    fail = self.fail[fail]
+                self.fail[child] = self.goto[fail].get(char, 0)
+                self.output[child] = self.output[child] + self.output[self.fail[child]]
+
+    def find_all(self, text: str) -> list[str]:
+        """
+        :return: The trigger strings that occur in text, in the order they are first found.
+        """
+        found = {}
+        node = 0
+        for char in text:
+            while node != 0 and char not in self.goto[node]:
+                node = self.fail[node]
+            node = self.goto[node].get(char, 0)
+            for trigger_string in self.output[node]:
+                found[trigger_string] = True
+        return list(found)
+
 class TextualInversionManager():
     def __init__(self,
                  tokenizer: CLIPTokenizer,
@@ -32,6 +81,9 @@ class TextualInversionManager():
         self.hf_concepts_library = HuggingFaceConceptsLibrary()
         default_textual_inversions: list[TextualInversion] = []
         self.textual_inversions = default_textual_inversions
+        self.textual_inversions_by_trigger_string: dict[str, TextualInversion] = {}
+        self.textual_inversions_by_token_id: dict[int, TextualInversion] = {}
+        self._trigger_string_matcher: Optional[TriggerStringMatcher] = None  # built on demand
 
     def load_huggingface_concepts(self, concepts: list[str]):
         for concept_name in concepts:
@@ -51,32 +103,67 @@ class TextualInversionManager():
             self.hf_concepts_library.concepts_loaded[concept_name]=True
 
     def get_all_trigger_strings(self) -> list[str]:
-        return [ti.trigger_string for ti in self.textual_inversions]
+        return list(self.textual_inversions_by_trigger_string.keys())
+
+    def get_injected_trigger_strings(self) -> frozenset[str]:
+        """
+        The triggers whose tokens have been added to the tokenizer. These are the
+        textual inversions that can affect how a prompt is encoded.
+        """
+        return frozenset(ti.trigger_string for ti in self.textual_inversions_by_token_id.values())
 
     def load_textual_inversion(self, ckpt_path, defer_injecting_tokens: bool=False):
         if str(ckpt_path).endswith('.DS_Store'):
             return
+        embedding_info = self._scan_and_parse_embedding(ckpt_path)
+        if embedding_info:
+            self._add_textual_inversion_if_compatible(embedding_info['name'],
+                                                      embedding_info['embedding'],
+                                                      defer_injecting_tokens=defer_injecting_tokens)
+
+    def load_textual_inversions(self, embedding_path, defer_injecting_tokens: bool=False):
+        """
+        Load all the embeddings under embedding_path that were trained for the token dimension
+        of the current model. Embedding files are only scanned and parsed the first time they
+        are seen, or after they change; see ldm.invoke.embedding_index.
+        """
+        added = []
+        for entry in get_embedding_index().load_directory(embedding_path,
+                                                          self._get_token_dim(),
+                                                          self._scan_and_parse_embedding):
+            ti = self._add_textual_inversion_if_compatible(entry.trigger_string,
+                                                           entry.embedding,
+                                                           defer_injecting_tokens=True)
+            if ti is not None:
+                added.append(ti)
+        if not defer_injecting_tokens:
+            self.inject_textual_inversions(added)
+
+    def _scan_and_parse_embedding(self, ckpt_path) -> Optional[dict]:
         try:
             scan_result = scan_file_path(ckpt_path)
             if scan_result.infected_files == 1:
                 print(f'\n### Security Issues Found in Model: {scan_result.issues_count}')
                 print('### For your safety, InvokeAI will not load this embed.')
-                return
+                return None
         except Exception:
             print(f"### WARNING::: Invalid or corrupt embeddings found. Ignoring: {ckpt_path}")
-            return
+            return None
 
-        embedding_info = self._parse_embedding(ckpt_path)
-        if embedding_info:
-            try:
-                self._add_textual_inversion(embedding_info['name'],
-                                            embedding_info['embedding'],
-                                            defer_injecting_tokens=defer_injecting_tokens)
-            except ValueError as e:
-                print(f'   | Ignoring incompatible embedding {embedding_info["name"]}')
-                print(f'   | The error was {str(e)}')
-        else:
+        embedding_info = self._parse_embedding(str(ckpt_path))
+        if not embedding_info:
             print(f'>> Failed to load embedding located at {ckpt_path}. Unsupported file.')
+        return embedding_info
+
+    def _add_textual_inversion_if_compatible(self, trigger_str, embedding, defer_injecting_tokens=False) -> Optional[TextualInversion]:
+        try:
+            return self._add_textual_inversion(trigger_str,
+                                               embedding,
+                                               defer_injecting_tokens=defer_injecting_tokens)
+        except ValueError as e:
+            print(f'   | Ignoring incompatible embedding {trigger_str}')
+            print(f'   | The error was {str(e)}')
+            return None
 
     def _add_textual_inversion(self, trigger_str, embedding, defer_injecting_tokens=False) -> TextualInversion:
         """
@@ -85,7 +172,7 @@ class TextualInversionManager():
         :param embedding: The actual embedding data that will be inserted into the conditioning at the point where the token_str appears.
         :return: The token id for the added embedding, either existing or newly-added.
         """
-        if trigger_str in [ti.trigger_string for ti in self.textual_inversions]:
+        if trigger_str in self.textual_inversions_by_trigger_string:
             print(f">> TextualInversionManager refusing to overwrite already-loaded token '{trigger_str}'")
             return
         if not self.full_precision:
@@ -103,6 +190,8 @@ class TextualInversionManager():
             if not defer_injecting_tokens:
                 self._inject_tokens_and_assign_embeddings(ti)
             self.textual_inversions.append(ti)
+            self.textual_inversions_by_trigger_string[trigger_str] = ti
+            self._trigger_string_matcher = None
             return ti
 
         except ValueError as e:
@@ -113,57 +202,114 @@ class TextualInversionManager():
                 print(f">> TextualInversionManager was unable to add a textual inversion with trigger string {trigger_str}.")
                 raise
 
+    def inject_textual_inversions(self, textual_inversions: list[TextualInversion]) -> list[int]:
+        """
+        Add the trigger and pad tokens of all the given textual inversions to the tokenizer and text encoder
+        in one go. Textual inversions whose tokens were already injected are skipped, as are those that
+        are incompatible with the current model.
+
+        :return: The ids of the injected trigger and pad tokens.
+        """
+        compatible = []
+        for ti in textual_inversions:
+            if ti.trigger_token_id is not None:
+                continue
+            try:
+                self._check_can_inject(ti)
+            except ValueError as e:
+                print(f'   | Ignoring incompatible embedding trigger {ti.trigger_string}')
+                print(f'   | The error was {str(e)}')
+                continue
+            compatible.append(ti)
+
+        self._inject_tokens_and_assign_embeddings_batched(compatible)
+        return [token_id for ti in compatible for token_id in [ti.trigger_token_id] + ti.pad_token_ids]
+
     def _inject_tokens_and_assign_embeddings(self, ti: TextualInversion) -> int:
+        self._check_can_inject(ti)
+        self._inject_tokens_and_assign_embeddings_batched([ti])
+        return ti.trigger_token_id
 
+    def _check_can_inject(self, ti: TextualInversion):
         if ti.trigger_token_id is not None:
             raise ValueError(f"Tokens already injected for textual inversion with trigger '{ti.trigger_string}'")
+        token_dim = self._get_token_dim()
+        if ti.embedding.shape[1] != token_dim:
+            raise ValueError(f"Warning. Cannot load embedding for {ti.trigger_string}. It was trained on a model with token dimension {ti.embedding.shape[1]}, but the current model has token dimension {token_dim}.")
+
+    def _inject_tokens_and_assign_embeddings_batched(self, textual_inversions: list[TextualInversion]):
+        # Resizing the token embeddings reallocates and copies the whole embedding matrix, so the tokens of
+        # all the textual inversions, including the pad tokens of multi-vector embeddings, are added together
+        # and the text encoder is resized only once.
+        if len(textual_inversions) == 0:
+            return
 
-        trigger_token_id = self._get_or_create_token_id_and_assign_embedding(ti.trigger_string, ti.embedding[0])
+        token_strings = []
+        for ti in textual_inversions:
+            token_strings.append(ti.trigger_string)
+            token_strings.extend(ti.trigger_string + "-!pad-" + str(pad_index) for pad_index in range(1, ti.embedding_vector_length))
 
-        if ti.embedding_vector_length > 1:
-            # for embeddings with vector length > 1
-            pad_token_strings = [ti.trigger_string + "-!pad-" + str(pad_index) for pad_index in range(1, ti.embedding_vector_length)]
-            # todo: batched UI for faster loading when vector length >2
-            pad_token_ids = [self._get_or_create_token_id_and_assign_embedding(pad_token_str, ti.embedding[1 + i]) \
-                                 for (i, pad_token_str) in enumerate(pad_token_strings)]
-        else:
-            pad_token_ids = []
+        existing_token_ids = self.tokenizer.convert_tokens_to_ids(token_strings)
+        new_token_strings = [token_str for token_str, token_id in zip(token_strings, existing_token_ids)
+                             if token_id == self.tokenizer.unk_token_id]
+        if len(new_token_strings) > 0:
+            num_tokens_added = self.tokenizer.add_tokens(new_token_strings)
+            current_token_count = self.text_encoder.resize_token_embeddings(None).num_embeddings
+            self.text_encoder.resize_token_embeddings(current_token_count + num_tokens_added)
 
-        ti.trigger_token_id = trigger_token_id
-        ti.pad_token_ids = pad_token_ids
-        return ti.trigger_token_id
+        token_ids = self.tokenizer.convert_tokens_to_ids(token_strings)
+        for token_str, token_id in zip(token_strings, token_ids):
+            if token_id == self.tokenizer.unk_token_id:
+                raise RuntimeError(f"Unable to find token id for token '{token_str}'")
+
+        weight = self.text_encoder.get_input_embeddings().weight
+        embeddings = torch.cat([ti.embedding for ti in textual_inversions])
+        weight.data[token_ids] = embeddings.to(device=weight.device, dtype=weight.dtype)
+
+        offset = 0
+        for ti in textual_inversions:
+            ti.trigger_token_id = token_ids[offset]
+            ti.pad_token_ids = token_ids[offset + 1:offset + ti.embedding_vector_length]
+            offset += ti.embedding_vector_length
+            self.textual_inversions_by_token_id[ti.trigger_token_id] = ti
+
+    def _get_token_dim(self) -> int:
+        return self.text_encoder.get_input_embeddings().embedding_dim
 
 
     def has_textual_inversion_for_trigger_string(self, trigger_string: str) -> bool:
-        try:
-            ti = self.get_textual_inversion_for_trigger_string(trigger_string)
-            return ti is not None
-        except StopIteration:
-            return False
+        return trigger_string in self.textual_inversions_by_trigger_string
 
 
     def get_textual_inversion_for_trigger_string(self, trigger_string: str) -> TextualInversion:
-        return next(ti for ti in self.textual_inversions if ti.trigger_string == trigger_string)
+        """
+        Raises KeyError if there is no textual inversion with this trigger string.
+        """
+        try:
+            return self.textual_inversions_by_trigger_string[trigger_string]
+        except KeyError:
+            raise KeyError(f"No textual inversion with trigger string '{trigger_string}'") from None
 
 
     def get_textual_inversion_for_token_id(self, token_id: int) -> TextualInversion:
-        return next(ti for ti in self.textual_inversions if ti.trigger_token_id == token_id)
+        """
+        Raises KeyError if there is no textual inversion with this trigger token id.
+        """
+        try:
+            return self.textual_inversions_by_token_id[token_id]
+        except KeyError:
+            raise KeyError(f"No textual inversion with trigger token id {token_id}") from None
 
     def create_deferred_token_ids_for_any_trigger_terms(self, prompt_string: str) -> list[int]:
-        injected_token_ids = []
-        for ti in self.textual_inversions:
-            if ti.trigger_token_id is None and ti.trigger_string in prompt_string:
-                if ti.embedding_vector_length > 1:
-                    print(f">> Preparing tokens for textual inversion {ti.trigger_string}...")
-                try:
-                    self._inject_tokens_and_assign_embeddings(ti)
-                except ValueError as e:
-                    print(f'   | Ignoring incompatible embedding trigger {ti.trigger_string}')
-                    print(f'   | The error was {str(e)}')
-                    continue
-                injected_token_ids.append(ti.trigger_token_id)
-                injected_token_ids.extend(ti.pad_token_ids)
-        return injected_token_ids
+        if self._trigger_string_matcher is None:
+            self._trigger_string_matcher = TriggerStringMatcher(self.get_all_trigger_strings())
+        deferred_textual_inversions = [self.textual_inversions_by_trigger_string[trigger_string]
+                                       for trigger_string in self._trigger_string_matcher.find_all(prompt_string)]
+        deferred_textual_inversions = [ti for ti in deferred_textual_inversions if ti.trigger_token_id is None]
+        for ti in deferred_textual_inversions:
+            if ti.embedding_vector_length > 1:
+                print(f">> Preparing tokens for textual inversion {ti.trigger_string}...")
+        return self.inject_textual_inversions(deferred_textual_inversions)
 
 
     def expand_textual_inversion_token_ids_if_necessary(self, prompt_token_ids: list[int]) -> list[int]:
@@ -181,37 +327,15 @@ class TextualInversionManager():
             raise ValueError("prompt_token_ids must not start with bos_token_id")
         if prompt_token_ids[-1] == self.tokenizer.eos_token_id:
             raise ValueError("prompt_token_ids must not end with eos_token_id")
-        textual_inversion_trigger_token_ids = [ti.trigger_token_id for ti in self.textual_inversions]
-        prompt_token_ids = prompt_token_ids.copy()
-        for i, token_id in reversed(list(enumerate(prompt_token_ids))):
-            if token_id in textual_inversion_trigger_token_ids:
-                textual_inversion = next(ti for ti in self.textual_inversions if ti.trigger_token_id == token_id)
-                for pad_idx in range(0, textual_inversion.embedding_vector_length-1):
-                    prompt_token_ids.insert(i+pad_idx+1, textual_inversion.pad_token_ids[pad_idx])
-
-        return prompt_token_ids
-
-
-    def _get_or_create_token_id_and_assign_embedding(self, token_str: str, embedding: torch.Tensor) -> int:
-        if len(embedding.shape) != 1:
-            raise ValueError("Embedding has incorrect shape - must be [token_dim] where token_dim is 768 for SD1 or 1280 for SD2")
-        existing_token_id = self.tokenizer.convert_tokens_to_ids(token_str)
-        if existing_token_id == self.tokenizer.unk_token_id:
-            num_tokens_added = self.tokenizer.add_tokens(token_str)
-            current_embeddings = self.text_encoder.resize_token_embeddings(None)
-            current_token_count = current_embeddings.num_embeddings
-            new_token_count = current_token_count + num_tokens_added
-            # the following call is slow - todo make batched for better performance with vector length >1
-            self.text_encoder.resize_token_embeddings(new_token_count)
-
-        token_id = self.tokenizer.convert_tokens_to_ids(token_str)
-        if token_id == self.tokenizer.unk_token_id:
-            raise RuntimeError(f"Unable to find token id for token '{token_str}'")
-        if self.text_encoder.get_input_embeddings().weight.data[token_id].shape != embedding.shape:
-            raise ValueError(f"Warning. Cannot load embedding for {token_str}. It was trained on a model with token dimension {embedding.shape[0]}, but the current model has token dimension {self.text_encoder.get_input_embeddings().weight.data[token_id].shape[0]}.")
-        self.text_encoder.get_input_embeddings().weight.data[token_id] = embedding
-
-        return token_id
+        expanded_prompt_token_ids = []
+        for token_id in prompt_token_ids:
+            expanded_prompt_token_ids.append(token_id)
+            textual_inversion = self.textual_inversions_by_token_id.get(token_id)
+            if textual_inversion is not None:
+                expanded_prompt_token_ids.extend(textual_inversion.pad_token_ids)
+
+        return expanded_prompt_token_ids
+
 
     def _parse_embedding(self, embedding_file: str):
         file_type = embedding_file.split('.')[-1]
@@ -0,0 +1,66 @@
+import unittest
+from types import SimpleNamespace
+
+import torch
+
+try:
+    from diffusers import EulerAncestralDiscreteScheduler, EulerDiscreteScheduler
+    from ldm.invoke.generator.txt2img import Txt2Img
+except ImportError:
+    Txt2Img = None
+
+
+class DummyPipeline:
+    channels = 4
+    device = torch.device('cpu')
+
+    def __init__(self):
+        self.scheduler = None
+        self.batch_sizes = []
+
+    def image_from_embeddings(self, latents, noise, num_inference_steps, conditioning_data, callback=None):
+        self.batch_sizes.append(noise.shape[0])
+        x = noise
+        for _ in range(num_inference_steps):
+            x = x * 0.5
+            if isinstance(self.scheduler, EulerAncestralDiscreteScheduler):
+                # like an ancestral step, the fresh noise comes from the global RNG
+                x = x + torch.randn_like(x)
+        return SimpleNamespace(images=x, attention_map_saver=None)
+
+    @staticmethod
+    def numpy_to_pil(images):
+        return list(images)
+
+
+@unittest.skipIf(Txt2Img is None, 'diffusers is not installed')
+class BatchedGenerationTestCase(unittest.TestCase):
+
+    def generate(self, pipeline, sampler, seed, iterations, max_batch_size):
+        generator = Txt2Img(pipeline, 'float32')
+        return generator.generate('a prompt', None, 64, 64, sampler,
+                                  iterations=iterations, seed=seed, max_batch_size=max_batch_size,
+                                  steps=3, cfg_scale=7.5, ddim_eta=0.0,
+                                  conditioning=(torch.zeros(1, 77, 768), torch.zeros(1, 77, 768), None))
+
+    def check_same_images_as_batch_of_one(self, sampler):
+        pipeline = DummyPipeline()
+        batched = self.generate(pipeline, sampler, seed=1234, iterations=4, max_batch_size=4)
+        self.assertEqual(len(batched), 4)
+        for image, seed in batched:
+            single, = self.generate(DummyPipeline(), sampler, seed=seed, iterations=1, max_batch_size=1)
+            self.assertEqual(single[1], seed)
+            self.assertTrue(torch.equal(single[0], image))
+        return pipeline.batch_sizes
+
+    def test_deterministic_sampler_is_batched(self):
+        batch_sizes = self.check_same_images_as_batch_of_one(EulerDiscreteScheduler())
+        self.assertEqual(batch_sizes, [4])
+
+    def test_ancestral_sampler_is_not_batched(self):
+        batch_sizes = self.check_same_images_as_batch_of_one(EulerAncestralDiscreteScheduler())
+        self.assertEqual(batch_sizes, [1, 1, 1, 1])
+
+
+if __name__ == '__main__':
+    unittest.main()
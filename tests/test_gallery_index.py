@@ -0,0 +1,60 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from PIL import Image
+
+from backend.modules import gallery_index
+from backend.modules.gallery_index import GalleryIndex
+
+
+class GalleryIndexTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.result_path = os.path.join(self.tmpdir.name, 'outputs')
+        self.user_path = os.path.join(self.result_path, 'init-images')
+        os.makedirs(self.user_path)
+        self.index = GalleryIndex(
+            os.path.join(self.tmpdir.name, 'databases', 'gallery.db'),
+            {'result': self.result_path, 'user': self.user_path},
+            lambda image, filename: filename,
+        )
+        self.index.reconcile(force=True)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def save(self, name):
+        path = os.path.join(self.result_path, name)
+        image = Image.new('RGB', (8, 8))
+        image.save(path)
+        self.index.add(path, image=image, metadata={})
+        return path
+
+    def test_own_save_does_not_rescan(self):
+        for name in ('000001.png', '000002.png'):
+            self.save(name)
+            with mock.patch.object(gallery_index.os, 'scandir', wraps=os.scandir) as scandir:
+                self.index.reconcile()
+            scandir.assert_not_called()
+        self.assertEqual(len(self.index.images('result')), 2)
+
+    def test_foreign_save_is_picked_up(self):
+        self.save('000001.png')
+        Image.new('RGB', (8, 8)).save(os.path.join(self.result_path, '000002.png'))
+        self.index.reconcile()
+        self.assertEqual(len(self.index.images('result')), 2)
+
+    def test_database_in_gallery_directory_is_rejected(self):
+        with self.assertRaises(ValueError):
+            GalleryIndex(
+                os.path.join(self.result_path, 'gallery.db'),
+                {'result': self.result_path},
+                lambda image, filename: filename,
+            )
+
+
+if __name__ == '__main__':
+    unittest.main()
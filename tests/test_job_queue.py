@@ -0,0 +1,38 @@
+import unittest
+
+from backend.modules.job_queue import (
+    Job,
+    JobQueue,
+    MAX_CLIENT_PRIORITY,
+    PRIORITY_HIGH,
+    PRIORITY_NORMAL,
+    client_priority,
+)
+
+
+class JobQueueTestCase(unittest.TestCase):
+
+    def test_client_priority_is_bounded(self):
+        self.assertEqual(client_priority(1), 1)
+        self.assertEqual(client_priority('1'), 1)
+        self.assertEqual(client_priority(1000), PRIORITY_NORMAL + MAX_CLIENT_PRIORITY)
+        self.assertEqual(client_priority(-1000), PRIORITY_NORMAL - MAX_CLIENT_PRIORITY)
+        for value in (None, 'high', [1], {}, float('nan'), float('inf')):
+            self.assertEqual(client_priority(value), PRIORITY_NORMAL)
+        self.assertLess(PRIORITY_NORMAL + MAX_CLIENT_PRIORITY, PRIORITY_HIGH)
+
+    def test_server_jobs_go_first(self):
+        job_queue = JobQueue()
+        greedy = Job('greedy', 'generation', None, priority=client_priority(1000))
+        other = Job('other', 'generation', None)
+        model_change = Job('other', 'model change', None, priority=PRIORITY_HIGH)
+        for job in (greedy, other, model_change):
+            job_queue.submit(job)
+        self.assertEqual(
+            [job_queue.next_job(timeout=0) for _ in range(3)],
+            [model_change, greedy, other],
+        )
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+import threading
+import unittest
+
+import torch
+
+try:
+    from ldm.invoke.model_manager import ModelManager, GIG
+except ImportError:
+    ModelManager = None
+
+
+def make_model_manager(max_loaded_models, max_cache_size, models):
+    '''
+    A ModelManager holding the given models, which are (name, location, size
+    in GB) tuples from least to most recently used, without loading any
+    weights. The last model is the current one.
+    '''
+    manager = ModelManager.__new__(ModelManager)
+    manager.config = {name: {} for name, _, _ in models}
+    manager.device = torch.device('cuda')
+    manager.max_loaded_models = max_loaded_models
+    manager.max_cache_bytes = int(max_cache_size * GIG)
+    manager.max_vram_cache_bytes = 0
+    manager.models = {
+        name: {'model': None, 'location': location, 'size': int(size * GIG)}
+        for name, location, size in models
+    }
+    manager.stack = [name for name, _, _ in models]
+    manager.current_model = models[-1][0]
+    manager.cache_hits = manager.cache_misses = manager.cache_evictions = 0
+    manager._prefetch_lock = threading.Lock()
+    manager._prefetch_threads = {}
+    manager._prefetched = {}
+    return manager
+
+
+@unittest.skipIf(ModelManager is None, 'diffusers is not installed')
+class ModelCacheTestCase(unittest.TestCase):
+
+    def test_ram_limit_only_evicts_models_in_ram(self):
+        manager = make_model_manager(10, 3, [
+            ('vram-old', 'device', 2),
+            ('ram-old', 'cpu', 2),
+            ('vram-new', 'device', 2),
+            ('ram-new', 'cpu', 2),
+            ('current', 'device', 2),
+        ])
+        manager._make_cache_room(incoming=0, keep='current')
+        self.assertEqual(list(manager.models), ['vram-old', 'vram-new', 'ram-new', 'current'])
+        self.assertEqual(manager.current_model, 'current')
+        self.assertEqual(manager.cache_evictions, 1)
+
+    def test_count_limit_evicts_least_recently_used(self):
+        manager = make_model_manager(3, 100, [
+            ('vram-old', 'device', 2),
+            ('ram-old', 'cpu', 2),
+            ('current', 'device', 2),
+        ])
+        manager._make_cache_room(incoming=1, keep='current')
+        self.assertEqual(list(manager.models), ['ram-old', 'current'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+import threading
+import unittest
+
+import torch
+
+from ldm.invoke.restoration.model_pool import PostprocessorModelPool
+
+
+class PostprocessorModelPoolTestCase(unittest.TestCase):
+
+    def test_loading_does_not_block_other_models(self):
+        pool = PostprocessorModelPool()
+        started = threading.Event()
+        release = threading.Event()
+        loads = []
+
+        def slow_loader(device):
+            loads.append('slow')
+            started.set()
+            release.wait(5)
+            return torch.nn.Identity()
+
+        def use_slow():
+            with pool.use('slow', slow_loader, 'cpu'):
+                pass
+
+        threads = [threading.Thread(target=use_slow) for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        self.assertTrue(started.wait(5))
+
+        # another model can be loaded and used while 'slow' is loading
+        fast_done = threading.Event()
+
+        def use_fast():
+            with pool.use('fast', lambda device: torch.nn.Identity(), 'cpu'):
+                fast_done.set()
+
+        fast_thread = threading.Thread(target=use_fast)
+        fast_thread.start()
+        self.assertTrue(fast_done.wait(2))
+
+        release.set()
+        fast_thread.join(5)
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(loads, ['slow'])
+        self.assertEqual(pool.models['slow'].users, 0)
+
+    def test_failed_load_is_retried(self):
+        pool = PostprocessorModelPool()
+
+        def failing_loader(device):
+            raise RuntimeError('no weights')
+
+        with self.assertRaises(RuntimeError):
+            with pool.use('model', failing_loader, 'cpu'):
+                pass
+        with pool.use('model', lambda device: torch.nn.Identity(), 'cpu') as model:
+            self.assertIsInstance(model, torch.nn.Identity)
+
+
+if __name__ == '__main__':
+    unittest.main()
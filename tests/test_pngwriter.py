@@ -0,0 +1,36 @@
+import os
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+from PIL import Image
+
+from ldm.invoke.pngwriter import BackgroundImageWriter, PngWriter
+
+
+class PngWriterTestCase(unittest.TestCase):
+
+    def test_writes_to_the_same_name_are_ordered(self):
+        save = PngWriter.save_image_and_prompt_to_png
+
+        def slow_save(writer, image, *args, **kwargs):
+            if image.size == (8, 8):
+                time.sleep(0.5)
+            return save(writer, image, *args, **kwargs)
+
+        background = BackgroundImageWriter(max_workers=2)
+        with tempfile.TemporaryDirectory() as outdir, \
+                mock.patch.object(PngWriter, 'save_image_and_prompt_to_png', slow_save):
+            writer = PngWriter(outdir, background=background)
+            # a raw image, then its upscaled version under the same name
+            writer.submit_image_and_prompt_to_png(Image.new('RGB', (8, 8)), 'a prompt', '000001.1.png')
+            writer.submit_image_and_prompt_to_png(Image.new('RGB', (32, 32)), 'a prompt', '000001.1.png')
+            writer.wait()
+            with Image.open(os.path.join(outdir, '000001.1.png')) as image:
+                self.assertEqual(image.size, (32, 32))
+        background.shutdown()
+
+
+if __name__ == '__main__':
+    unittest.main()
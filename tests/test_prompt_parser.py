@@ -494,6 +494,11 @@ class PromptParserTestCase(unittest.TestCase):
                          parse_prompt("(\"mountain man\", \"a person with a hat (riding a bicycle.swap(skateboard))++\").and(0.5, 0.5)"))
         pass
 
+    def test_grammar_is_shared(self):
+        self.assertIs(PromptParser().conjunction, PromptParser().conjunction)
+        self.assertIsNot(PromptParser().conjunction, PromptParser(attention_plus_base=1.2).conjunction)
+        self.assertTrue(pyparsing.ParserElement._packratEnabled)
+
 
 if __name__ == '__main__':
     unittest.main()
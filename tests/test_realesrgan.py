@@ -0,0 +1,41 @@
+import unittest
+from types import SimpleNamespace
+
+import numpy as np
+import torch
+from PIL import Image
+
+from ldm.invoke.restoration.realesrgan import ESRGAN, upscale_in_tiles
+
+
+def make_dummy_upsampler():
+    return SimpleNamespace(
+        model=torch.nn.Upsample(scale_factor=4, mode='nearest'),
+        device=torch.device('cpu'),
+        half=False,
+        scale=4,
+    )
+
+def make_test_image(width=48, height=40):
+    rng = np.random.default_rng(0)
+    return Image.fromarray(rng.integers(0, 256, (height, width, 3), dtype=np.uint8))
+
+
+class ESRGANTestCase(unittest.TestCase):
+
+    def test_tiles_match_whole_image(self):
+        image = np.asarray(make_test_image())
+        whole = upscale_in_tiles(make_dummy_upsampler().model, image, tile_size=1000, device=torch.device('cpu'))
+        tiled = upscale_in_tiles(make_dummy_upsampler().model, image, tile_size=16, device=torch.device('cpu'))
+        self.assertTrue(np.array_equal(whole, tiled))
+
+    def test_tiled_upscale_with_strength(self):
+        image = make_test_image()
+        esrgan = ESRGAN(bg_tile_size=16)
+        for upsampler_scale in (2, 4):
+            res = esrgan._process(make_dummy_upsampler(), image, strength=0.75, seed=None, upsampler_scale=upsampler_scale)
+            self.assertEqual(res.size, (image.width * upsampler_scale, image.height * upsampler_scale))
+
+
+if __name__ == '__main__':
+    unittest.main()
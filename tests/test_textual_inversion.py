@@ -19,6 +19,19 @@ class DummyEmbeddingsList(list):
             return self
         elif name == 'data':
             return self
+        elif name == 'embedding_dim':
+            return self[0].shape[0]
+        elif name == 'dtype':
+            return self[0].dtype
+        elif name == 'device':
+            return self[0].device
+
+    def __setitem__(self, index, value):
+        if isinstance(index, list):
+            for i, v in zip(index, value):
+                super().__setitem__(i, v)
+        else:
+            super().__setitem__(index, value)
 
 def make_dummy_embedding():
     return torch.randn([768])
@@ -28,11 +41,13 @@ class DummyTransformer:
 
     def __init__(self):
         self.embeddings = DummyEmbeddingsList([make_dummy_embedding() for _ in range(len(KNOWN_WORDS))])
+        self.resize_count = 0
 
     def resize_token_embeddings(self, new_size=None):
         if new_size is None:
             return self.embeddings
         else:
+            self.resize_count += 1
             while len(self.embeddings) > new_size:
                 self.embeddings.pop(-1)
             while len(self.embeddings) < new_size:
@@ -50,12 +65,16 @@ class DummyTokenizer():
         self.unk_token_id = 49407
 
     def convert_tokens_to_ids(self, token_str):
+        if isinstance(token_str, list):
+            return [self.convert_tokens_to_ids(t) for t in token_str]
         try:
             return self.tokens.index(token_str)
         except ValueError:
             return self.unk_token_id
 
     def add_tokens(self, token_str):
+        if isinstance(token_str, list):
+            return sum(self.add_tokens(t) for t in token_str)
         if token_str in self.tokens:
             return 0
         self.tokens.append(token_str)
@@ -96,6 +115,10 @@ class TextualInversionManagerTestCase(unittest.TestCase):
         test_embedding = torch.randn([1, 768])
         test_embedding_name = KNOWN_WORDS[0]
         self.assertFalse(tim.has_textual_inversion_for_trigger_string(test_embedding_name))
+        with self.assertRaises(KeyError):
+            tim.get_textual_inversion_for_trigger_string(test_embedding_name)
+        with self.assertRaises(KeyError):
+            tim.get_textual_inversion_for_token_id(0)
 
         pre_embeddings_count = len(tim.text_encoder.resize_token_embeddings(None))
 
@@ -299,3 +322,26 @@ class TextualInversionManagerTestCase(unittest.TestCase):
         textual_inversion = tim.get_textual_inversion_for_trigger_string(test_embedding_name)
         self.assertEqual(textual_inversion.trigger_string, test_embedding_name)
         self.assertEqual(textual_inversion.trigger_token_id, len(KNOWN_WORDS))
+
+
+    def test_deferred_loading_is_batched(self):
+        tim = make_dummy_textual_inversion_manager()
+        test_embedding_8v = torch.randn([8, 768])
+        test_embedding_2v = torch.randn([2, 768])
+        tim._add_textual_inversion(UNKNOWN_WORDS[0], test_embedding_8v, defer_injecting_tokens=True)
+        tim._add_textual_inversion(UNKNOWN_WORDS[1], test_embedding_2v, defer_injecting_tokens=True)
+        pre_embeddings_count = len(tim.text_encoder.resize_token_embeddings(None))
+
+        prompt = " ".join([KNOWN_WORDS[0], UNKNOWN_WORDS[0], UNKNOWN_WORDS[1]])
+        injected_token_ids = tim.create_deferred_token_ids_for_any_trigger_terms(prompt)
+
+        # all 10 tokens are added with a single resize
+        self.assertEqual(tim.text_encoder.resize_count, 1)
+        self.assertEqual(len(tim.text_encoder.resize_token_embeddings(None)), pre_embeddings_count + 10)
+        self.assertEqual(injected_token_ids, list(range(len(KNOWN_WORDS), len(KNOWN_WORDS) + 10)))
+
+        ti_8v = tim.get_textual_inversion_for_trigger_string(UNKNOWN_WORDS[0])
+        ti_2v = tim.get_textual_inversion_for_trigger_string(UNKNOWN_WORDS[1])
+        embeddings = tim.text_encoder.get_input_embeddings().weight.data
+        self.assertTrue(torch.equal(torch.stack([embeddings[i] for i in [ti_8v.trigger_token_id] + ti_8v.pad_token_ids]), test_embedding_8v))
+        self.assertTrue(torch.equal(torch.stack([embeddings[i] for i in [ti_2v.trigger_token_id] + ti_2v.pad_token_ids]), test_embedding_2v))